@@ -0,0 +1,83 @@
+
+"""
+Checks that the incremental `FairnessQueue` produces the same order as `pods_calculate_order`
+on random sequences of pod additions, removals, priority and utilization changes.
+
+	python -m experiments.fairness_queue_equivalence --steps 5000
+"""
+
+import random
+import click
+from copy import copy
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+from kube_watchdog.fairness import pods_calculate_order, FairnessQueue
+
+USERS = [None, 'alice', 'bob', 'carol', 'dave', 'eve']
+STATUSES = ['Running', 'Running', 'Running', 'Pending', 'Succeeded']
+DATE_BASE = datetime(2019, 10, 1, tzinfo=timezone.utc)
+
+def random_pod(rng, name):
+	# few distinct dates to exercise the tie-break by name
+	date_started = DATE_BASE + timedelta(hours=rng.randrange(8))
+	return SimpleNamespace(
+		name = name,
+		user = rng.choice(USERS),
+		status = rng.choice(STATUSES),
+		date_created = date_started,
+		date_started = date_started,
+		num_gpu = rng.choice([0, 1, 1, 2, 4]),
+		user_priority = rng.choice([-1, 0, 0, 1, 2]),
+		user_ordinal = 0,
+		global_ordinal = 0,
+		utilization_mem = None,
+		utilization_compute = None,
+		utilization_date = None,
+	)
+
+def order_summary(pod_list):
+	return [
+		(p.name, p.user_ordinal, p.global_ordinal, p.utilization_compute)
+		for p in pod_list
+	]
+
+@click.command()
+@click.option('--steps', type=int, default=2000)
+@click.option('--num-names', type=int, default=60)
+@click.option('--seed', type=int, default=0)
+def main(steps, num_names, seed):
+	rng = random.Random(seed)
+	pods = {}
+	queue = FairnessQueue()
+
+	for step in range(steps):
+		name = f'pod-{rng.randrange(num_names)}'
+		action = rng.random()
+		pod = pods.get(name)
+
+		if pod is None or action < 0.3:
+			# added, or new description
+			pods[name] = random_pod(rng, name)
+		elif action < 0.45:
+			del pods[name]
+		elif action < 0.6:
+			# priority label changed, the supervisor publishes a new object
+			pod = copy(pod)
+			pod.user_priority = rng.choice([-1, 0, 1, 2])
+			pods[name] = pod
+		else:
+			# utilization is updated in-place
+			pod.utilization_compute = round(rng.random(), 2)
+
+		pod_list = sorted(pods.values(), key=lambda p: p.name)
+		# both write the ordinals into the pod objects, the reference works on copies
+		expected = order_summary(pods_calculate_order([copy(p) for p in pod_list]))
+		result = order_summary(queue.update(pod_list))
+
+		if expected != result:
+			raise AssertionError(f'Step {step}: orders differ\nexpected {expected}\nresult   {result}')
+
+	print(f'{steps} steps: FairnessQueue is equivalent to pods_calculate_order')
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,107 @@
+
+"""
+Compares `NvidiaSmiCsvParser` against the previous `np.genfromtxt` parsing
+on long `nvidia-smi --format=csv --loop` outputs of multi-GPU nodes.
+
+	python -m experiments.nvidiasmi_parser_benchmark --num-gpus 8 --num-loops 1000
+"""
+
+import random
+import timeit
+import click
+import numpy as np
+from io import StringIO
+from kube_watchdog.utilization_monitor import GPU_QUERY_FIELDS, NvidiaSmiCsvParser, process_nvidiasmi_report
+
+#
+# Previous implementation, kept here as the reference
+#
+
+def process_row_percent(val):
+	return float(val.split(maxsplit=1)[0]) * 0.01
+
+def process_row_mem(val):
+	return float(val.split(maxsplit=1)[0])
+
+class FrozenDict(dict):
+	def __setitem__(self, key, value):
+		raise RuntimeError(f'FrozenDict: Trying to set key {key} to {value}')
+
+GPU_QUERY_PROCESSORS = FrozenDict(**{
+	'index': int,
+	'utilization.gpu': process_row_percent,
+	'memory.used': process_row_mem,
+	'memory.total': process_row_mem,
+})
+
+def legacy_process_nvidiasmi_report(report_txt):
+	report_table = np.genfromtxt(
+		StringIO(report_txt),
+		names = GPU_QUERY_FIELDS,
+		converters = GPU_QUERY_PROCESSORS,
+		deletechars = '',
+		delimiter = ',',
+		skip_header = 1,
+		autostrip = True,
+		dtype = None,
+		encoding = 'utf8',
+	)
+
+	mem_relative = report_table['memory.used'] / report_table['memory.total']
+	gpu_util = report_table['utilization.gpu']
+
+	return dict(
+		memory = np.mean(mem_relative).round(2),
+		compute = np.mean(gpu_util).round(2),
+	)
+
+#
+# Benchmark
+#
+
+def synthetic_report(num_gpus, num_loops, seed=0):
+	rng = random.Random(seed)
+	mem_total = 16160
+	lines = ['index, utilization.gpu [%], memory.used [MiB], memory.total [MiB]']
+	for _ in range(num_loops):
+		for gpu_idx in range(num_gpus):
+			lines.append(f'{gpu_idx}, {rng.randrange(101)} %, {rng.randrange(mem_total)} MiB, {mem_total} MiB')
+	return '\n'.join(lines) + '\n'
+
+def chunks(text, chunk_size):
+	return [text[i:i+chunk_size] for i in range(0, len(text), chunk_size)]
+
+def parse_streamed(report_chunks):
+	parser = NvidiaSmiCsvParser()
+	for chunk in report_chunks:
+		parser.feed(chunk)
+	parser.finish()
+	return parser.summary()
+
+@click.command()
+@click.option('--num-gpus', type=int, default=8)
+@click.option('--num-loops', type=int, default=1000)
+@click.option('--chunk-size', type=int, default=4096, help="Size of the websocket messages in the streamed case")
+@click.option('--repeat', type=int, default=10)
+def main(num_gpus, num_loops, chunk_size, repeat):
+	report_txt = synthetic_report(num_gpus, num_loops)
+	report_chunks = chunks(report_txt, chunk_size)
+
+	legacy = legacy_process_nvidiasmi_report(report_txt)
+	current = process_nvidiasmi_report(report_txt)
+	if abs(legacy['memory'] - current['memory']) > 0.01 or abs(legacy['compute'] - current['compute']) > 0.01:
+		raise AssertionError(f'Legacy and current results differ: {legacy} {current}')
+
+	cases = [
+		('np.genfromtxt', lambda: legacy_process_nvidiasmi_report(report_txt)),
+		('NvidiaSmiCsvParser, whole text', lambda: process_nvidiasmi_report(report_txt)),
+		(f'NvidiaSmiCsvParser, {chunk_size}B chunks', lambda: parse_streamed(report_chunks)),
+	]
+
+	print(f'{num_gpus} GPUs x {num_loops} loops = {num_gpus * num_loops} rows, {len(report_txt) / 1024:.0f} KiB, best of {repeat}')
+	for name, func in cases:
+		duration = min(timeit.repeat(func, number=1, repeat=repeat))
+		print(f'	{name:<36} {duration*1e3:8.2f} ms')
+
+if __name__ == '__main__':
+	main()
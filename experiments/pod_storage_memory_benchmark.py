@@ -0,0 +1,96 @@
+
+"""
+Memory held by the supervisor and the fairness ordering for the stored pods,
+compared with the previous storage which retained the `V1Pod` objects,
+used `PodInfoToPublish` records with a `__dict__` and copied the running pods for the ordering.
+
+	python -m experiments.pod_storage_memory_benchmark --num-pods 5000
+"""
+
+import gc
+import tracemalloc
+import click
+from copy import copy
+from kube_watchdog.benchmark.synthetic import SyntheticPodGenerator
+from kube_watchdog.monitor import KubernetesPodListSupervisor, PodStoredData, PodInfoToPublish, pod_key
+from kube_watchdog.fairness import FairnessQueuesByNamespace
+from kube_watchdog.state_revisions import POD_FIELD_NAMES
+from kube_watchdog.pod_json import sanitize_model
+
+#
+# Previous storage, kept here as the reference
+#
+
+class LegacyPodInfoToPublish:
+	""" Same fields as `PodInfoToPublish`, stored in the instance `__dict__` like the non-slotted dataclass """
+	def __init__(self, pod_info):
+		for name in POD_FIELD_NAMES:
+			setattr(self, name, getattr(pod_info, name))
+
+class LegacyPodStoredData:
+	def __init__(self, pod_obj):
+		self.name = pod_obj.metadata.name
+		self.namespace = pod_obj.metadata.namespace
+		self.description_from_api = pod_obj
+		self.data_pub = LegacyPodInfoToPublish(PodInfoToPublish(sanitize_model(pod_obj)))
+
+def legacy_storage(generator, states):
+	pod_data_by_key = {}
+	for state in states:
+		pod_data = LegacyPodStoredData(generator.build_pod(state))
+		pod_data_by_key[pod_key(pod_data.namespace, pod_data.name)] = pod_data
+
+	# the ordering kept its own copy of each running pod
+	ordering_copies = [copy(pd.data_pub) for pd in pod_data_by_key.values() if pd.data_pub.status == 'Running']
+	return pod_data_by_key, ordering_copies
+
+#
+# Current storage
+#
+
+def current_storage(generator, states):
+	supervisor = KubernetesPodListSupervisor(namespaces=[generator.namespace], coalesce_window=0, measure_utilization=False)
+	for state in states:
+		pod_data = PodStoredData(supervisor, sanitize_model(generator.build_pod(state)))
+		supervisor.pod_data_by_key[pod_key(pod_data.namespace, pod_data.name)] = pod_data
+
+	supervisor.publish_state()
+	ordering = FairnessQueuesByNamespace()
+	ordering.update(supervisor.get_pods())
+	return supervisor, ordering
+
+#
+# Benchmark
+#
+
+def retained_memory(build_func, *args):
+	""" Bytes allocated by `build_func` which are still referenced by its result """
+	gc.collect()
+	tracemalloc.start()
+	result = build_func(*args)
+	gc.collect()
+	retained, peak = tracemalloc.get_traced_memory()
+	tracemalloc.stop()
+	del result
+	return retained, peak
+
+@click.command()
+@click.option('--num-pods', type=int, default=5000)
+@click.option('--num-users', type=int, default=40)
+@click.option('--seed', type=int, default=0)
+def main(num_pods, num_users, seed):
+	generator = SyntheticPodGenerator(num_users=num_users, seed=seed)
+	states = generator.initial_pods(num_pods)
+
+	cases = [
+		('V1Pod + __dict__ records + copies', legacy_storage),
+		('JSON bytes + slotted records', current_storage),
+	]
+
+	print(f'{num_pods} pods, memory retained after building the storage (peak during the build)')
+	for name, func in cases:
+		retained, peak = retained_memory(func, generator, states)
+		print(f'	{name:<36} {retained / 2**20:7.1f} MiB  {retained / num_pods:7.0f} B/pod  (peak {peak / 2**20:.1f} MiB)')
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,114 @@
+
+"""
+Checks that the queries answered from `StateIndex` return the same pods as filtering the whole pod list,
+on a random sequence of synthetic pod changes, including pods which are not running.
+
+	python -m experiments.state_query_equivalence --steps 300
+"""
+
+import random
+import click
+from multidict import MultiDict
+from kube_watchdog.benchmark.synthetic import SyntheticPodGenerator
+from kube_watchdog.monitor import PodInfoToPublish
+from kube_watchdog.pod_json import sanitize_model
+from kube_watchdog.fairness import FairnessQueuesByNamespace
+from kube_watchdog.state_revisions import StateRevisionLog, pod_field_values, pod_json_fragment
+from kube_watchdog.state_query import StateIndex, StateQuery, SORT_KEYS, is_pod_idle
+
+def random_query(rng, pods):
+	users = sorted({p.user for p in pods if p.user})
+	nodes = sorted({p.node for p in pods if p.node})
+
+	query = MultiDict()
+	if rng.random() < 0.5:
+		for user in rng.sample(users, rng.randint(1, 3)):
+			query.add('user', user)
+	if rng.random() < 0.4:
+		query.add('status', rng.choice(['Running', 'Pending']))
+	if rng.random() < 0.3 and nodes:
+		query.add('node', rng.choice(nodes))
+	if rng.random() < 0.3:
+		query.add('min_gpus', str(rng.randrange(3)))
+	if rng.random() < 0.3:
+		query.add('max_gpus', str(rng.randrange(1, 5)))
+	if rng.random() < 0.2:
+		query.add('idle', '1')
+	if rng.random() < 0.5:
+		query.add('sort', rng.choice(['', '-']) + rng.choice(list(SORT_KEYS)))
+	if rng.random() < 0.5:
+		query.add('limit', str(rng.randrange(1, 30)))
+		query.add('offset', str(rng.randrange(0, 50)))
+	return query
+
+def reference_query(all_pods, query : StateQuery):
+	""" The same query by filtering the list in index order """
+	pods = [
+		p for p in all_pods
+		if all(getattr(p, field) in values for field, values in query.field_values.items())
+		and (query.min_gpus is None or p.num_gpu >= query.min_gpus)
+		and (query.max_gpus is None or p.num_gpu <= query.max_gpus)
+		and (not query.idle_only or is_pod_idle(p))
+	]
+
+	sort_key = SORT_KEYS[query.sort]
+	if sort_key is not None:
+		pods.sort(key=sort_key, reverse=query.sort_descending)
+	elif query.sort_descending:
+		pods.reverse()
+
+	end = query.offset + query.limit if query.limit is not None else None
+	return len(pods), pods[query.offset:end]
+
+@click.command()
+@click.option('--steps', type=int, default=300)
+@click.option('--num-pods', type=int, default=300)
+@click.option('--queries-per-step', type=int, default=20)
+@click.option('--seed', type=int, default=0)
+def main(steps, num_pods, queries_per_step, seed):
+	rng = random.Random(seed)
+	generator = SyntheticPodGenerator(num_users=12, seed=seed)
+	states = {s.name: s for s in generator.initial_pods(num_pods)}
+	pods = {name: PodInfoToPublish(sanitize_model(generator.build_pod(s))) for name, s in states.items()}
+
+	ordering = FairnessQueuesByNamespace()
+	state_log = StateRevisionLog()
+	index = None
+
+	for step in range(steps):
+		# new descriptions, as the supervisor publishes new objects
+		for name in rng.sample(sorted(states), 10):
+			states[name] = generator.modified_pod_state(states[name])
+			pods[name] = PodInfoToPublish(sanitize_model(generator.build_pod(states[name])))
+
+		# utilization reports replace the objects with copies
+		for name in rng.sample(sorted(pods), 10):
+			pods[name] = pods[name].with_utilization_report(dict(memory=rng.random(), compute=rng.choice([0., 0.01, rng.random()])))
+
+		pod_list = sorted(pods.values(), key=lambda p: p.key)
+		hierarchy = ordering.update(pod_list)
+		others = [p for p in pod_list if p.status != 'Running']
+		state_log.update(hierarchy)
+		index = StateIndex(hierarchy, others, previous=index)
+		all_pods = hierarchy + others
+
+		num_pending = sum(p.status == 'Pending' for p in pod_list)
+		total, pending = index.query(StateQuery.from_query(MultiDict(status='Pending')))
+		if total != num_pending or not all(p.status == 'Pending' for p in pending):
+			raise AssertionError(f'Step {step}: status=Pending gave {total} pods, expected {num_pending}')
+
+		for _ in range(queries_per_step):
+			query = StateQuery.from_query(random_query(rng, pod_list))
+			result = index.query(query)
+			expected = reference_query(all_pods, query)
+			if [p.key for p in result[1]] != [p.key for p in expected[1]] or result[0] != expected[0]:
+				raise AssertionError(f'Step {step}: {query} differs\nexpected {expected}\nresult   {result}')
+
+			for pod in result[1]:
+				if index.pod_json(pod, state_log.pod_json_by_key) != pod_json_fragment(pod_field_values(pod)):
+					raise AssertionError(f'Step {step}: outdated JSON of {pod.key}')
+
+	print(f'{steps} steps, {num_pending} of {len(pods)} pods pending: StateIndex queries are equivalent to filtering the list')
+
+if __name__ == '__main__':
+	main()
@@ -2,15 +2,23 @@
 import logging, logging.handlers, sys
 from pathlib import Path
 
-def init_log():
+def init_log(file_name='watchdog.log'):
+	"""
+	file_name - in ./logs, each process needs its own file, as a rotation would break the other writers
+	"""
 	log_root = logging.getLogger(__name__)
 	log_root.setLevel(logging.DEBUG)
 
+	# called again in a web worker, which has imported the package
+	for handler in list(log_root.handlers):
+		log_root.removeHandler(handler)
+		handler.close()
+
 	Path('./logs').mkdir(exist_ok=True)
 	
 	handlers = [
 		logging.StreamHandler(sys.stdout),
-		logging.handlers.RotatingFileHandler('logs/watchdog.log', maxBytes=1024*1024, backupCount=7),
+		logging.handlers.RotatingFileHandler(Path('logs') / file_name, maxBytes=1024*1024, backupCount=7),
 	]
 
 	handlers[0].setLevel(logging.DEBUG)
@@ -2,9 +2,14 @@
 import click
 from .console import main as console_main
 from .web import main as web_main
+from .benchmark import main as benchmark_main, fake_api_main
+from .node_agent import main as agent_main
 
 entrypoint = click.Group(name='kube_watchdog')
 entrypoint.add_command(console_main)
 entrypoint.add_command(web_main)
+entrypoint.add_command(benchmark_main)
+entrypoint.add_command(fake_api_main)
+entrypoint.add_command(agent_main)
 if __name__ == '__main__':
 	entrypoint()
@@ -0,0 +1,58 @@
+
+import asyncio
+import click
+from .synthetic import SyntheticPodGenerator, SyntheticPodState
+from .pipeline import PipelineBenchmark, run_benchmark
+from .fake_api import FakeKubernetesApi
+from ..kube_listener import KubernetesPodListMonitor
+from ..utilization_monitor import GPU_QUERY_MEASUREMENT_DURATION
+
+@click.command('benchmark')
+@click.option('--num-pods', type=int, default=1000, help="Pods created by the initial ADDED events")
+@click.option('--num-events', type=int, default=10000, help="Random ADDED/MODIFIED/DELETED events after the initial ones")
+@click.option('--num-users', type=int, default=40)
+@click.option('--pipeline', type=click.Choice(PipelineBenchmark.PIPELINES), default='incremental')
+@click.option('--decoding', type=click.Choice(KubernetesPodListMonitor.WATCH_DECODINGS), default='raw', help="How the watch stream is decoded")
+@click.option('--utilization-ratio', type=float, default=0.3, help="Utilization reports injected per watch event")
+@click.option('--seed', type=int, default=0)
+@click.option('--memory/--no-memory', default=False, help="Trace allocations with tracemalloc (slow)")
+def main(num_pods, num_events, num_users, pipeline, decoding, utilization_ratio, seed, memory):
+	"""
+	Replay synthetic pod events offline and report throughput and latency.
+	"""
+	print(run_benchmark(
+		num_pods = num_pods,
+		num_events = num_events,
+		num_users = num_users,
+		pipeline = pipeline,
+		decoding = decoding,
+		utilization_ratio = utilization_ratio,
+		seed = seed,
+		trace_memory = memory,
+	))
+
+
+@click.command('fake-api')
+@click.option('--namespace', type=str, default='bench')
+@click.option('--port', type=int, default=8001)
+@click.option('--kubeconfig', type=click.Path(dir_okay=False), default='fake-kubeconfig.yaml', help="Written on start, pass it to the server with --config")
+@click.option('--num-pods', type=int, default=1000)
+@click.option('--num-users', type=int, default=40)
+@click.option('--events-per-second', type=float, default=5.)
+@click.option('--exec-latency', type=float, default=GPU_QUERY_MEASUREMENT_DURATION, help="Seconds before an exec returns the nvidia-smi report")
+@click.option('--history-size', type=int, default=2000, help="Events kept for resuming watches, older versions get 410 Gone")
+@click.option('--seed', type=int, default=0)
+def fake_api_main(namespace, port, kubeconfig, num_pods, num_users, events_per_second, exec_latency, history_size, seed):
+	"""
+	Serve a fake Kubernetes API with synthetic pods, for load-testing without a cluster.
+	"""
+	fake_api = FakeKubernetesApi(
+		namespace = namespace,
+		num_pods = num_pods,
+		num_users = num_users,
+		events_per_second = events_per_second,
+		exec_latency = exec_latency,
+		history_size = history_size,
+		seed = seed,
+	)
+	asyncio.get_event_loop().run_until_complete(fake_api.run(port=port, kubeconfig_path=kubeconfig))
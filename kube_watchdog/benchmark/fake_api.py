@@ -0,0 +1,280 @@
+
+import asyncio
+import json
+import logging
+import random
+from collections import deque
+from pathlib import Path
+import yaml
+from aiohttp import web
+import kubernetes_asyncio as kube
+from .synthetic import SyntheticPodGenerator, SyntheticPodState
+from ..utilization_monitor import GPU_QUERY_MEASUREMENT_DURATION, GPU_QUERY_LOOP_INTERVAL
+
+log = logging.getLogger(__name__)
+
+# channels of the v4.channel.k8s.io exec protocol
+CHANNEL_STDOUT = 1
+CHANNEL_STDERR = 2
+CHANNEL_ERROR = 3
+
+EXEC_STATUS_SUCCESS = json.dumps({'metadata': {}, 'status': 'Success'})
+EXEC_STATUS_FAILURE = json.dumps({
+	'metadata': {},
+	'status': 'Failure',
+	'message': 'command terminated with non-zero exit code',
+	'reason': 'NonZeroExitCode',
+	'details': {'causes': [{'reason': 'ExitCode', 'message': '127'}]},
+})
+
+def query_flag(request, name):
+	return request.query.get(name, 'false').lower() in ('true', '1')
+
+def nvidiasmi_csv_chunks(num_gpu, rng, utilization_compute, utilization_mem):
+	"""
+	Output of the `nvidia-smi --format=csv --loop` command run by `GpuUtilizationScheduler`,
+	one chunk per loop iteration, the first one includes the header.
+	"""
+	mem_total = 16160
+	chunks = []
+
+	for loop_idx in range(GPU_QUERY_MEASUREMENT_DURATION // GPU_QUERY_LOOP_INTERVAL):
+		lines = ['index, utilization.gpu [%], memory.used [MiB], memory.total [MiB]'] if loop_idx == 0 else []
+
+		for gpu_idx in range(num_gpu):
+			compute = min(100, max(0, round(rng.gauss(utilization_compute, 10))))
+			mem_used = round(mem_total * utilization_mem)
+			lines.append(f'{gpu_idx}, {compute} %, {mem_used} MiB, {mem_total} MiB')
+
+		chunks.append('\n'.join(lines) + '\n')
+
+	return chunks
+
+def write_kubeconfig(path, server_url, namespace):
+	config = {
+		'apiVersion': 'v1',
+		'kind': 'Config',
+		'clusters': [{'name': 'fake', 'cluster': {'server': server_url}}],
+		'users': [{'name': 'fake', 'user': {'token': 'fake-token'}}],
+		'contexts': [{'name': 'fake', 'context': {'cluster': 'fake', 'user': 'fake', 'namespace': namespace}}],
+		'current-context': 'fake',
+	}
+	Path(path).write_text(yaml.dump(config))
+
+
+class FakeKubernetesApi:
+	"""
+	A stand-in for the Kubernetes API server, implementing what the watchdog uses:
+		- list pods in a namespace or in all namespaces, with resourceVersion
+		- watch pods: streamed JSON lines, resuming from a resourceVersion, 410 Gone when it is too old
+		- exec into a pod over websocket (v4.channel.k8s.io), returning canned `nvidia-smi` output
+
+	The pods come from `SyntheticPodGenerator` and change at `events_per_second`.
+	"""
+
+	def __init__(self, namespace='bench', num_pods=1000, num_users=40, events_per_second=5.,
+			exec_latency=GPU_QUERY_MEASUREMENT_DURATION, history_size=2000, seed=0):
+
+		self.namespace = namespace
+		self.events_per_second = events_per_second
+		self.exec_latency = exec_latency
+		self.rng = random.Random(seed)
+
+		self.generator = SyntheticPodGenerator(num_users=num_users, namespace=namespace, seed=seed)
+		self.generator.initial_pods(num_pods)
+
+		# (resource_version, serialized event line), the oldest events are forgotten and watching from there results in 410
+		self.history = deque(maxlen=history_size)
+		# name -> serialized pod object
+		self.pod_json_by_name = {}
+
+		self.history_changed = None
+		self.api_client = None
+
+		self.num_exec_active = 0
+		self.num_exec_total = 0
+		self.num_watches_active = 0
+
+	def pod_json(self, state : SyntheticPodState):
+		pod_obj = self.generator.build_pod(state)
+		return json.dumps(self.api_client.sanitize_for_serialization(pod_obj))
+
+	def record_event(self, ev_type, state):
+		pod_json = self.pod_json(state)
+
+		if ev_type == 'DELETED':
+			self.pod_json_by_name.pop(state.name, None)
+		else:
+			self.pod_json_by_name[state.name] = pod_json
+
+		line = f'{{"type": "{ev_type}", "object": {pod_json}}}\n'.encode('utf8')
+		self.history.append((state.resource_version, line))
+
+		self.history_changed.set_result(None)
+		self.history_changed = asyncio.get_event_loop().create_future()
+
+	async def churn_loop(self):
+		if self.events_per_second <= 0:
+			return
+
+		for ev_type, state in self.generator.event_states(num_events=2**62):
+			await asyncio.sleep(self.rng.expovariate(self.events_per_second))
+			self.record_event(ev_type, state)
+
+	async def web_list_pods(self, request):
+		if query_flag(request, 'watch'):
+			return await self.web_watch_pods(request)
+
+		body = (
+			f'{{"kind": "PodList", "apiVersion": "v1", "metadata": {{"resourceVersion": "{self.generator.resource_version}"}}, "items": ['
+			+ ','.join(self.pod_json_by_name.values())
+			+ ']}'
+		)
+		return web.Response(text=body, content_type='application/json')
+
+	async def web_watch_pods(self, request):
+		response = web.StreamResponse(headers={'Content-Type': 'application/json'})
+		await response.prepare(request)
+
+		timeout = float(request.query.get('timeoutSeconds', 0)) or None
+		since_version = int(request.query.get('resourceVersion', 0) or 0)
+
+		self.num_watches_active += 1
+		try:
+			if since_version == 0:
+				# no version: start with the current state
+				for pod_json in list(self.pod_json_by_name.values()):
+					await response.write(f'{{"type": "ADDED", "object": {pod_json}}}\n'.encode('utf8'))
+				since_version = self.generator.resource_version
+
+			elif self.history and since_version < self.history[0][0] - 1:
+				gone = {
+					'type': 'ERROR',
+					'object': {
+						'kind': 'Status', 'apiVersion': 'v1', 'metadata': {}, 'status': 'Failure',
+						'message': f'too old resource version: {since_version} ({self.history[0][0]})',
+						'reason': 'Expired', 'code': 410,
+					},
+				}
+				await response.write(json.dumps(gone).encode('utf8') + b'\n')
+				return response
+
+			await asyncio.wait_for(self.stream_history(response, since_version), timeout=timeout)
+
+		except (asyncio.TimeoutError, ConnectionResetError):
+			pass
+		finally:
+			self.num_watches_active -= 1
+
+		return response
+
+	def history_since(self, since_version):
+		new_events = []
+		for (version, line) in reversed(self.history):
+			if version <= since_version:
+				break
+			new_events.append((version, line))
+		new_events.reverse()
+		return new_events
+
+	async def stream_history(self, response, since_version):
+		while True:
+			new_events = self.history_since(since_version)
+
+			if not new_events:
+				await asyncio.shield(self.history_changed)
+				continue
+
+			for (version, line) in new_events:
+				await response.write(line)
+				since_version = version
+
+	async def web_exec(self, request):
+		pod_name = request.match_info['pod_name']
+		ws = web.WebSocketResponse(protocols=['v4.channel.k8s.io'])
+		await ws.prepare(request)
+
+		# reading answers the client's pings, like the API server
+		ping_responder = asyncio.ensure_future(self.read_until_closed(ws))
+
+		self.num_exec_active += 1
+		self.num_exec_total += 1
+		try:
+			state = self.generator.pods.get(pod_name)
+			latency = self.exec_latency * self.rng.uniform(0.8, 1.2)
+
+			if state is None or state.num_gpu == 0:
+				await asyncio.sleep(latency)
+
+			if state is None:
+				await ws.send_bytes(bytes([CHANNEL_STDERR]) + f'pod {pod_name} not found'.encode('utf8'))
+				await ws.send_bytes(bytes([CHANNEL_ERROR]) + EXEC_STATUS_FAILURE.encode('utf8'))
+			elif state.num_gpu == 0:
+				# CPU-only containers do not have nvidia-smi
+				await ws.send_bytes(bytes([CHANNEL_ERROR]) + EXEC_STATUS_FAILURE.encode('utf8'))
+			else:
+				# utilization stable for a given pod
+				pod_rng = random.Random(state.uid)
+				report_chunks = nvidiasmi_csv_chunks(
+					num_gpu = state.num_gpu,
+					rng = self.rng,
+					utilization_compute = pod_rng.uniform(0, 100),
+					utilization_mem = pod_rng.uniform(0, 1),
+				)
+				# the rows arrive as the nvidia-smi loop progresses
+				for chunk in report_chunks:
+					await asyncio.sleep(latency / len(report_chunks))
+					await ws.send_bytes(bytes([CHANNEL_STDOUT]) + chunk.encode('utf8'))
+				await ws.send_bytes(bytes([CHANNEL_ERROR]) + EXEC_STATUS_SUCCESS.encode('utf8'))
+		except ConnectionResetError:
+			# the client has closed the exec, for example after its timeout
+			pass
+		finally:
+			self.num_exec_active -= 1
+			ping_responder.cancel()
+			await ws.close()
+
+		return ws
+
+	@staticmethod
+	async def read_until_closed(ws):
+		async for msg in ws:
+			pass
+
+	async def status_loop(self, interval=10):
+		while True:
+			await asyncio.sleep(interval)
+			log.info(
+				f'pods: {len(self.pod_json_by_name)}, version: {self.generator.resource_version}, '
+				f'watches: {self.num_watches_active}, exec active: {self.num_exec_active}, exec total: {self.num_exec_total}'
+			)
+
+	async def run(self, port, kubeconfig_path=None):
+		self.api_client = kube.client.ApiClient()
+		self.history_changed = asyncio.get_event_loop().create_future()
+
+		for state in self.generator.pods.values():
+			self.pod_json_by_name[state.name] = self.pod_json(state)
+
+		application = web.Application()
+		application.add_routes([
+			web.get('/api/v1/pods', self.web_list_pods),
+			web.get('/api/v1/namespaces/{namespace}/pods', self.web_list_pods),
+			web.get('/api/v1/namespaces/{namespace}/pods/{pod_name}/exec', self.web_exec),
+		])
+
+		runner = web.AppRunner(application)
+		await runner.setup()
+		site = web.TCPSite(runner, '127.0.0.1', port)
+		await site.start()
+
+		if kubeconfig_path:
+			write_kubeconfig(kubeconfig_path, f'http://127.0.0.1:{port}', self.namespace)
+			log.info(f'Kubeconfig written to {kubeconfig_path}')
+
+		log.info(f'Fake Kubernetes API listening on port {port} with {len(self.pod_json_by_name)} pods in namespace {self.namespace}')
+
+		await asyncio.gather(
+			self.churn_loop(),
+			self.status_loop(),
+		)
@@ -0,0 +1,180 @@
+
+import asyncio
+import logging
+import random
+import time
+import tracemalloc
+from datetime import datetime
+import numpy as np
+import kubernetes_asyncio as kube
+from ..kube_listener import KubernetesPodListMonitor
+from ..monitor import KubernetesPodListSupervisor
+from ..fairness import pods_calculate_order, FairnessQueue
+from ..state_revisions import StateRevisionLog
+from ..web import build_json_response
+
+log = logging.getLogger(__name__)
+
+def percentiles_text(durations):
+	if not durations:
+		return '-'
+	d_us = np.array(durations) * 1e6
+	p50, p90, p99 = np.percentile(d_us, [50, 90, 99])
+	return f'p50 {p50:8.1f}  p90 {p90:8.1f}  p99 {p99:8.1f}  max {d_us.max():9.1f} us'
+
+def max_rss_mb():
+	try:
+		import resource
+		# kilobytes on Linux
+		return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+	except ImportError:
+		return float('nan')
+
+
+class PipelineBenchmark:
+	"""
+	Replays the lines of a watch stream through the same path as the server:
+	decoding -> `KubernetesPodListSupervisor` -> ordering -> serialization.
+	The supervisor does not coalesce events and does not start utilization monitors,
+	utilization reports are injected between events instead.
+
+	Pipelines:
+		incremental - `FairnessQueue` and `StateRevisionLog`, as used by the web server
+		full - `pods_calculate_order` and `build_json_response` on every change
+
+	Decodings (`KubernetesPodListMonitor.WATCH_DECODINGS`):
+		raw - `KubernetesPodListMonitor.process_raw_event`
+		model - `kube.watch.Watch.unmarshal_event` into `V1Pod`, then `KubernetesPodListMonitor.process_event`
+	"""
+
+	PIPELINES = ['incremental', 'full']
+	STAGES = ['supervisor', 'order', 'serialize']
+
+	def __init__(self, namespace='bench', pipeline='incremental', decoding='raw', utilization_ratio=0.3, seed=0):
+		self.rng = random.Random(seed)
+		self.utilization_ratio = utilization_ratio
+
+		if pipeline == 'incremental':
+			self.order = FairnessQueue().update
+			self.serialize = StateRevisionLog().update
+		elif pipeline == 'full':
+			self.order = pods_calculate_order
+			self.serialize = build_json_response
+		else:
+			raise ValueError(f'Unknown pipeline {pipeline}, expected one of {self.PIPELINES}')
+
+		self.supervisor = KubernetesPodListSupervisor(
+			namespaces = [namespace],
+			coalesce_window = 0,
+			measure_utilization = False,
+		)
+		self.supervisor.add_listener(self.on_state_change)
+
+		self.kube_listener = KubernetesPodListMonitor(namespace = namespace, decoding = decoding)
+		self.kube_listener.callback = self.supervisor.on_kubernetes_pod_event
+		# for the model decoding, `replay_in_loop` creates it as its client needs an event loop
+		self.watch = None
+
+		self.stage_durations = {stage: [] for stage in self.STAGES}
+		self.listener_duration = 0
+
+	def on_state_change(self, pod_list):
+		t0 = time.perf_counter()
+		pod_hierarchy = self.order(pod_list)
+		t1 = time.perf_counter()
+		self.serialize(pod_hierarchy)
+		t2 = time.perf_counter()
+
+		self.stage_durations['order'].append(t1 - t0)
+		self.stage_durations['serialize'].append(t2 - t1)
+		self.listener_duration += t2 - t0
+
+	def random_utilization_report(self):
+		"""
+		Returns (pod_data, report) for a random running pod, or None
+		"""
+		running = [pd for pd in self.supervisor.pod_data_by_key.values() if pd.data_pub.status == 'Running']
+		if running:
+			return self.rng.choice(running), dict(
+				memory = round(self.rng.random(), 2),
+				compute = round(self.rng.random(), 2),
+				date = datetime.now(),
+			)
+
+	def run_step(self, func, *args):
+		self.listener_duration = 0
+		t0 = time.perf_counter()
+		func(*args)
+		duration = time.perf_counter() - t0
+		self.stage_durations['supervisor'].append(duration - self.listener_duration)
+		return duration
+
+	def process_line(self, line):
+		if self.kube_listener.decoding == 'raw':
+			self.kube_listener.process_raw_event(line)
+		else:
+			self.kube_listener.process_event(self.watch.unmarshal_event(line, 'V1Pod'))
+
+	def replay(self, lines):
+		"""
+		lines - of the watch stream
+		Returns (number of steps, total duration)
+		"""
+		num_steps = 0
+		total_duration = 0
+
+		for line in lines:
+			total_duration += self.run_step(self.process_line, line)
+			num_steps += 1
+
+			utilization = self.random_utilization_report() if self.rng.random() < self.utilization_ratio else None
+			if utilization is not None:
+				pod_data, report = utilization
+				total_duration += self.run_step(pod_data.update_utilization, report)
+				num_steps += 1
+
+		return num_steps, total_duration
+
+	async def replay_in_loop(self, lines):
+		async with kube.watch.Watch() as watch:
+			self.watch = watch
+			return self.replay(lines)
+
+	def report(self, num_steps, total_duration):
+		lines = [
+			f'{num_steps} events in {total_duration:.2f}s = {num_steps / total_duration:.0f} events/s',
+			f'pods stored: {self.supervisor.pod_data_by_key.__len__()}',
+			f'watch events: {dict(self.supervisor.event_counts)}',
+		]
+		for stage in self.STAGES:
+			lines.append(f'	{stage:<10} {percentiles_text(self.stage_durations[stage])}')
+		return '\n'.join(lines)
+
+
+def run_benchmark(num_pods, num_events, num_users, pipeline, decoding, utilization_ratio, seed, trace_memory):
+	from .synthetic import SyntheticPodGenerator
+
+	generator = SyntheticPodGenerator(num_users=num_users, seed=seed)
+	lines = generator.watch_event_lines(num_pods=num_pods, num_events=num_events)
+
+	bench = PipelineBenchmark(pipeline=pipeline, decoding=decoding, utilization_ratio=utilization_ratio, seed=seed)
+
+	# per-event debug logs would dominate the measurement
+	logging.getLogger('kube_watchdog').setLevel(logging.WARNING)
+
+	# tracemalloc slows down allocation heavily, so it is optional, and it is not available on PyPy
+	if trace_memory:
+		tracemalloc.start()
+
+	num_steps, total_duration = asyncio.run(bench.replay_in_loop(lines))
+
+	out = [f'pipeline: {pipeline}, decoding: {decoding}', bench.report(num_steps, total_duration)]
+
+	if trace_memory:
+		mem_current, mem_peak = tracemalloc.get_traced_memory()
+		tracemalloc.stop()
+		out.append(f'memory traced: current {mem_current / 2**20:.1f} MiB, peak {mem_peak / 2**20:.1f} MiB allocated during the replay')
+
+	out.append(f'max RSS: {max_rss_mb():.1f} MiB')
+	
+	return '\n'.join(out)
@@ -0,0 +1,203 @@
+
+import json
+import random
+from dataclasses import dataclass, replace
+from datetime import datetime, timedelta, timezone
+import kubernetes_asyncio as kube
+from ..pod_json import sanitize_model
+
+@dataclass
+class SyntheticPodState:
+	""" The few fields from which a synthetic V1Pod is built """
+	name: str
+	namespace: str
+	uid: str
+	user: str
+	priority: str
+	num_gpu: int
+	phase: str
+	node: str
+	date_created: datetime
+	date_started: datetime
+	resource_version: int
+	# changed by no-op modifications, like the status heartbeats of a real cluster
+	heartbeat: int = 0
+
+
+class SyntheticPodGenerator:
+	"""
+	Generates `V1Pod` objects and watch events resembling a lab namespace:
+	users with several jobs, priority labels (including the `0-p` negative form), 
+	CPU and multi-GPU pods, pending and running containers.
+	"""
+
+	NUM_GPU_CHOICES = [0, 1, 1, 1, 1, 2, 2, 4]
+	PRIORITY_CHOICES = ['0', '0', '0', '1', '2', '0-1', None]
+	PHASE_CHOICES = ['Running', 'Running', 'Running', 'Running', 'Pending']
+
+	def __init__(self, num_users=40, namespace='bench', num_nodes=16, seed=0):
+		self.rng = random.Random(seed)
+		self.namespace = namespace
+		# None is a pod without the user label
+		self.users = [None] + [f'user{i:03d}' for i in range(num_users)]
+		self.nodes = [f'gpu-node-{i:02d}' for i in range(num_nodes)]
+
+		self.date_base = datetime(2019, 10, 1, tzinfo=timezone.utc)
+		self.resource_version = 1000
+		self.name_counter = 0
+		self.pods = {}
+
+	def next_resource_version(self):
+		self.resource_version += 1
+		return self.resource_version
+
+	def new_pod_state(self):
+		self.name_counter += 1
+		user = self.rng.choice(self.users)
+		date_created = self.date_base + timedelta(seconds=self.rng.randrange(7*24*3600))
+		phase = self.rng.choice(self.PHASE_CHOICES)
+
+		return SyntheticPodState(
+			name = f'{user or "anon"}-job-{self.name_counter:06d}',
+			namespace = self.namespace,
+			uid = f'00000000-0000-4000-8000-{self.name_counter:012d}',
+			user = user,
+			priority = self.rng.choice(self.PRIORITY_CHOICES),
+			num_gpu = self.rng.choice(self.NUM_GPU_CHOICES),
+			phase = phase,
+			node = self.rng.choice(self.nodes) if phase == 'Running' else None,
+			date_created = date_created,
+			date_started = date_created + timedelta(seconds=self.rng.randrange(600)) if phase == 'Running' else None,
+			resource_version = self.next_resource_version(),
+		)
+
+	def modified_pod_state(self, state):
+		"""
+		Most modifications do not change anything we publish (status heartbeats),
+		some change the phase or the priority label.
+		"""
+		kind = self.rng.random()
+
+		if kind < 0.1 and state.phase == 'Pending':
+			change = dict(
+				phase = 'Running', 
+				node = self.rng.choice(self.nodes),
+				date_started = state.date_created + timedelta(seconds=self.rng.randrange(600)),
+			)
+		elif kind < 0.2:
+			change = dict(priority = self.rng.choice(self.PRIORITY_CHOICES))
+		else:
+			change = dict(heartbeat = state.heartbeat + 1)
+
+		return replace(state, resource_version=self.next_resource_version(), **change)
+
+	@staticmethod
+	def build_pod(state : SyntheticPodState) -> kube.client.V1Pod:
+		labels = {'app': 'experiment'}
+		if state.user is not None:
+			labels['user'] = state.user
+		if state.priority is not None:
+			labels['priority'] = state.priority
+
+		limits = {'cpu': '4', 'memory': '16Gi'}
+		if state.num_gpu:
+			limits['nvidia.com/gpu'] = str(state.num_gpu)
+
+		if state.date_started is not None:
+			container_state = kube.client.V1ContainerState(
+				running = kube.client.V1ContainerStateRunning(started_at=state.date_started),
+			)
+		else:
+			container_state = kube.client.V1ContainerState(
+				waiting = kube.client.V1ContainerStateWaiting(reason='ContainerCreating'),
+			)
+
+		return kube.client.V1Pod(
+			api_version = 'v1',
+			kind = 'Pod',
+			metadata = kube.client.V1ObjectMeta(
+				name = state.name,
+				namespace = state.namespace,
+				uid = state.uid,
+				labels = labels,
+				annotations = {'heartbeat': str(state.heartbeat)},
+				creation_timestamp = state.date_created,
+				resource_version = str(state.resource_version),
+			),
+			spec = kube.client.V1PodSpec(
+				node_name = state.node,
+				restart_policy = 'Never',
+				containers = [
+					kube.client.V1Container(
+						name = 'main',
+						image = 'ic-registry.epfl.ch/cvlab/pytorch:latest',
+						command = ['python', 'train.py'],
+						resources = kube.client.V1ResourceRequirements(limits=limits, requests=limits),
+					),
+				],
+			),
+			status = kube.client.V1PodStatus(
+				phase = state.phase,
+				host_ip = '10.0.0.1',
+				start_time = state.date_created,
+				container_statuses = [
+					kube.client.V1ContainerStatus(
+						name = 'main',
+						image = 'ic-registry.epfl.ch/cvlab/pytorch:latest',
+						image_id = 'docker-pullable://ic-registry.epfl.ch/cvlab/pytorch@sha256:0',
+						ready = state.phase == 'Running',
+						restart_count = 0,
+						state = container_state,
+					),
+				],
+			),
+		)
+
+	def initial_pods(self, num_pods):
+		""" Creates `num_pods` pods, returns their states """
+		for i in range(num_pods):
+			state = self.new_pod_state()
+			self.pods[state.name] = state
+		return list(self.pods.values())
+
+	def event_states(self, num_events, p_added=0.05, p_deleted=0.05):
+		"""
+		Random sequence of (event_type, SyntheticPodState) applied to the current pods
+		"""
+		for i in range(num_events):
+			kind = self.rng.random()
+
+			if kind < p_added or not self.pods:
+				state = self.new_pod_state()
+				self.pods[state.name] = state
+				yield ('ADDED', state)
+
+			elif kind < p_added + p_deleted:
+				state = self.pods.pop(self.rng.choice(list(self.pods.keys())))
+				yield ('DELETED', replace(state, resource_version=self.next_resource_version()))
+
+			else:
+				name = self.rng.choice(list(self.pods.keys()))
+				state = self.modified_pod_state(self.pods[name])
+				self.pods[name] = state
+				yield ('MODIFIED', state)
+
+	def watch_events(self, num_pods, num_events, **event_kwargs):
+		"""
+		Events as produced by `kube.watch.Watch.stream`: 
+		ADDED for each of `num_pods` initial pods, then `num_events` random changes.
+		"""
+		events = [('ADDED', state) for state in self.initial_pods(num_pods)]
+		events += list(self.event_states(num_events, **event_kwargs))
+
+		return [
+			dict(type = ev_type, object = self.build_pod(state))
+			for (ev_type, state) in events
+		]
+
+	def watch_event_lines(self, num_pods, num_events, **event_kwargs):
+		""" The events of `watch_events` as the lines of the watch stream """
+		return [
+			json.dumps(dict(type = event['type'], object = sanitize_model(event['object']))).encode('utf8') + b'\n'
+			for event in self.watch_events(num_pods, num_events, **event_kwargs)
+		]
@@ -2,30 +2,41 @@
 import asyncio
 import click
 import logging
-from .monitor import KubernetesPodListSupervisor
-from .fairness import pods_calculate_order
+from .monitor import KubernetesPodListSupervisor, namespaces_from_options
+from .fairness import FairnessQueuesByNamespace
 
 log = logging.getLogger(__name__)
 
 
 @click.command('console')
-@click.option('--namespace', type=str, help="Kubernetes namespace to monitor")
+@click.option('--namespace', type=str, multiple=True, help="Kubernetes namespace to monitor, can be repeated")
+@click.option('--all-namespaces', is_flag=True, help="Monitor all namespaces in the cluster")
+@click.option('--label-selector', type=str, default=None, help="Only monitor pods matching this selector, for example lab=cvlab")
 @click.option('--config', type=click.Path(exists=True, file_okay=True, dir_okay=False), help="Config file path", default=None)
-def main(namespace, config):
+@click.option('--coalesce-window', type=float, default=KubernetesPodListSupervisor.COALESCE_WINDOW, help="Changes within this many seconds are processed together, 0 to disable")
+def main(namespace, all_namespaces, label_selector, config, coalesce_window):
 	"""
 	Display the queue in console.
 	"""
 
 	monitor = KubernetesPodListSupervisor(
-		namespace = namespace,
+		namespaces = namespaces_from_options(namespace, all_namespaces),
+		label_selector = label_selector,
 		config_file = config,
+		coalesce_window = coalesce_window,
 	)
 
+	fairness_queue = FairnessQueuesByNamespace()
+
 	def on_kube_state_change(event):
-		pod_hierarchy = pods_calculate_order(monitor.get_pods())
+		pod_hierarchy = fairness_queue.update(monitor.get_pods())
 
-		out_lines = [f'\n{"q":<5} {"name":30} {"user":<10} {"prio":<5} {"uo":<5} {"gpu":5}']
+		out_lines = []
+		prev_namespace = None
 		for p in pod_hierarchy:
+			if not out_lines or p.namespace != prev_namespace:
+				out_lines.append(f'\n[{p.namespace}]\n{"q":<5} {"name":30} {"user":<10} {"prio":<5} {"uo":<5} {"gpu":5}')
+				prev_namespace = p.namespace
 			prio = p.user_priority if p.user_priority != 0 else 'auto'
 			user = p.user or '<anonym>'
 			out_lines.append(f'{p.global_ordinal:<5} {p.name:30} {user:<10} {prio:5} {p.user_ordinal:5} {p.num_gpu:5}')
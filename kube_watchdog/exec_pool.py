@@ -0,0 +1,179 @@
+
+import asyncio
+import logging
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+import aiohttp
+import kubernetes_asyncio as kube
+from .metrics import Histogram
+
+log = logging.getLogger(__name__)
+
+
+class ExecClient:
+	""" One websocket API client of `ExecClientPool` """
+
+	def __init__(self, client_id, max_connections, heartbeat=None):
+		configuration = kube.client.Configuration.get_default_copy()
+		# the aiohttp connector limit of the client
+		configuration.connection_pool_maxsize = max_connections
+
+		self.client_id = client_id
+		self.api_client = kube.stream.WsApiClient(configuration=configuration, heartbeat=heartbeat)
+		self.api = kube.client.CoreV1Api(api_client=self.api_client)
+		self.num_in_use = 0
+		self.num_connection_errors = 0 # consecutive
+		self.retired = False
+
+	@property
+	def is_closed(self):
+		return self.api_client.rest_client.pool_manager.closed
+
+	async def close(self):
+		await self.api_client.close()
+
+
+class ExecClientPool:
+	"""
+	Websocket API clients for `exec` into pods.
+	The execs are spread over `num_clients` clients with at most `max_connections` connections in total.
+
+	A client whose session got closed, or whose last `MAX_CONNECTION_ERRORS` execs failed to connect,
+	is retired: new execs go to a fresh client and the old one is closed once its running execs finish.
+	Errors reported by the API server (such as a missing pod) do not count, only connection failures;
+	neither does a command which runs too long, the connection of its client was working.
+	"""
+
+	MAX_CONNECTION_ERRORS = 3
+	# number of recent exec durations kept for the latency statistics
+	LATENCY_WINDOW = 256
+	# interval of the websocket pings [s]
+	HEARTBEAT = 30
+
+	def __init__(self, num_clients=2, max_connections=16, heartbeat=HEARTBEAT):
+		"""
+		heartbeat - interval [s] of websocket pings which keep long execs alive through proxies, None to disable
+		"""
+		self.num_clients = num_clients
+		self.max_connections_per_client = max(1, max_connections // num_clients)
+		self.max_connections = self.max_connections_per_client * num_clients
+		self.heartbeat = heartbeat
+
+		self.clients = []
+		self.next_client_id = 0
+		self.round_robin = 0
+		self.closed = False
+
+		# statistics
+		self.num_execs = 0
+		self.num_errors = 0
+		self.num_clients_replaced = 0
+		self.max_in_use = 0
+		self.latencies = deque(maxlen=self.LATENCY_WINDOW)
+		self.exec_duration = Histogram(
+			'watchdog_exec_duration_seconds', 'Duration of execs through the pool by result: ok, connection_error, timeout, error',
+			label_names = ['result'],
+		)
+
+	@property
+	def num_in_use(self):
+		return sum(c.num_in_use for c in self.clients)
+
+	def new_client(self):
+		client = ExecClient(self.next_client_id, self.max_connections_per_client, heartbeat=self.heartbeat)
+		self.next_client_id += 1
+		return client
+
+	def pick_client(self) -> ExecClient:
+		for client in list(self.clients):
+			if not client.retired and client.is_closed:
+				self.retire(client)
+
+		active = [c for c in self.clients if not c.retired]
+		while len(active) < self.num_clients:
+			client = self.new_client()
+			self.clients.append(client)
+			active.append(client)
+
+		self.round_robin = (self.round_robin + 1) % len(active)
+		return active[self.round_robin]
+
+	def retire(self, client):
+		log.warning(f'Exec client {client.client_id} retired, session closed or {client.num_connection_errors} connection errors')
+		client.retired = True
+		self.num_clients_replaced += 1
+		self.close_if_unused(client)
+
+	def close_if_unused(self, client):
+		if client.retired and client.num_in_use == 0 and client in self.clients:
+			self.clients.remove(client)
+			asyncio.get_event_loop().create_task(client.close())
+
+	@asynccontextmanager
+	async def client(self):
+		"""
+		`async with pool.client() as api:` gives a `CoreV1Api` for one exec
+		"""
+		if self.closed:
+			raise RuntimeError('ExecClientPool is closed')
+
+		client = self.pick_client()
+		client.num_in_use += 1
+		self.max_in_use = max(self.max_in_use, self.num_in_use)
+		t_start = time.monotonic()
+		result = 'ok'
+
+		try:
+			yield client.api
+			client.num_connection_errors = 0
+
+		except aiohttp.ClientConnectionError:
+			# transport failures, including aiohttp's connection timeouts
+			result = 'connection_error'
+			self.num_errors += 1
+			client.num_connection_errors += 1
+			if client.num_connection_errors >= self.MAX_CONNECTION_ERRORS and not client.retired:
+				self.retire(client)
+			raise
+
+		except asyncio.TimeoutError:
+			# the command was slow, such as a stuck nvidia-smi, the connection worked
+			result = 'timeout'
+			self.num_errors += 1
+			client.num_connection_errors = 0
+			raise
+
+		except Exception:
+			# including errors reported by the server, the connection is fine
+			result = 'error'
+			self.num_errors += 1
+			raise
+
+		finally:
+			duration = time.monotonic() - t_start
+			self.num_execs += 1
+			self.latencies.append(duration)
+			self.exec_duration.observe(duration, (result,))
+			client.num_in_use -= 1
+			self.close_if_unused(client)
+
+	def stats(self) -> dict:
+		latencies = sorted(self.latencies)
+		return dict(
+			clients = len(self.clients),
+			in_use = self.num_in_use,
+			max_in_use = self.max_in_use,
+			execs = self.num_execs,
+			errors = self.num_errors,
+			clients_replaced = self.num_clients_replaced,
+			latency_p50 = latencies[len(latencies) // 2] if latencies else None,
+			latency_max = latencies[-1] if latencies else None,
+		)
+
+	async def close(self):
+		self.closed = True
+		clients = self.clients
+		self.clients = []
+		await asyncio.gather(*(c.close() for c in clients), return_exceptions=True)
+		log.info(f'Exec client pool closed, {self.stats()}')
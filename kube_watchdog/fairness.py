@@ -1,27 +1,22 @@
 import logging
-from operator import itemgetter
-from copy import copy
+from operator import itemgetter, attrgetter
+from bisect import bisect_left, insort
 import sys
-import functools
 
 log = logging.getLogger(__name__)
 
-@functools.total_ordering
-class LowerIsBetter:
-	def __init__(self, value):
-		self.value = value
+def date_sort_value(date):
+	return date.timestamp() if date is not None else 0.
 
-	def __eq__(self, other):
-		return self.value < other.value
-
-	def __lt__(self, other):
-		# (not (a < b)) means a >= b
-		return self.value >= other.value
 
+# The keys below are tuples of bools and numbers which are compared natively.
+# The last criterion, name (lower is better), can not be negated, 
+# so the lists are sorted by name first and we rely on the stability of `list.sort`,
+# which is preserved with reverse=True.
 
 def sorting_key_within_user(pod_info):
 	"""
-	Higher key is higher priority
+	Higher key is higher priority, ties broken by name
 	"""	
 	return (
 		# is cpu: CPU job is free, always before GPU job
@@ -29,15 +24,13 @@ def sorting_key_within_user(pod_info):
 		# user priority: # User-set priority, the higher the better
 		pod_info.user_priority, 
 		# date: older is better
-		LowerIsBetter(pod_info.date_started), 
-		# Break tie by name
-		LowerIsBetter(pod_info.name),
+		- date_sort_value(pod_info.date_started), 
 	)
 
 
 def sorting_key_all_users_together(pod_info):
 	"""
-	Higher key is higher priority
+	Higher key is higher priority, ties broken by name
 	"""
 
 	return (
@@ -49,9 +42,7 @@ def sorting_key_all_users_together(pod_info):
 		# position within users queue: lower is better th
 		- pod_info.user_ordinal, 
 		# date: newer is better
-		pod_info.date_started, 
-		# Break tie by name
-		LowerIsBetter(pod_info.name),
+		date_sort_value(pod_info.date_started), 
 	)
 
 
@@ -60,6 +51,7 @@ def pods_calc_user_queue(pods_of_user : list):
 	Assigns the `user_ordinal` to each pod which has a user
 	"""
 
+	pods_of_user.sort(key=attrgetter('name'))
 	pods_of_user.sort(key=sorting_key_within_user, reverse=True)
 	
 	gpu_accumulation = 0
@@ -72,13 +64,16 @@ def pods_calc_user_queue(pods_of_user : list):
 
 
 def pods_calculate_order(pod_infos):
+	"""
+	The ordinals are written into the given pod objects, the result holds the same objects.
+	"""
 	# only running pods
 	pod_infos = [p for p in pod_infos if p.status == 'Running']
 
 	# users' queues
 	pods_by_user = {}
 	for pod in pod_infos:
-		pods_by_user.setdefault(pod.user, []).append(copy(pod))
+		pods_by_user.setdefault(pod.user, []).append(pod)
 
 	pods_all = []
 	for user, pods in pods_by_user.items():
@@ -96,6 +91,7 @@ def pods_calculate_order(pod_infos):
 		pods_all += pods
 
 	# global order		
+	pods_all.sort(key=attrgetter('name'))
 	pods_all.sort(key=sorting_key_all_users_together, reverse=True)
 		
 	# global ordinal
@@ -113,4 +109,225 @@ def pods_calculate_order(pod_infos):
 	# 	'{name} {user} {user_score} [{num_gpu} gpus]'.format(**p)
 	# 	for p in pods_all
 	# ))
-	
+
+
+def queue_key_within_user(pod_info):
+	"""
+	Lower key is higher priority, same order as `sorting_key_within_user`
+	"""
+	return (
+		pod_info.num_gpu != 0,
+		- pod_info.user_priority,
+		date_sort_value(pod_info.date_started),
+		pod_info.name,
+	)
+
+
+def queue_key_all_users_together(pod_info):
+	"""
+	Lower key is higher priority, same order as `sorting_key_all_users_together`
+	"""
+	return (
+		pod_info.num_gpu != 0,
+		pod_info.user is None,
+		pod_info.user_ordinal,
+		- date_sort_value(pod_info.date_started),
+		pod_info.name,
+	)
+
+
+def order_fingerprint(pod_info):
+	"""
+	The fields which influence the queue order, utilization is not among them
+	"""
+	return (
+		pod_info.status,
+		pod_info.user,
+		pod_info.num_gpu,
+		pod_info.user_priority,
+		pod_info.date_started,
+	)
+
+
+class FairnessQueue:
+	"""
+	Incremental equivalent of `pods_calculate_order`.
+	The users' queues and the global queue are kept sorted between updates,
+	adding, removing or changing a pod only recalculates its owner's queue
+	and the global ordinals after the first position which moved.
+	Utilization changes do not cause any reordering.
+
+	The ordinals are written into the received pod objects, which are not copied.
+	"""
+
+	def __init__(self):
+		# object received in the last update, the supervisor replaces it when the pod's description changes
+		self.pods_by_name = {}
+		self.fingerprint_by_name = {}
+
+		# user -> sorted list of (queue_key_within_user, name)
+		self.user_queues = {}
+		self.user_key_by_name = {}
+
+		# sorted list of (queue_key_all_users_together, name)
+		self.global_queue = []
+		self.global_key_by_name = {}
+
+		self.pod_hierarchy = []
+
+	def update(self, pod_infos):
+		"""
+		Synchronize with the current list of pods, returns the ordered list of running pods.
+		"""
+		running = {p.name: p for p in pod_infos if p.status == 'Running'}
+
+		dirty_users = set()
+		global_dirty_from = len(self.global_queue)
+		hierarchy_stale = False
+
+		for name in [n for n in self.pods_by_name if n not in running]:
+			global_dirty_from = min(global_dirty_from, self.remove(name, dirty_users))
+
+		for name, pod in running.items():
+			source = self.pods_by_name.get(name)
+
+			if source is pod:
+				# same object: only the utilization could have been changed in-place
+				continue
+
+			fingerprint = order_fingerprint(pod)
+			if source is not None and self.fingerprint_by_name[name] == fingerprint:
+				# new description, but nothing relevant for the order
+				self.replace(pod)
+				hierarchy_stale = True
+				continue
+
+			if source is not None:
+				global_dirty_from = min(global_dirty_from, self.remove(name, dirty_users))
+			
+			global_dirty_from = min(global_dirty_from, self.insert(pod, fingerprint, dirty_users))
+
+		for user in dirty_users:
+			global_dirty_from = min(global_dirty_from, self.recalc_user_queue(user))
+
+		if hierarchy_stale or global_dirty_from < len(self.global_queue) or len(self.pod_hierarchy) != len(self.global_queue):
+			self.recalc_global_ordinals(global_dirty_from)
+
+		return self.pod_hierarchy
+
+	def replace(self, pod_info):
+		""" The new object takes over the ordinals of the previous one """
+		prev = self.pods_by_name[pod_info.name]
+		pod_info.user_ordinal = prev.user_ordinal
+		pod_info.global_ordinal = prev.global_ordinal
+		self.pods_by_name[pod_info.name] = pod_info
+
+	def insert(self, pod_info, fingerprint, dirty_users):
+		"""
+		Returns the lowest position in the global queue which has changed.
+		"""
+		name = pod_info.name
+		self.pods_by_name[name] = pod_info
+		self.fingerprint_by_name[name] = fingerprint
+
+		if pod_info.user is not None:
+			# the global position depends on the ordinal within the user's queue
+			key = queue_key_within_user(pod_info)
+			self.user_key_by_name[name] = key
+			insort(self.user_queues.setdefault(pod_info.user, []), (key, name))
+			dirty_users.add(pod_info.user)
+			return len(self.global_queue)
+		else:
+			# unknown users: prefer those with fewer gpus
+			pod_info.user_ordinal = pod_info.num_gpu
+			return self.global_insert(pod_info)
+
+	def remove(self, name, dirty_users):
+		"""
+		Returns the lowest position in the global queue which has changed.
+		"""
+		pod = self.pods_by_name.pop(name)
+		del self.fingerprint_by_name[name]
+
+		if pod.user is not None:
+			queue = self.user_queues[pod.user]
+			del queue[bisect_left(queue, (self.user_key_by_name.pop(name), name))]
+			if not queue:
+				del self.user_queues[pod.user]
+			dirty_users.add(pod.user)
+
+		return self.global_remove(name)
+
+	def global_insert(self, pod_info):
+		key = queue_key_all_users_together(pod_info)
+		entry = (key, pod_info.name)
+		idx = bisect_left(self.global_queue, entry)
+		self.global_queue.insert(idx, entry)
+		self.global_key_by_name[pod_info.name] = key
+		return idx
+
+	def global_remove(self, name):
+		key = self.global_key_by_name.pop(name, None)
+		if key is None:
+			# was waiting for its user's queue to be calculated
+			return len(self.global_queue)
+		idx = bisect_left(self.global_queue, (key, name))
+		del self.global_queue[idx]
+		return idx
+
+	def recalc_user_queue(self, user):
+		"""
+		Assigns the `user_ordinal` to the user's pods and moves those whose ordinal changed in the global queue.
+		Returns the lowest position in the global queue which has changed.
+		"""
+		dirty_from = len(self.global_queue)
+
+		gpu_accumulation = 0
+		for (_, name) in self.user_queues.get(user, []):
+			pod = self.pods_by_name[name]
+			gpu_accumulation += pod.num_gpu
+
+			if pod.user_ordinal != gpu_accumulation or name not in self.global_key_by_name:
+				dirty_from = min(dirty_from, self.global_remove(name))
+				pod.user_ordinal = gpu_accumulation
+				dirty_from = min(dirty_from, self.global_insert(pod))
+
+		return dirty_from
+
+	def recalc_global_ordinals(self, dirty_from):
+		pods = [self.pods_by_name[name] for (_, name) in self.global_queue]
+		
+		gpu_accumulation = pods[dirty_from - 1].global_ordinal if dirty_from > 0 else 0
+		for p in pods[dirty_from:]:
+			gpu_accumulation += p.num_gpu
+			p.global_ordinal = gpu_accumulation
+
+		self.pod_hierarchy = pods
+
+
+class FairnessQueuesByNamespace:
+	"""
+	A separate `FairnessQueue` for each namespace, as the quotas are per namespace.
+	The result is the concatenation of the namespaces' queues, sorted by namespace.
+	"""
+
+	def __init__(self):
+		self.queues = {}
+
+	def update(self, pod_infos):
+		pods_by_namespace = {}
+		for pod in pod_infos:
+			pods_by_namespace.setdefault(pod.namespace, []).append(pod)
+
+		for namespace in [ns for ns in self.queues if ns not in pods_by_namespace]:
+			del self.queues[namespace]
+
+		pod_hierarchy = []
+		for namespace in sorted(pods_by_namespace.keys()):
+			queue = self.queues.get(namespace)
+			if queue is None:
+				queue = self.queues[namespace] = FairnessQueue()
+
+			pod_hierarchy += queue.update(pods_by_namespace[namespace])
+
+		return pod_hierarchy
@@ -1,55 +1,211 @@
 
 import logging
 import asyncio
+import json
 import kubernetes_asyncio as kube
-from typing import Callable
+from typing import Callable, List
+from .pod_json import sanitize_model
 
 log = logging.getLogger(__name__)
 
 class KubernetesPodListMonitor:
+	"""
+	List-then-watch: the pods are listed once, then watched from the resourceVersion of the list.
+	After a disconnect or timeout the watch resumes from the last seen resourceVersion,
+	the full list is only requested again if the server has forgotten that version (410 Gone).
+
+	Pods are delivered in the JSON form of the API (see `pod_json`). Decodings:
+		raw - the list and the watch stream are parsed as JSON directly
+		model - through `kube.watch.Watch` and the client's model objects,
+			several times slower as each event is deserialized into a `V1Pod` tree
+	"""
 
 	POD_EVENTS = {'ADDED', 'MODIFIED', 'DELETED'}
+	WATCH_DECODINGS = ['raw', 'model']
+
+	# the server ends the watch after this time [s], we then resume from the last version
+	WATCH_TIMEOUT = 600
+	# wait after an error [s]
+	RETRY_DELAY = 5
+
+	resource_version : str = None
+
+	def __init__(self, namespace : str = None, label_selector : str = None, config_file = None, api : kube.client.CoreV1Api = None, decoding : str = 'raw'):
+		"""
+		namespace - None to watch all namespaces
+		api - shared API client, if None one is created from `config_file`
+		decoding - one of `WATCH_DECODINGS`
+		"""
+		if decoding not in self.WATCH_DECODINGS:
+			raise ValueError(f'Unknown decoding {decoding}, expected one of {self.WATCH_DECODINGS}')
 
-	def __init__(self, namespace : str, config_file = None):
 		self.namespace = namespace
+		self.label_selector = label_selector
 		self.config_file = config_file
+		self.api = api
+		self.decoding = decoding
+
+	def list_function_and_args(self, api):
+		args = dict(label_selector = self.label_selector) if self.label_selector else {}
 
-	async def listen(self, callback : Callable[[str, str, kube.client.V1Pod], None]):
+		if self.namespace is None:
+			return api.list_pod_for_all_namespaces, args
+		else:
+			return api.list_namespaced_pod, dict(args, namespace=self.namespace)
+
+	async def listen(self, callback : Callable[[str, str, dict], None], reconcile_callback : Callable[[List[dict]], None] = None):
 		"""
-		callback(event_name, pod_name, pod_obj)
+		callback(event_name, pod_name, pod)
+		reconcile_callback(pods) - the full list of existing pods, after the initial list and after 410 Gone.
+			If not provided, each listed pod is passed to `callback` as ADDED.
 		"""
 		self.callback = callback
+		self.reconcile_callback = reconcile_callback
+
+		api = self.api
+		if api is None:
+			await kube.config.load_kube_config(config_file = self.config_file)
+			api = kube.client.CoreV1Api()
 
-		await kube.config.load_kube_config(config_file = self.config_file)
-		api = kube.client.CoreV1Api()
+		list_function, list_args = self.list_function_and_args(api)
+		scope = f'namespace {self.namespace}' if self.namespace else 'all namespaces'
 
 		while True:
 			try:
-				log.info(f'Kubernetes stream listener starting, namespace {self.namespace}')
-				w = kube.watch.Watch()
-				async for event in w.stream(api.list_namespaced_pod, namespace=self.namespace):
-					self.process_event(event)
+				if self.resource_version is None:
+					await self.relist(list_function, list_args)
 
-				log.warning('Kubernetes watch has run out of events, restarting in 5s ...')
+				log.info(f'Kubernetes stream listener starting, {scope}, resource version {self.resource_version}')
+				if self.decoding == 'raw':
+					await self.watch_raw(list_function, list_args)
+				else:
+					await self.watch_models(list_function, list_args)
+
+				log.debug(f'Kubernetes watch timed out, resuming from {self.resource_version}')
+				continue
+
+			except kube.client.exceptions.ApiException as e:
+				if e.status == 410:
+					log.info(f'Resource version {self.resource_version} is too old, listing pods again')
+					self.resource_version = None
+					continue
+
+				log.exception('API error in Kubernetes stream listener, restarting in 5s ...')
 			except Exception as e:
 				log.exception('Exception in Kubernetes stream listener, restarting in 5s ...')
-			
-			await asyncio.sleep(5)
 
-	def process_event(self, event):
+			await asyncio.sleep(self.RETRY_DELAY)
+
+	async def watch_models(self, list_function, list_args):
+		async with kube.watch.Watch() as w:
+			stream = w.stream(
+				list_function,
+				resource_version = self.resource_version,
+				allow_watch_bookmarks = True,
+				timeout_seconds = self.WATCH_TIMEOUT,
+				**list_args,
+			)
+			async for event in stream:
+				self.process_event(event)
+				self.resource_version = w.resource_version or self.resource_version
+
+	async def watch_raw(self, list_function, list_args):
+		response = await list_function(
+			watch = True,
+			resource_version = self.resource_version,
+			allow_watch_bookmarks = True,
+			timeout_seconds = self.WATCH_TIMEOUT,
+			_preload_content = False,
+			**list_args,
+		)
 		try:
-			ev_type = event.get('type', None) 
-			pod_obj = event.get('object', None)
+			await raise_for_status(response)
+
+			# one event per line, the client's read buffer fits the largest objects
+			while True:
+				line = await response.content.readline()
+				if not line:
+					break
+				if line.strip():
+					self.process_raw_event(line)
+		finally:
+			response.release()
+
+	async def relist(self, list_function, list_args):
+		if self.decoding == 'raw':
+			response = await list_function(_preload_content = False, **list_args)
+			await raise_for_status(response)
+			pod_list = json.loads(await response.read())
+			pods = pod_list.get('items') or []
+			resource_version = pod_list['metadata']['resourceVersion']
+		else:
+			pod_list = await list_function(**list_args)
+			pods = [sanitize_model(pod_obj) for pod_obj in pod_list.items]
+			resource_version = pod_list.metadata.resource_version
+
+		log.info(f'Listed {pods.__len__()} pods, resource version {resource_version}')
 
+		if self.reconcile_callback is not None:
+			self.reconcile_callback(pods)
+		else:
+			for pod in pods:
+				self.callback('ADDED', pod['metadata']['name'], pod)
+
+		self.resource_version = resource_version
+
+	def process_raw_event(self, line : bytes):
+		"""
+		One line of the watch stream, `{"type": ..., "object": ...}`.
+		Raises `ApiException` for ERROR events, such as 410 Gone.
+		"""
+		try:
+			event = json.loads(line)
+		except ValueError as e:
+			log.error(f'Malformed line in the watch stream: {e}: {line[:200]}')
+			return
+
+		ev_type = event.get('type', None)
+		obj = event.get('object', None) or {}
+
+		if ev_type == 'ERROR':
+			raise kube.client.exceptions.ApiException(status=obj.get('code'), reason=f'{obj.get("reason")}: {obj.get("message")}')
+
+		self.process_pod_event(ev_type, obj)
+
+		# also for bookmarks, which only advance the resource version
+		self.resource_version = (obj.get('metadata') or {}).get('resourceVersion') or self.resource_version
+
+	def process_event(self, event):
+		""" Event of `kube.watch.Watch`, with the object as a model and the `raw_object` """
+		pod = event.get('raw_object', None)
+		if pod is None:
+			pod = sanitize_model(event.get('object', None))
+
+		self.process_pod_event(event.get('type', None), pod)
+
+	def process_pod_event(self, ev_type, pod):
+		try:
 			if ev_type in self.POD_EVENTS:
-				pod_name = pod_obj.metadata.name
+				pod_name = pod['metadata']['name']
 
 				log.debug(f"Event: {ev_type} {pod_name}")
 
-				self.callback(ev_type, pod_name, pod_obj)
+				self.callback(ev_type, pod_name, pod)
+
+			elif ev_type == 'BOOKMARK':
+				# only advances the resource version
+				pass
 
 			else:
-				log.error(f'Unusual event type from kubectl: {event}')
+				log.error(f'Unusual event type from kubectl: {ev_type} {pod}')
 
 		except Exception as e:
 			log.exception(f'PodListSupervisor: error while processing event')
+
+
+async def raise_for_status(response):
+	""" Requests with `_preload_content=False` do not check the status """
+	if response.status != 200:
+		body = await response.text()
+		response.release()
+		raise kube.client.exceptions.ApiException(status=response.status, reason=f'{response.reason}: {body[:500]}')
@@ -0,0 +1,152 @@
+
+"""
+Minimal metrics in the Prometheus text format, without the client library.
+Updating a metric is a dict lookup and an addition, so they can be used on the event path.
+"""
+
+import asyncio
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from typing import Callable, Iterable, Tuple
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+def escape_label_value(value):
+	return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_labels(label_names, label_values, extra=''):
+	parts = [f'{n}="{escape_label_value(v)}"' for n, v in zip(label_names, label_values)]
+	if extra:
+		parts.append(extra)
+	return '{' + ','.join(parts) + '}' if parts else ''
+
+def format_value(value):
+	if value is None:
+		return 'NaN'
+	if value == float('inf'):
+		return '+Inf'
+	return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric(ABC):
+	metric_type = 'untyped'
+
+	def __init__(self, name, help, label_names=()):
+		self.name = name
+		self.help = help
+		self.label_names = tuple(label_names)
+
+	def header(self):
+		return [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.metric_type}']
+
+	@abstractmethod
+	def render(self):
+		""" Lines of the text format """
+
+
+class Histogram(Metric):
+	metric_type = 'histogram'
+
+	# seconds, from fast in-loop work to nvidia-smi execs
+	DEFAULT_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 15, 20, 30, 60)
+
+	def __init__(self, name, help, buckets=DEFAULT_BUCKETS, label_names=()):
+		super().__init__(name, help, label_names)
+		self.buckets = tuple(buckets)
+		# labels -> [count per bucket (last is +Inf), sum]
+		self.values = {}
+
+	def observe(self, value, labels=()):
+		state = self.values.get(labels)
+		if state is None:
+			state = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.]
+
+		state[0][bisect_left(self.buckets, value)] += 1
+		state[1] += value
+
+	def render(self):
+		lines = self.header()
+		for labels, (counts, total) in self.values.items():
+			cumulative = 0
+			for bound, count in zip(self.buckets + (float('inf'),), counts):
+				cumulative += count
+				le = f'le="{format_value(bound)}"'
+				lines.append(f'{self.name}_bucket{format_labels(self.label_names, labels, le)} {cumulative}')
+			lines.append(f'{self.name}_sum{format_labels(self.label_names, labels)} {format_value(total)}')
+			lines.append(f'{self.name}_count{format_labels(self.label_names, labels)} {cumulative}')
+		return lines
+
+
+class CallbackMetric(Metric):
+	"""
+	A gauge or counter whose values are read at scrape time:
+	`callback()` returns an iterable of (label values tuple, value).
+	"""
+
+	def __init__(self, name, help, callback : Callable[[], Iterable[Tuple[tuple, float]]], metric_type='gauge', label_names=()):
+		super().__init__(name, help, label_names)
+		self.callback = callback
+		self.metric_type = metric_type
+
+	def render(self):
+		lines = self.header()
+		for labels, value in self.callback():
+			lines.append(f'{self.name}{format_labels(self.label_names, labels)} {format_value(value)}')
+		return lines
+
+
+class EventLoopLagMonitor:
+	"""
+	How late the event loop wakes up a sleeping task, 
+	which is the delay seen by every request and callback while the loop is busy.
+	"""
+
+	INTERVAL = 0.1
+	# seconds, from an idle loop to one blocked by a long computation
+	BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5)
+
+	def __init__(self, name, help, interval=INTERVAL):
+		self.interval = interval
+		self.histogram = Histogram(name, help, buckets=self.BUCKETS)
+		self.last_lag = 0.
+		# since the last scrape of `max_lag_metric`
+		self.max_lag = 0.
+
+	def max_lag_metric(self, name, help):
+		""" Gauge of the largest lag since the previous scrape """
+		def read_and_reset():
+			value = self.max_lag
+			self.max_lag = self.last_lag
+			return [((), value)]
+
+		return CallbackMetric(name, help, read_and_reset)
+
+	async def run(self):
+		loop = asyncio.get_running_loop()
+		while True:
+			expected = loop.time() + self.interval
+			await asyncio.sleep(self.interval)
+			lag = max(0., loop.time() - expected)
+
+			self.last_lag = lag
+			self.max_lag = max(self.max_lag, lag)
+			self.histogram.observe(lag)
+
+
+class MetricsRegistry:
+	def __init__(self):
+		self.metrics = []
+
+	def register(self, metric : Metric) -> Metric:
+		self.metrics.append(metric)
+		return metric
+
+	def gauge(self, name, help, callback, label_names=()):
+		""" Shortcut for a `CallbackMetric` gauge """
+		return self.register(CallbackMetric(name, help, callback, label_names=label_names))
+
+	def render(self) -> str:
+		lines = []
+		for metric in self.metrics:
+			lines += metric.render()
+		return '\n'.join(lines) + '\n'
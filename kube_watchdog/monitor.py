@@ -1,57 +1,120 @@
 
 import logging, operator
+import json
+import asyncio, functools
+import click
+from collections import Counter
+from copy import copy
 from dataclasses import dataclass
 from datetime import date, datetime, timezone
 import kubernetes_asyncio as kube
 from typing import Mapping, List
 from .kube_listener import KubernetesPodListMonitor
-from .utilization_monitor import GpuUtilizationMonitor
+from .utilization_monitor import GpuUtilizationScheduler
+from .exec_pool import ExecClientPool
+from .utilization_history import PodUtilizationHistory
+from .snapshot import StateSnapshotFile, utilization_report_to_json, utilization_report_from_json
+from .pod_json import parse_timestamp, encode_pod_json
 
 log = logging.getLogger(__name__)
 
+def pod_key(namespace : str, name : str) -> str:
+	""" Pod names are only unique within a namespace """
+	return f'{namespace}/{name}'
+
+def optional_float(value):
+	return None if value is None else float(value)
+
+def namespaces_from_options(namespaces, all_namespaces):
+	""" The `namespaces` argument of `KubernetesPodListSupervisor` from the `--namespace` and `--all-namespaces` options """
+	if all_namespaces:
+		if namespaces:
+			raise click.UsageError('--namespace and --all-namespaces are mutually exclusive')
+		return None
+
+	if not namespaces:
+		raise click.UsageError('Specify at least one --namespace, or --all-namespaces')
+
+	return list(namespaces)
+
 @dataclass
 class PodInfoToPublish:
-	""" Pod info to be exposed by the server """
+	""" 
+	Pod info to be exposed by the server.
+	Slotted, as there is one per pod: the fields have no class-level defaults, `__init__` sets all of them.
+	"""
+	__slots__ = (
+		'name', 'namespace', 'user', 'status', 'node', 'date_created', 'date_started', 'num_gpu', 
+		'user_priority', 'user_ordinal', 'global_ordinal', 
+		'utilization_mem', 'utilization_compute', 'utilization_date',
+	)
+
 	name: str
+	namespace: str
 	user: str
 	status: str
+	node: str # node the pod is scheduled on, None while pending
 	date_created: datetime
 	date_started: datetime
-	num_gpu: int = 0 # number of GPUs used
+	num_gpu: int # number of GPUs used
 		
-	user_priority: int = 0 # priority specified by the user, the higher the more important, 0 is default
-	user_ordinal: int = 0 # position in owner's queue: is it the 1st, 2nd ... most important job, expressed in number of GPUs
-	global_ordinal: int = 0 # position in global queue expressed in number of GPUs
-
-	utilization_mem: float = None # fraction of GPU memory allocated
-	utilization_compute: float = None # fraction of GPU compute power used
-	utilization_date: datetime = None
-
-	def __init__(self, pod_obj, utilization_report={}):	
-		labels = pod_obj.metadata.labels or {} # if null then use empty dict
-
-		self.name = pod_obj.metadata.name
+	user_priority: int # priority specified by the user, the higher the more important, 0 is default
+	user_ordinal: int # position in owner's queue: is it the 1st, 2nd ... most important job, expressed in number of GPUs
+	global_ordinal: int # position in global queue expressed in number of GPUs
+
+	utilization_mem: float # fraction of GPU memory allocated
+	utilization_compute: float # fraction of GPU compute power used
+	utilization_date: datetime
+
+	def __init__(self, pod : dict, utilization_report={}):	
+		"""
+		pod - in the JSON form of the API, see `pod_json`
+		"""
+		metadata = pod['metadata']
+		labels = metadata.get('labels') or {} # if null then use empty dict
+
+		self.name = metadata['name']
+		self.namespace = metadata['namespace']
 		self.user = labels.get('user', None)
-		self.status = pod_obj.status.phase
+		self.status = (pod.get('status') or {}).get('phase')
+		self.node = (pod.get('spec') or {}).get('nodeName')
 
-		self.num_gpu = self.extract_num_gpu(pod_obj)
+		self.num_gpu = self.extract_num_gpu(pod)
 		
-		self.user_priority = self.extract_priority(pod_obj)
+		self.user_priority = self.extract_priority(pod)
 
-		self.date_created = pod_obj.metadata.creation_timestamp
-		self.date_started = self.extract_started_at(pod_obj) or self.date_created
+		self.date_created = parse_timestamp(metadata.get('creationTimestamp'))
+		self.date_started = self.extract_started_at(pod) or self.date_created
 		# log.debug(f'date started {self.date_started}')
 
+		# set by the fairness ordering
+		self.user_ordinal = 0
+		self.global_ordinal = 0
+
 		self.set_utilization_report(utilization_report)
 	
+	@property
+	def key(self):
+		return pod_key(self.namespace, self.name)
+
 	def set_utilization_report(self, utilization_report : dict):
 		self.utilization_mem = utilization_report.get('memory', None)
 		self.utilization_compute = utilization_report.get('compute', None)
 		self.utilization_date = utilization_report.get('date', None)
 
+	def with_utilization_report(self, utilization_report : dict) -> 'PodInfoToPublish':
+		""" 
+		A copy with the new utilization.
+		The description and utilization of published objects are not modified, as listeners may be reading them outside of the event loop;
+		only the ordinals are written, by the fairness ordering.
+		"""
+		pod_info = copy(self)
+		pod_info.set_utilization_report(utilization_report)
+		return pod_info
+
 	@staticmethod
-	def extract_priority(pod_obj):
-		labels = pod_obj.metadata.labels or {} # if null then use empty dict
+	def extract_priority(pod):
+		labels = pod['metadata'].get('labels') or {} # if null then use empty dict
 		
 		priority_label = labels.get('priority', '0')
 		
@@ -64,96 +127,197 @@ class PodInfoToPublish:
 
 			return int(priority_label)
 		except ValueError:
-			log.info(f'Non-numeric value for labels|priority: {priority_label} in pod {pod_obj.metadata.name}')
+			log.info(f'Non-numeric value for labels|priority: {priority_label} in pod {pod["metadata"]["name"]}')
 			return 0 # default
 	
 	@staticmethod
-	def extract_num_gpu(pod_obj):
+	def extract_num_gpu(pod):
 		num_gpu = 0
-		for container in pod_obj.spec.containers:
-			limits = container.resources.limits
+		for container in pod['spec']['containers']:
+			limits = (container.get('resources') or {}).get('limits')
 			if limits is not None:
 				num_gpu_in_container = limits.get('nvidia.com/gpu', 0)
 				try:
 					num_gpu += int(num_gpu_in_container)
 				except ValueError:
-					log.warning(f'Unexpected value for limits|nvidia.com/gpu: {num_gpu_in_container} in pod {pod_obj.metadata.name}')
+					log.warning(f'Unexpected value for limits|nvidia.com/gpu: {num_gpu_in_container} in pod {pod["metadata"]["name"]}')
 
 		return num_gpu
 					
 	@staticmethod
-	def extract_started_at(pod_obj):
+	def extract_started_at(pod):
 		started_at = None
-		for status in pod_obj.status.container_statuses or []:
-			if status.state.running is not None:
-				started_at = status.state.running.started_at # TODO get earlier date
+		for status in (pod.get('status') or {}).get('containerStatuses') or []:
+			running = (status.get('state') or {}).get('running')
+			if running is not None:
+				started_at = parse_timestamp(running.get('startedAt')) # TODO get earlier date
 		return started_at
 
+	def description_fingerprint(self):
+		""" The published fields which come from the pod description (not from utilization or ordering) """
+		return (
+			self.name, 
+			self.namespace,
+			self.user, 
+			self.status, 
+			self.node,
+			self.date_created, 
+			self.date_started, 
+			self.num_gpu, 
+			self.user_priority,
+		)
+
 	def __repr__(self):
 		return f'pod({self.name}, user={self.user} with priority={self.user_priority}, {self.status}, {self.num_gpu} GPU)'
 
 
 class PodStoredData:
-	""" Pod info kept by the monitor """
+	"""
+	Pod info kept by the monitor.
+	No `V1Pod` object is retained, only the few fields we use and the description as compact JSON bytes,
+	which is decoded on demand for the describe page.
+	"""
+	__slots__ = (
+		'parent', 'name', 'namespace', 'uid', 'resource_version', 'description_raw',
+		'utilization_report', 'utilization_history', 'data_pub', 'is_measuring',
+	)
+
 	name: str
 	parent: 'KubernetesPodListSupervisor'
 
-	description_from_api: kube.client.V1Pod
-	utilization_report: dict = {}
+	description_raw: bytes
+	utilization_report: dict
+	utilization_history: PodUtilizationHistory
 	data_pub: PodInfoToPublish
 	# TODO note time of last change
 
-	utilization_monitor: GpuUtilizationMonitor = None
+	is_measuring: bool
 	
-	def __init__(self, parent : 'KubernetesPodListSupervisor', api_data : kube.client.V1Pod):
+	def __init__(self, parent : 'KubernetesPodListSupervisor', pod : dict, utilization_report : dict = None, description_raw : bytes = None):
+		"""
+		pod - in the JSON form of the API, see `pod_json`
+		utilization_report - the last report, when restored from a snapshot
+		description_raw - encoded `pod` if already available, to avoid encoding it again
+		"""
 		self.parent = parent
-		self.name = api_data.metadata.name
-		self.update_description(api_data)
-		
-
-	def update_description(self, api_data : kube.client.V1Pod):
-		self.description_from_api = api_data
-		self.data_pub = PodInfoToPublish(api_data, self.utilization_report)
+		self.name = pod['metadata']['name']
+		self.namespace = pod['metadata']['namespace']
+		self.utilization_report = utilization_report if utilization_report is not None else {}
+		self.utilization_history = None
+		self.data_pub = None
+		self.is_measuring = False
+		self.update_description(pod, description_raw)
+
+	def update_description(self, pod : dict, description_raw : bytes = None) -> bool:
+		"""
+		Returns False if nothing we publish has changed, in which case the `data_pub` object is kept.
+		"""
+		self.uid = pod['metadata'].get('uid')
+		self.resource_version = pod['metadata'].get('resourceVersion')
+		self.description_raw = description_raw if description_raw is not None else encode_pod_json(pod)
+		data_pub = PodInfoToPublish(pod, self.utilization_report)
+
+		if self.data_pub is not None and self.data_pub.description_fingerprint() == data_pub.description_fingerprint():
+			return False
+
+		self.data_pub = data_pub
 
 		is_running = self.data_pub.status == 'Running'
-		is_measuring = self.utilization_monitor is not None
+		scheduler = self.parent.utilization_scheduler
 
 		# ensure we measure utilization
-		if is_running and (not is_measuring):
-			self.utilization_monitor = GpuUtilizationMonitor(
-				pod_name = self.name,
-				namespace = self.parent.namespace,
+		if is_running and (not self.is_measuring) and scheduler is not None:
+			scheduler.register(
+				self.data_pub.key, self.name, self.namespace, self.update_utilization, 
+				last_measured = self.utilization_report.get('date'),
 			)
-			self.utilization_monitor.start(self.update_utilization)
+			self.is_measuring = True
 
 		# stop utilization measurement if container stops
-		if (not is_running) and is_measuring:
-			self.utilization_monitor.stop()
-			self.utilization_monitor = None
+		if (not is_running) and self.is_measuring:
+			scheduler.unregister(self.data_pub.key)
+			self.is_measuring = False
+
+		return True
 
 	def update_utilization(self, utilization_report : dict):
 		self.utilization_report = utilization_report
-		self.data_pub.set_utilization_report(self.utilization_report)
+
+		gpus = utilization_report.get('gpus')
+		if gpus:
+			if self.utilization_history is None:
+				self.utilization_history = PodUtilizationHistory()
+			self.utilization_history.add_report(utilization_report['date'], gpus)
+
+		self.data_pub = self.data_pub.with_utilization_report(self.utilization_report)
 		self.parent.on_state_change()
 
+	def snapshot(self) -> dict:
+		return dict(
+			description_json = self.description_raw.decode('utf8'),
+			utilization = utilization_report_to_json(self.utilization_report),
+		)
+
 	def on_remove(self):
-		if self.utilization_monitor is not None:
-			self.utilization_monitor.stop()
+		if self.is_measuring:
+			self.parent.utilization_scheduler.unregister(self.data_pub.key)
+			self.is_measuring = False
 
 
 class KubernetesPodListSupervisor:
-	pod_data_by_name : Mapping[str, PodStoredData]
+	"""
+	Keeps the pods of several namespaces, or of the whole cluster, 
+	sharing one API client between the watches.
+	Pods are identified by `pod_key(namespace, name)`.
+	"""
+	pod_data_by_key : Mapping[str, PodStoredData]
 	pod_info_list : List[PodInfoToPublish]
 
-	def __init__(self, namespace, config_file=None):
-		self.namespace = namespace
+	# changes closer than this [s] to each other are delivered to listeners as one
+	COALESCE_WINDOW = 0.15
+	# but a change is not delayed by more than this [s]
+	COALESCE_MAX_DELAY = 1.0
+
+	# the state is written to the snapshot file at most this often [s]
+	SNAPSHOT_INTERVAL = 30
+
+	def __init__(self, namespaces=None, label_selector=None, config_file=None, coalesce_window=COALESCE_WINDOW, coalesce_max_delay=COALESCE_MAX_DELAY, measure_utilization=True, snapshot_path=None, watch_decoding='raw', exec_heartbeat=ExecClientPool.HEARTBEAT):
+		"""
+		namespaces - list of namespaces to watch, None for all namespaces in the cluster (one watch connection)
+		label_selector - only watch pods matching this selector, for example `lab=cvlab`
+		snapshot_path - the state is saved there periodically and restored at startup, None to disable
+		watch_decoding - one of `KubernetesPodListMonitor.WATCH_DECODINGS`
+		exec_heartbeat - interval [s] of the pings on the nvidia-smi exec websockets, None to disable
+		"""
+		self.namespaces = list(namespaces) if namespaces else None
+		self.label_selector = label_selector
+		self.watch_decoding = watch_decoding
 		self.config_file = config_file
-
-		self.pod_data_by_name = {}
+		# one scheduler bounds the number of concurrent nvidia-smi execs for all pods
+		self.utilization_scheduler = GpuUtilizationScheduler(exec_heartbeat=exec_heartbeat) if measure_utilization else None
+		self.coalesce_window = coalesce_window
+		self.coalesce_max_delay = coalesce_max_delay
+		self.snapshot_file = StateSnapshotFile(snapshot_path) if snapshot_path else None
+		self.snapshot_needed = False
+		self.kube_listeners = []
+
+		self.pod_data_by_key = {}
+		# node agents identify pods by UID
+		self.pod_key_by_uid = {}
 		self.pod_info_list = []
 	
 		self.listeners = set()
 
+		# number of watch events by type, and 'suppressed' for modifications which did not change published fields
+		self.event_counts = Counter()
+		# calls of on_state_change, and deliveries to listeners after coalescing
+		self.num_state_changes = 0
+		self.num_publishes = 0
+
+		# loop time of the first change not yet delivered to listeners
+		self.state_change_pending_since = None
+		self.state_change_timer = None
+
 	def get_pods(self) -> List[PodInfoToPublish]:
 		return self.pod_info_list
 
@@ -163,50 +327,272 @@ class KubernetesPodListSupervisor:
 	def remove_listener(self, listener):
 		self.listeners.remove(listener)
 
+	def get_pod_data(self, namespace, name) -> PodStoredData:
+		return self.pod_data_by_key.get(pod_key(namespace, name), None)
+
 	async def run(self):
-		kube_listener = KubernetesPodListMonitor(
-			namespace = self.namespace,
-			config_file = self.config_file,
+		await kube.config.load_kube_config(config_file = self.config_file)
+		api = kube.client.CoreV1Api()
+
+		# None means the whole cluster
+		namespaces = self.namespaces or [None]
+
+		self.kube_listeners = [
+			KubernetesPodListMonitor(
+				namespace = namespace,
+				label_selector = self.label_selector,
+				api = api,
+				decoding = self.watch_decoding,
+			)
+			for namespace in namespaces
+		]
+
+		if self.snapshot_file is not None:
+			self.restore_snapshot()
+
+		tasks = [
+			kube_listener.listen(
+				callback = self.on_kubernetes_pod_event,
+				reconcile_callback = functools.partial(self.on_pod_list, namespace=kube_listener.namespace),
+			)
+			for kube_listener in self.kube_listeners
+		]
+
+		if self.utilization_scheduler is not None:
+			tasks.append(self.utilization_scheduler.run())
+
+		if self.snapshot_file is not None:
+			tasks.append(self.snapshot_loop())
+
+		try:
+			await asyncio.gather(*tasks)
+		finally:
+			if self.utilization_scheduler is not None:
+				await self.utilization_scheduler.close()
+			await api.api_client.close()
+
+	def snapshot_scope(self):
+		""" A snapshot is only valid for the same set of watched pods """
+		return dict(namespaces = self.namespaces, label_selector = self.label_selector)
+
+	def snapshot_state(self) -> dict:
+		return dict(
+			scope = self.snapshot_scope(),
+			resource_versions = {kl.namespace or '': kl.resource_version for kl in self.kube_listeners},
+			pods = [pd.snapshot() for pd in self.pod_data_by_key.values()],
 		)
-		await kube_listener.listen(callback=self.on_kubernetes_pod_event)
 
-	def on_kubernetes_pod_event(self, ev_type, pod_name, pod_obj):
+	def restore_snapshot(self):
+		"""
+		Restore the pods and utilization reports, and resume the watches from the saved resource versions.
+		The watches then deliver what changed since, or relist if the versions are too old.
+		"""
+		state = self.snapshot_file.load()
+		if state is None:
+			return
+
+		if state.get('scope') != self.snapshot_scope():
+			log.info(f'Snapshot is for {state.get("scope")}, not restoring it')
+			return
+
+		for pod_state in state['pods']:
+			try:
+				description_raw = pod_state['description_json'].encode('utf8')
+				pod = json.loads(description_raw)
+				key = pod_key(pod['metadata']['namespace'], pod['metadata']['name'])
+				pod_data = self.pod_data_by_key[key] = PodStoredData(
+					self, pod, 
+					utilization_report = utilization_report_from_json(pod_state['utilization']),
+					description_raw = description_raw,
+				)
+				self.pod_key_by_uid[pod_data.uid] = key
+			except Exception as e:
+				log.exception(f'Failed to restore a pod from the snapshot')
+
+		resource_versions = state.get('resource_versions', {})
+		for kube_listener in self.kube_listeners:
+			kube_listener.resource_version = resource_versions.get(kube_listener.namespace or '')
+
+		log.info(f'Restored {len(self.pod_data_by_key)} pods from snapshot {self.snapshot_file.path}')
+		self.publish_state()
+
+	async def snapshot_loop(self):
+		while True:
+			await asyncio.sleep(self.SNAPSHOT_INTERVAL)
+
+			if not self.snapshot_needed:
+				continue
+			self.snapshot_needed = False
+
+			try:
+				state = self.snapshot_state()
+				# compression and writing outside of the event loop
+				size = await asyncio.get_event_loop().run_in_executor(None, self.snapshot_file.save, state)
+				log.debug(f'Snapshot of {len(state["pods"])} pods written, {size} bytes')
+			except Exception as e:
+				log.exception(f'Failed to write the snapshot {self.snapshot_file.path}')
+
+	def on_kubernetes_pod_event(self, ev_type, pod_name, pod):
+		self.event_counts[ev_type] += 1
+
+		key = pod_key(pod['metadata']['namespace'], pod_name)
+
 		if ev_type == 'MODIFIED' or ev_type == 'ADDED':
-			self.on_pod_update(pod_name, pod_obj)
+			self.on_pod_update(key, pod)
 
 		elif ev_type == 'DELETED':
-			self.on_pod_deleted(pod_name)
-
-	def on_pod_deleted(self, pod_name):
+			self.on_pod_deleted(key)
+
+	def on_pod_list(self, pods, namespace=None):
+		""" 
+		Full list of pods in `namespace` (None for all namespaces), after a (re)connection.
+		Pods which are no longer listed are removed, the unchanged ones are left untouched.
+		"""
+		listed_keys = set()
+
+		for pod in pods:
+			metadata = pod['metadata']
+			key = pod_key(metadata['namespace'], metadata['name'])
+			listed_keys.add(key)
+
+			pod_data = self.pod_data_by_key.get(key, None)
+			if pod_data is not None and pod_data.uid != metadata.get('uid'):
+				# deleted and created again with the same name while we were disconnected
+				self.on_pod_deleted(key)
+				pod_data = None
+
+			if pod_data is None or pod_data.resource_version != metadata.get('resourceVersion'):
+				self.on_pod_update(key, pod)
+
+		for key, pod_data in list(self.pod_data_by_key.items()):
+			if key not in listed_keys and (namespace is None or pod_data.namespace == namespace):
+				self.on_pod_deleted(key)
+
+	def on_pod_deleted(self, key):
 		try:
-			pod_data = self.pod_data_by_name.pop(pod_name, None)
+			pod_data = self.pod_data_by_key.pop(key, None)
 			if pod_data is not None:
+				self.pod_key_by_uid.pop(pod_data.uid, None)
 				pod_data.on_remove()
 
 			self.on_state_change()
 		except Exception as e:
-			log.exception(f'Error in pod deletion, pod object:\n{pod_name}')
+			log.exception(f'Error in pod deletion, pod object:\n{key}')
 
-	def on_pod_update(self, pod_name, pod_obj):
+	def on_pod_update(self, key, pod):
 		""" Pod is created or modified """
 
 		try:
 			# store the api data
-			pod_data = self.pod_data_by_name.get(pod_name, None)
+			pod_data = self.pod_data_by_key.get(key, None)
 			if pod_data is None:
-				self.pod_data_by_name[pod_name] = PodStoredData(self, pod_obj)
-			else:
-				pod_data.update_description(pod_obj)
+				pod_data = self.pod_data_by_key[key] = PodStoredData(self, pod)
+				self.pod_key_by_uid[pod_data.uid] = key
+			elif not pod_data.update_description(pod):
+				# no change in published fields, listeners do not need to know
+				self.event_counts['suppressed'] += 1
+				return
 
 			self.on_state_change()
 
 		except Exception as e:
-			log.exception(f'Error in pod info extraction, pod object:\n{pod_obj}')
+			log.exception(f'Error in pod info extraction, pod object:\n{pod}')
+
+	def on_utilization_reports(self, pod_reports, node=None) -> int:
+		"""
+		Utilization reports pushed by node agents, a list of dicts `{uid, memory, compute, gpus, report_txt}`.
+		node - the reporting node, whose agent reports all pods with a process on a GPU:
+			its running GPU pods missing from the report are not using their GPUs.
+			Without it, the pods not in the report keep their previous report.
+		Returns the number of reports which matched a known pod.
+		"""
+		date = datetime.now()
+		num_matched = 0
+		reported_keys = set()
+
+		for pod_report in pod_reports:
+			key = self.pod_key_by_uid.get(pod_report.get('uid'), None)
+			pod_data = self.pod_data_by_key.get(key, None) if key is not None else None
+			if pod_data is None:
+				continue
+			reported_keys.add(key)
+
+			try:
+				utilization_report = dict(
+					memory = optional_float(pod_report['memory']),
+					compute = optional_float(pod_report['compute']),
+					report_txt = str(pod_report.get('report_txt', '')),
+					# JSON object keys are strings
+					gpus = {
+						int(gpu_index): dict(memory = optional_float(g.get('memory')), compute = optional_float(g.get('compute')))
+						for gpu_index, g in (pod_report.get('gpus') or {}).items()
+					},
+					date = date,
+				)
+			except (KeyError, TypeError, ValueError, AttributeError) as e:
+				log.warning(f'Invalid utilization report for pod {key}: {e}')
+				continue
+
+			pod_data.update_utilization(utilization_report)
+			num_matched += 1
+
+		if node:
+			for key, pod_data in self.pod_data_by_key.items():
+				pod_info = pod_data.data_pub
+				if pod_info.node == node and pod_info.status == 'Running' and pod_info.num_gpu > 0 and key not in reported_keys:
+					pod_data.update_utilization(dict(
+						memory = 0.,
+						compute = 0.,
+						report_txt = f'No process of this pod is using a GPU of node {node}',
+						gpus = {},
+						date = date,
+					))
+
+		return num_matched
 
 	def on_state_change(self):
-		self.pod_info_list = [pd.data_pub for pd in self.pod_data_by_name.values()]
-		self.pod_info_list.sort(key=operator.attrgetter('name'))
+		"""
+		Schedules the listener notification.
+		A burst of changes results in one notification `coalesce_window` after the last change,
+		but at most `coalesce_max_delay` after the first one.
+		"""
+		self.snapshot_needed = True
+		self.num_state_changes += 1
+
+		try:
+			loop = asyncio.get_running_loop()
+		except RuntimeError:
+			loop = None
+
+		# no coalescing requested, or called outside of the event loop
+		if self.coalesce_window <= 0 or loop is None:
+			self.publish_state()
+			return
+
+		now = loop.time()
+		if self.state_change_pending_since is None:
+			self.state_change_pending_since = now
+
+		if self.state_change_timer is not None:
+			self.state_change_timer.cancel()
+
+		deliver_at = min(now + self.coalesce_window, self.state_change_pending_since + self.coalesce_max_delay)
+		self.state_change_timer = loop.call_at(deliver_at, self.publish_state)
+
+	def publish_state(self):
+		""" Rebuild the pod list and notify listeners """
+		if self.state_change_timer is not None:
+			self.state_change_timer.cancel()
+		self.state_change_timer = None
+		self.state_change_pending_since = None
+		self.num_publishes += 1
+
+		self.pod_info_list = [pd.data_pub for pd in self.pod_data_by_key.values()]
+		self.pod_info_list.sort(key=operator.attrgetter('namespace', 'name'))
 
 		for listener in self.listeners:
-			listener(self.pod_info_list)	
+			try:
+				listener(self.pod_info_list)
+			except Exception as e:
+				log.exception(f'Error in state change listener {listener}')	
 
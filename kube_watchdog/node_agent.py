@@ -0,0 +1,184 @@
+
+import asyncio
+import logging
+import os
+import re
+from collections import defaultdict
+from pathlib import Path
+import aiohttp
+import click
+from .utilization_monitor import GPU_QUERY_CMD, GPU_QUERY_MEASUREMENT_TIMEOUT, NvidiaSmiCsvParser
+
+log = logging.getLogger(__name__)
+
+NODE_AGENT_INTERVAL = 30
+
+GPU_UUID_QUERY_CMD = [
+	'/usr/bin/nvidia-smi',
+	'--format=csv,noheader',
+	'--query-gpu=index,uuid',
+]
+
+GPU_APPS_QUERY_CMD = [
+	'/usr/bin/nvidia-smi',
+	'--format=csv,noheader',
+	'--query-compute-apps=gpu_uuid,pid',
+]
+
+# cgroup paths of containers contain the pod UID:
+#	cgroupfs driver: /kubepods/burstable/pod3f1e1d4c-1b2a-4c8e-9f00-6a5b4c3d2e1f/<container>
+#	systemd driver: /kubepods.slice/kubepods-burstable.slice/kubepods-burstable-pod3f1e1d4c_1b2a_4c8e_9f00_6a5b4c3d2e1f.slice/...
+CGROUP_POD_UID_PATTERN = re.compile(r'pod([0-9a-f]{8}[-_][0-9a-f]{4}[-_][0-9a-f]{4}[-_][0-9a-f]{4}[-_][0-9a-f]{12})')
+
+def pod_uid_from_cgroup(cgroup_txt):
+	match = CGROUP_POD_UID_PATTERN.search(cgroup_txt)
+	if match:
+		return match.group(1).replace('_', '-')
+	return None
+
+def pod_uid_of_process(pid, proc_dir='/proc'):
+	try:
+		return pod_uid_from_cgroup((Path(proc_dir) / str(pid) / 'cgroup').read_text())
+	except OSError:
+		# the process has exited
+		return None
+
+def csv_rows(report_txt):
+	for line in report_txt.splitlines():
+		if line.strip():
+			yield [field.strip() for field in line.split(',')]
+
+async def run_command(cmd, timeout):
+	proc = await asyncio.create_subprocess_exec(
+		*cmd,
+		stdout = asyncio.subprocess.PIPE,
+		stderr = asyncio.subprocess.PIPE,
+	)
+	try:
+		stdout, stderr = await asyncio.wait_for(proc.communicate(), timeout=timeout)
+	except asyncio.TimeoutError:
+		proc.kill()
+		raise
+
+	# `timeout` ends the nvidia-smi loop with code 124, the output is still valid
+	if proc.returncode not in (0, 124):
+		raise RuntimeError(f'{cmd[0]} exited with code {proc.returncode}: {stderr.decode("utf8", errors="replace")}')
+
+	return stdout.decode('utf8')
+
+
+class NodeUtilizationAgent:
+	"""
+	Runs on a GPU node (one per node, as a DaemonSet with `hostPID` so that GPU processes are visible)
+	and pushes the utilization of all pods on the node to the watchdog server,
+	instead of the server running `nvidia-smi` inside each pod.
+
+	GPUs are attributed to pods through the processes using them:
+	nvidia-smi lists the process IDs per GPU, the cgroup of each process contains the pod UID.
+	A report lists every pod of the node with a process on a GPU, so the server takes
+	the GPU pods of the node which are missing from it as not using their GPUs.
+	"""
+
+	def __init__(self, server_url, token, node_name=None, interval=NODE_AGENT_INTERVAL, proc_dir='/proc'):
+		"""
+		token - shared with the server, which rejects reports without it
+		"""
+		self.report_url = server_url.rstrip('/') + '/api/utilization'
+		self.token = token
+		self.node_name = node_name
+		self.interval = interval
+		self.proc_dir = proc_dir
+
+	async def gpus_by_pod_uid(self):
+		""" pod UID -> set of GPU indices """
+		index_by_uuid = {
+			uuid: int(index)
+			for (index, uuid) in csv_rows(await run_command(GPU_UUID_QUERY_CMD, timeout=GPU_QUERY_MEASUREMENT_TIMEOUT))
+		}
+
+		gpus = defaultdict(set)
+		for (gpu_uuid, pid) in csv_rows(await run_command(GPU_APPS_QUERY_CMD, timeout=GPU_QUERY_MEASUREMENT_TIMEOUT)):
+			pod_uid = pod_uid_of_process(pid, self.proc_dir)
+			if pod_uid is not None and gpu_uuid in index_by_uuid:
+				gpus[pod_uid].add(index_by_uuid[gpu_uuid])
+
+		return gpus
+
+	async def measure(self):
+		"""
+		Returns a list of pod reports `{uid, memory, compute, gpus, report_txt}`
+		"""
+		gpus_by_pod = await self.gpus_by_pod_uid()
+		if not gpus_by_pod:
+			return []
+
+		report_txt = await run_command(GPU_QUERY_CMD, timeout=GPU_QUERY_MEASUREMENT_TIMEOUT)
+		lines = report_txt.splitlines()
+		header, rows = lines[0], lines[1:]
+
+		parser = NvidiaSmiCsvParser()
+		parser.feed(report_txt)
+		parser.finish()
+
+		pod_reports = []
+		for pod_uid, gpu_indices in gpus_by_pod.items():
+			try:
+				report_parsed = parser.summary(gpu_indices=gpu_indices)
+			except ValueError:
+				# its GPUs only reported unavailable values
+				continue
+
+			# the rows of this pod's GPUs, shown on the pod's page
+			index_texts = {str(i) for i in gpu_indices}
+			pod_rows = [row for row in rows if row.split(',', 1)[0].strip() in index_texts]
+
+			pod_reports.append(dict(
+				uid = pod_uid,
+				memory = report_parsed['memory'],
+				compute = report_parsed['compute'],
+				gpus = report_parsed['gpus'],
+				report_txt = '\n'.join([header] + pod_rows),
+			))
+
+		return pod_reports
+
+	async def run(self):
+		log.info(f'Node agent for {self.node_name} reporting to {self.report_url} every {self.interval}s')
+
+		async with aiohttp.ClientSession(headers={'Authorization': f'Bearer {self.token}'}) as session:
+			while True:
+				try:
+					pod_reports = await self.measure()
+
+					async with session.post(self.report_url, json=dict(node=self.node_name, pods=pod_reports)) as response:
+						response.raise_for_status()
+						result = await response.json()
+
+					log.info(f'Reported {len(pod_reports)} pods, {result.get("pods_matched")} matched by the server')
+				except Exception as e:
+					log.exception(f'Node agent measurement or report failed: {e}')
+
+				await asyncio.sleep(self.interval)
+
+
+@click.command('agent')
+@click.option('--server', type=str, required=True, help="Address of the watchdog server, for example http://kube-watchdog:5336")
+@click.option('--node-name', type=str, default=lambda: os.environ.get('NODE_NAME'), help="Name of this node, by default $NODE_NAME")
+@click.option('--interval', type=float, default=NODE_AGENT_INTERVAL, help="Seconds between reports")
+@click.option('--proc-dir', type=click.Path(exists=True, file_okay=False), default='/proc', help="Host's /proc")
+@click.option('--token-file', type=click.Path(exists=True, dir_okay=False), required=True, help="File with the secret token, the same as the server's --agent-token-file")
+def main(server, node_name, interval, proc_dir, token_file):
+	"""
+	Measure the GPU utilization of the pods on this node and push it to the server.
+	"""
+	if not node_name:
+		raise click.UsageError('The node name is required, with --node-name or $NODE_NAME: the server matches the pods of the node against the report')
+
+	agent = NodeUtilizationAgent(
+		server_url = server,
+		token = Path(token_file).read_text().strip(),
+		node_name = node_name,
+		interval = interval,
+		proc_dir = proc_dir,
+	)
+	asyncio.get_event_loop().run_until_complete(agent.run())
@@ -0,0 +1,47 @@
+
+"""
+Pods in the JSON form of the Kubernetes API (camelCase keys, timestamps as text),
+as delivered by the watch and stored by the supervisor, and the conversion from the model objects.
+"""
+
+import json
+from datetime import datetime, date
+from dateutil.parser import isoparse
+
+def parse_timestamp(text):
+	""" RFC 3339 timestamp of the API, None stays None """
+	if text is None:
+		return None
+
+	# fromisoformat is much faster but only accepts the Z suffix since py3.11
+	if text.endswith('Z'):
+		text = text[:-1] + '+00:00'
+	try:
+		return datetime.fromisoformat(text)
+	except ValueError:
+		return isoparse(text)
+
+def sanitize_model(obj):
+	"""
+	JSON-compatible form of a kubernetes model object,
+	equivalent to `ApiClient.sanitize_for_serialization` but usable without a client.
+	"""
+	if obj is None or isinstance(obj, (str, bool, int, float)):
+		return obj
+	if isinstance(obj, (list, tuple)):
+		return [sanitize_model(item) for item in obj]
+	if isinstance(obj, (datetime, date)):
+		return obj.isoformat()
+	if isinstance(obj, dict):
+		return {key: sanitize_model(value) for key, value in obj.items()}
+
+	return {
+		obj.attribute_map[attr]: sanitize_model(value)
+		for attr in obj.openapi_types
+		for value in (getattr(obj, attr),)
+		if value is not None
+	}
+
+def encode_pod_json(pod : dict) -> bytes:
+	""" Compact JSON of a pod """
+	return json.dumps(pod, separators=(',', ':')).encode('utf8')
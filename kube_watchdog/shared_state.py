@@ -0,0 +1,191 @@
+
+"""
+The published state in a memory-mapped file, written by the collector process and read by the web workers.
+
+Layout: a fixed header followed by the bodies, one after another.
+The header starts with a sequence number which is odd while the writer is changing the file (a seqlock):
+a reader copies the bodies and then checks that the sequence number has not changed meanwhile.
+There is one writer, the readers never block it.
+"""
+
+import mmap
+import os
+import struct
+import tempfile
+import time
+from pathlib import Path
+from typing import Optional
+
+# magic, sequence, revision, boot id, length of each body
+HEADER = struct.Struct('<8sQQ16s4Q')
+HEADER_SIZE = 128
+SEQUENCE = struct.Struct('<Q')
+SEQUENCE_OFFSET = 8
+MAGIC = b'KWDSTATE'
+
+# the bodies stored after the header, in this order
+BODY_NAMES = ('identity', 'gzip', 'br', 'patch')
+
+INITIAL_SIZE = 1 << 20
+
+def shared_memory_dir():
+	""" tmpfs on Linux, so that the file is never written to disk """
+	shm = Path('/dev/shm')
+	return shm if shm.is_dir() else None
+
+def make_state_dir():
+	""" Temporary directory for the state file and the collector's socket """
+	return Path(tempfile.mkdtemp(prefix='kube_watchdog_', dir=shared_memory_dir()))
+
+
+class SharedState:
+	"""
+	One revision read from the shared file.
+	Answers `changes_since_json` like `StateRevisionLog`, but only knows the latest patch:
+	clients further behind get a full snapshot.
+	"""
+
+	def __init__(self, sequence, revision, boot_id, bodies):
+		self.sequence = sequence
+		self.revision = revision
+		self.boot_id = boot_id
+		self.patch_json = bodies.pop('patch').decode('utf8')
+		# encoding -> snapshot body, only the encodings written by the collector
+		self.bodies = {enc: body for enc, body in bodies.items() if body}
+		self.bodies['identity'] = bodies['identity']
+		self.full_json_cache = None
+
+	@property
+	def snapshot_json(self):
+		return self.bodies['identity'].decode('utf8')
+
+	def full_json(self) -> str:
+		if self.full_json_cache is None:
+			self.full_json_cache = f'{{"revision": {self.revision}, "full": true, "pods": {self.snapshot_json}}}'
+		return self.full_json_cache
+
+	def changes_since_json(self, since_revision : Optional[int]) -> str:
+		""" since_revision - None for a revision of a previous start of the collector """
+		if since_revision is None:
+			return self.full_json()
+		if since_revision == self.revision:
+			return f'{{"revision": {self.revision}, "full": false, "changed": [], "removed": [], "order": null}}'
+		if since_revision == self.revision - 1 and self.patch_json:
+			return self.patch_json
+		return self.full_json()
+
+
+class SharedStateWriter:
+
+	def __init__(self, path, boot_id):
+		self.path = Path(path)
+		self.boot_id = boot_id
+		self.sequence = 0
+
+		self.file = open(self.path, 'w+b')
+		self.file.truncate(INITIAL_SIZE)
+		self.mm = mmap.mmap(self.file.fileno(), INITIAL_SIZE)
+
+		self.publish(0, {'identity': b'[]'}, b'')
+
+	def publish(self, revision, bodies, patch : bytes):
+		"""
+		bodies - encoding -> snapshot body, 'identity' is required
+		patch - JSON of the changes from the previous revision
+		"""
+		bodies = dict(bodies, patch=patch)
+		lengths = [len(bodies.get(name, b'')) for name in BODY_NAMES]
+
+		size = HEADER_SIZE + sum(lengths)
+		if size > len(self.mm):
+			# the file only grows, readers remap it when they see a larger state
+			self.mm.resize(max(size, 2 * len(self.mm)))
+
+		self.sequence += 1
+		SEQUENCE.pack_into(self.mm, SEQUENCE_OFFSET, self.sequence)
+
+		offset = HEADER_SIZE
+		for name, length in zip(BODY_NAMES, lengths):
+			if length:
+				self.mm[offset:offset + length] = bodies[name]
+			offset += length
+
+		HEADER.pack_into(self.mm, 0, MAGIC, self.sequence, revision, self.boot_id.encode('ascii'), *lengths)
+		# the even sequence number goes last, after the whole revision is in place
+		self.sequence += 1
+		SEQUENCE.pack_into(self.mm, SEQUENCE_OFFSET, self.sequence)
+
+	def close(self):
+		self.mm.close()
+		self.file.close()
+
+
+class SharedStateReader:
+	"""
+	Reads the state when its sequence number changes, the bodies are copied once per revision.
+	"""
+
+	# a read overlapping with a write keeps the previous state, the new one is read by the next call;
+	# only the first read, with no previous state, waits for the write: this many times, with a doubling delay [s]
+	MAX_ATTEMPTS = 8
+	RETRY_DELAY = 0.001
+
+	def __init__(self, path):
+		self.path = Path(path)
+		self.file = open(self.path, 'rb')
+		self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+		self.state = None
+
+	def current_sequence(self):
+		return SEQUENCE.unpack_from(self.mm, SEQUENCE_OFFSET)[0]
+
+	def read(self) -> SharedState:
+		delay = self.RETRY_DELAY
+
+		for attempt in range(self.MAX_ATTEMPTS):
+			sequence = self.current_sequence()
+			if self.state is not None and sequence == self.state.sequence:
+				break
+
+			state = self.read_state(sequence) if sequence % 2 == 0 else None
+			if state is not None:
+				self.state = state
+				break
+			if self.state is not None:
+				break
+
+			time.sleep(delay)
+			delay *= 2
+
+		if self.state is None:
+			raise RuntimeError(f'Shared state {self.path} could not be read')
+
+		return self.state
+
+	def read_state(self, sequence):
+		magic, _, revision, boot_id, *lengths = HEADER.unpack_from(self.mm, 0)
+		if magic != MAGIC:
+			return None
+
+		size = HEADER_SIZE + sum(lengths)
+		if size > len(self.mm):
+			if size > os.fstat(self.file.fileno()).st_size:
+				# lengths of a write in progress
+				return None
+			self.mm.close()
+			self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+		bodies = {}
+		offset = HEADER_SIZE
+		for name, length in zip(BODY_NAMES, lengths):
+			bodies[name] = self.mm[offset:offset + length]
+			offset += length
+
+		if self.current_sequence() != sequence:
+			return None
+
+		return SharedState(sequence, revision, boot_id.rstrip(b'\0').decode('ascii'), bodies)
+
+	def close(self):
+		self.mm.close()
+		self.file.close()
@@ -0,0 +1,71 @@
+
+import gzip
+import json
+import logging
+import os
+from datetime import datetime
+from pathlib import Path
+
+log = logging.getLogger(__name__)
+
+# 2: pod descriptions stored as JSON text
+SNAPSHOT_FORMAT_VERSION = 2
+
+def utilization_report_to_json(report):
+	""" The serializable part of a utilization report (date as text, GPU indices as keys) """
+	out = {k: report[k] for k in ('memory', 'compute', 'report_txt', 'error') if k in report}
+	if report.get('date') is not None:
+		out['date'] = report['date'].isoformat()
+	if report.get('gpus'):
+		out['gpus'] = {str(idx): g for idx, g in report['gpus'].items()}
+	return out
+
+def utilization_report_from_json(report_json):
+	report = dict(report_json)
+	if report.get('date') is not None:
+		report['date'] = datetime.fromisoformat(report['date'])
+	if report.get('gpus'):
+		report['gpus'] = {int(idx): g for idx, g in report['gpus'].items()}
+	return report
+
+
+class StateSnapshotFile:
+	"""
+	Gzipped JSON file holding the supervisor's state, for a warm restart.
+	Written to a temporary file which then replaces the previous snapshot,
+	so that a crash while writing leaves the previous snapshot intact.
+	"""
+
+	def __init__(self, path):
+		self.path = Path(path)
+
+	def save(self, state : dict):
+		""" Blocking, meant to run in an executor """
+		state = dict(state, version=SNAPSHOT_FORMAT_VERSION)
+		data = gzip.compress(json.dumps(state, separators=(',', ':')).encode('utf8'), compresslevel=3)
+
+		self.path.parent.mkdir(parents=True, exist_ok=True)
+		path_tmp = self.path.with_name(self.path.name + '.tmp')
+		with path_tmp.open('wb') as f_out:
+			f_out.write(data)
+			f_out.flush()
+			os.fsync(f_out.fileno())
+		os.replace(path_tmp, self.path)
+
+		return len(data)
+
+	def load(self) -> dict:
+		""" None if there is no usable snapshot """
+		try:
+			state = json.loads(gzip.decompress(self.path.read_bytes()).decode('utf8'))
+		except FileNotFoundError:
+			return None
+		except Exception as e:
+			log.warning(f'Ignoring unreadable snapshot {self.path}: {e}')
+			return None
+
+		if state.get('version') != SNAPSHOT_FORMAT_VERSION:
+			log.warning(f'Ignoring snapshot {self.path} with format version {state.get("version")}')
+			return None
+
+		return state
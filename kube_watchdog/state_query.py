@@ -0,0 +1,187 @@
+
+"""
+Filtering, sorting and pagination of the published pods, for `api/state?user=...`.
+The `StateIndex` is built with each new ordering, a query only visits the pods of the selected users, statuses or nodes.
+Unlike the state of `api/state`, which lists the running pods, queries cover all pods: `status=Pending` finds the waiting ones.
+"""
+
+from dataclasses import dataclass
+from typing import List, Mapping, Tuple
+from .fairness import date_sort_value
+from .state_revisions import pod_field_values, pod_json_fragment
+from .utilization_monitor import GpuUtilizationScheduler
+
+# fields of `PodInfoToPublish` with an index, query parameter -> field
+INDEXED_FIELDS = {
+	'namespace': 'namespace',
+	'user': 'user',
+	'status': 'status',
+	'node': 'node',
+}
+
+# sort parameter -> key, pods without the value go last (first when descending)
+SORT_KEYS = {
+	'queue': None,
+	'name': lambda p: (p.name,),
+	'user': lambda p: (p.user is None, p.user or ''),
+	'gpus': lambda p: (p.num_gpu,),
+	'started': lambda p: (p.date_started is None, date_sort_value(p.date_started)),
+	'compute': lambda p: (p.utilization_compute is None, p.utilization_compute or 0.),
+	'memory': lambda p: (p.utilization_mem is None, p.utilization_mem or 0.),
+}
+
+QUERY_PARAMETERS = set(INDEXED_FIELDS) | {'min_gpus', 'max_gpus', 'idle', 'sort', 'limit', 'offset'}
+
+def is_pod_idle(pod_info):
+	""" GPUs allocated but not computing, by the last measurement """
+	return (
+		pod_info.num_gpu > 0
+		and pod_info.utilization_compute is not None
+		and pod_info.utilization_compute < GpuUtilizationScheduler.IDLE_THRESHOLD
+	)
+
+def parse_int(query, name, minimum=0):
+	value = query.get(name, None)
+	if value is None:
+		return None
+	try:
+		value = int(value)
+	except ValueError:
+		raise ValueError(f'{name} must be an integer, got {value}')
+	if value < minimum:
+		raise ValueError(f'{name} must be at least {minimum}, got {value}')
+	return value
+
+def parse_flag(query, name):
+	return query.get(name, 'false').lower() in ('', '1', 'true', 'yes')
+
+
+@dataclass
+class StateQuery:
+	# field -> accepted values, for the `INDEXED_FIELDS` given in the query
+	field_values: dict
+	min_gpus: int
+	max_gpus: int
+	idle_only: bool
+	sort: str
+	sort_descending: bool
+	limit: int
+	offset: int
+
+	@staticmethod
+	def is_requested(query) -> bool:
+		""" Any parameter apart from `namespace`, which alone selects a state log """
+		return any(name in query for name in QUERY_PARAMETERS if name != 'namespace')
+
+	@classmethod
+	def from_query(cls, query) -> 'StateQuery':
+		"""
+		query - the request's query parameters, those of `INDEXED_FIELDS` can be repeated
+		Raises ValueError for invalid parameters.
+		"""
+		field_values = {
+			field: set(query.getall(param))
+			for param, field in INDEXED_FIELDS.items()
+			# empty namespace is all namespaces, as for `api/state`
+			if query.get(param, None)
+		}
+
+		sort = query.get('sort', 'queue')
+		sort_descending = sort.startswith('-')
+		sort = sort.lstrip('-')
+		if sort not in SORT_KEYS:
+			raise ValueError(f'sort must be one of {", ".join(SORT_KEYS)}, got {sort}')
+
+		return cls(
+			field_values = field_values,
+			min_gpus = parse_int(query, 'min_gpus'),
+			max_gpus = parse_int(query, 'max_gpus'),
+			idle_only = parse_flag(query, 'idle'),
+			sort = sort,
+			sort_descending = sort_descending,
+			limit = parse_int(query, 'limit'),
+			offset = parse_int(query, 'offset') or 0,
+		)
+
+
+class StateIndex:
+	"""
+	Positions in the pod list by user, status, node and namespace.
+	The list is the queue order of the running pods, followed by the other pods by namespace and name.
+	Built in the recompute together with the ordering, so it always matches a published revision.
+
+	The JSON of the running pods is that of the state log of all namespaces,
+	the other pods are serialized here, only when their object has changed since the `previous` index.
+	"""
+
+	def __init__(self, pod_hierarchy=(), other_pods=(), previous : 'StateIndex' = None):
+		"""
+		pod_hierarchy - the ordered running pods
+		other_pods - the pods which are not running
+		"""
+		self.pods = list(pod_hierarchy) + list(other_pods)
+
+		# key -> (pod object, JSON fragment) for `other_pods`
+		self.other_json = {}
+		previous_json = previous.other_json if previous is not None else {}
+		for pod in other_pods:
+			key = pod.key
+			entry = previous_json.get(key)
+			if entry is None or entry[0] is not pod:
+				entry = (pod, pod_json_fragment(pod_field_values(pod)))
+			self.other_json[key] = entry
+
+		# field -> value -> ascending positions in `pods`
+		self.positions = {field: {} for field in INDEXED_FIELDS.values()}
+
+		for position, pod in enumerate(self.pods):
+			for field, index in self.positions.items():
+				index.setdefault(getattr(pod, field), []).append(position)
+
+	def select_positions(self, field_values) -> List[int]:
+		""" Positions of the pods matching all the indexed fields, in queue order """
+		selected = None
+
+		# the smallest selection first, the other fields only narrow it
+		candidates = sorted(
+			(
+				[pos for value in values for pos in self.positions[field].get(value, ())]
+				for field, values in field_values.items()
+			),
+			key = len,
+		)
+		for positions in candidates:
+			selected = set(positions) if selected is None else selected.intersection(positions)
+
+		if selected is None:
+			return range(len(self.pods))
+		return sorted(selected)
+
+	def pod_json(self, pod_info, published_json : Mapping[str, str]) -> str:
+		"""
+		published_json - `pod_json_by_key` of the state log of all namespaces, which holds the running pods
+		"""
+		entry = self.other_json.get(pod_info.key)
+		return entry[1] if entry is not None else published_json[pod_info.key]
+
+	def query(self, query : StateQuery) -> Tuple[int, list]:
+		""" (number of matching pods, the requested page of them) """
+		pods = [self.pods[pos] for pos in self.select_positions(query.field_values)]
+
+		if query.min_gpus is not None or query.max_gpus is not None:
+			min_gpus = query.min_gpus or 0
+			max_gpus = query.max_gpus if query.max_gpus is not None else float('inf')
+			pods = [p for p in pods if min_gpus <= p.num_gpu <= max_gpus]
+
+		if query.idle_only:
+			pods = [p for p in pods if is_pod_idle(p)]
+
+		sort_key = SORT_KEYS[query.sort]
+		if sort_key is not None:
+			# stable, equal keys stay in queue order
+			pods.sort(key=sort_key, reverse=query.sort_descending)
+		elif query.sort_descending:
+			pods.reverse()
+
+		end = query.offset + query.limit if query.limit is not None else None
+		return len(pods), pods[query.offset:end]
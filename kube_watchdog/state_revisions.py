@@ -0,0 +1,201 @@
+
+import json
+import dataclasses
+import logging
+from collections import deque
+from datetime import datetime, date
+from typing import List, Mapping, Optional
+from .monitor import PodInfoToPublish
+
+log = logging.getLogger(__name__)
+
+POD_FIELD_NAMES = tuple(f.name for f in dataclasses.fields(PodInfoToPublish))
+
+def json_serialize_unknown(obj):
+	if isinstance(obj, (datetime, date)):
+		return obj.isoformat()
+
+	raise TypeError(f'Object not serializable class={type(obj)} obj={obj}')
+
+def pod_field_values(pod_info):
+	return tuple(getattr(pod_info, name) for name in POD_FIELD_NAMES)
+
+def pod_json_fragment(field_values):
+	return json.dumps(dict(zip(POD_FIELD_NAMES, field_values)), default=json_serialize_unknown)
+
+def json_list(fragments):
+	return '[' + ','.join(fragments) + ']'
+
+def revision_token(boot_id, revision) -> str:
+	""" `since` of `api/state`, the revisions start from 0 again when the server restarts """
+	return f'{boot_id}-{revision}'
+
+def parse_revision_token(token, boot_id) -> Optional[int]:
+	"""
+	The revision of a `revision_token`, None if it is from another start of the server (or a bare number).
+	Raises ValueError if the revision is not an integer.
+	"""
+	token_boot_id, _, revision = token.rpartition('-')
+	revision = int(revision)
+	return revision if token_boot_id == boot_id else None
+
+def patch_json(revision, changed_fragments, removed_keys, order):
+	""" order - None if unchanged """
+	order_json = json.dumps(order) if order is not None else 'null'
+	return f'{{"revision": {revision}, "full": false, "changed": {json_list(changed_fragments)}, "removed": {json.dumps(sorted(removed_keys))}, "order": {order_json}}}'
+
+
+@dataclasses.dataclass
+class StateUpdate:
+	""" The next revision of a `StateRevisionLog`, computed by `prepare_update` """
+	revision: int
+	order: List[str]
+	order_changed: bool
+	values_by_key: Mapping[str, tuple] # of the changed pods
+	json_by_key: Mapping[str, str] # of the changed pods
+	removed: set
+	snapshot_json: str
+	patch_json: str # changes from the previous revision
+
+
+class StateRevisionLog:
+	"""
+	The published pod list as a sequence of revisions.
+	Each pod is serialized only when its fields change,
+	clients which know revision N can download only the changes since N.
+	Pods are identified by `PodInfoToPublish.key` (namespace/name).
+	"""
+
+	# how many past revisions can be patched, older clients get a full snapshot
+	MAX_PATCHES = 64
+
+	revision: int
+	order: List[str] # pod keys
+	pod_values_by_key: Mapping[str, tuple]
+	pod_json_by_key: Mapping[str, str]
+
+	def __init__(self, max_patches=MAX_PATCHES):
+		self.revision = 0
+		self.order = []
+		self.pod_values_by_key = {}
+		self.pod_json_by_key = {}
+		self.snapshot_json = '[]'
+
+		# (revision, keys changed, keys removed, has the order changed)
+		self.patches = deque(maxlen=max_patches)
+
+	def update(self, pod_list) -> bool:
+		"""
+		Store the new pod list, returns True if it is different from the previous revision.
+		"""
+		update = self.prepare_update(pod_list)
+		if update is None:
+			return False
+
+		self.apply_update(update)
+		return True
+
+	def prepare_update(self, pod_list) -> StateUpdate:
+		"""
+		Computes the next revision without modifying the log, None if nothing has changed.
+		This is most of the work of `update`, it can run outside of the event loop 
+		as long as the log is not updated meanwhile.
+		"""
+		return self.prepare_update_from_values([p.key for p in pod_list], [pod_field_values(p) for p in pod_list])
+
+	def prepare_subset_update(self, source : 'StateRevisionLog', keys : List[str]) -> StateUpdate:
+		"""
+		The next revision holding these pods of another log, as of its current revision.
+		Reads only the serialized values of `source`, not the pod objects, which may be changing in the recompute thread.
+		"""
+		return self.prepare_update_from_values(
+			keys, 
+			[source.pod_values_by_key[key] for key in keys], 
+			known_json = source.pod_json_by_key,
+		)
+
+	def prepare_update_from_values(self, order, values_list, known_json={}) -> StateUpdate:
+		"""
+		order - pod keys
+		values_list - `pod_field_values` of each pod in `order`
+		known_json - key -> JSON fragment of the pod, if already serialized
+		"""
+		order_changed = order != self.order
+
+		values_by_key = {}
+		json_by_key = {}
+		for key, values in zip(order, values_list):
+			if self.pod_values_by_key.get(key) != values:
+				values_by_key[key] = values
+				json_by_key[key] = known_json.get(key) or pod_json_fragment(values)
+
+		removed = set(self.pod_values_by_key.keys()).difference(order) if order_changed else set()
+
+		if not (values_by_key or removed or order_changed):
+			return None
+
+		revision = self.revision + 1
+		return StateUpdate(
+			revision = revision,
+			order = order,
+			order_changed = order_changed,
+			values_by_key = values_by_key,
+			json_by_key = json_by_key,
+			removed = removed,
+			snapshot_json = json_list(json_by_key.get(key) or self.pod_json_by_key[key] for key in order),
+			patch_json = patch_json(revision, json_by_key.values(), removed, order if order_changed else None),
+		)
+
+	def apply_update(self, update : StateUpdate):
+		""" Switches to the revision from `prepare_update` """
+		if update.revision != self.revision + 1:
+			raise ValueError(f'Update to revision {update.revision} does not follow revision {self.revision}')
+
+		self.pod_values_by_key.update(update.values_by_key)
+		self.pod_json_by_key.update(update.json_by_key)
+		for key in update.removed:
+			del self.pod_values_by_key[key]
+			del self.pod_json_by_key[key]
+
+		self.revision = update.revision
+		self.order = update.order
+		self.patches.append((update.revision, set(update.json_by_key.keys()), update.removed, update.order_changed))
+		self.snapshot_json = update.snapshot_json
+
+	def full_json(self) -> str:
+		return f'{{"revision": {self.revision}, "full": true, "pods": {self.snapshot_json}}}'
+
+	def changes_since_json(self, since_revision : Optional[int]) -> str:
+		"""
+		Changes between `since_revision` and the current revision.
+		Falls back to a full snapshot if the client is too far behind or from the future,
+		or `since_revision` is None: a revision of a previous start of the server, see `parse_revision_token`.
+		"""
+		if since_revision is None:
+			return self.full_json()
+		if since_revision == self.revision:
+			return patch_json(self.revision, [], [], None)
+
+		oldest_patchable = self.patches[0][0] - 1 if self.patches else self.revision
+		if not (oldest_patchable <= since_revision < self.revision):
+			return self.full_json()
+
+		changed = set()
+		removed = set()
+		order_changed = False
+		for (rev, rev_changed, rev_removed, rev_order_changed) in self.patches:
+			if rev > since_revision:
+				changed |= rev_changed
+				removed |= rev_removed
+				order_changed = order_changed or rev_order_changed
+
+		# a pod could have been removed and added back since then
+		removed.difference_update(self.pod_json_by_key.keys())
+		changed.intersection_update(self.pod_json_by_key.keys())
+
+		return patch_json(
+			self.revision, 
+			(self.pod_json_by_key[key] for key in changed), 
+			removed, 
+			self.order if order_changed else None,
+		)
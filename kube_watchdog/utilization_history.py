@@ -0,0 +1,184 @@
+
+import math
+import numpy as np
+from typing import Mapping
+
+# (name, bucket length [s] - 0 keeps every measurement, retention [s], capacity)
+HISTORY_TIERS = [
+	('raw', 0, 3600, 360),
+	('1m', 60, 24*3600, 24*60),
+	('10m', 600, 7*24*3600, 7*24*6),
+]
+HISTORY_RESOLUTIONS = [name for (name, *_) in HISTORY_TIERS]
+
+def parse_resolutions(values):
+	"""
+	values - the requested resolution names, None or empty for all of them
+	Raises ValueError for an unknown resolution.
+	"""
+	if not values:
+		return None
+	unknown = [v for v in values if v not in HISTORY_RESOLUTIONS]
+	if unknown:
+		raise ValueError(f'resolution must be one of {", ".join(HISTORY_RESOLUTIONS)}, got {", ".join(unknown)}')
+	return set(values)
+
+class RingBuffer:
+	"""
+	Time series of (time, memory, compute) with a fixed maximal capacity, the oldest samples are overwritten.
+	The arrays start small and double until they reach the capacity, so that short jobs take little memory.
+	Missing values are NaN.
+	"""
+
+	INITIAL_CAPACITY = 16
+
+	def __init__(self, capacity):
+		self.capacity = capacity
+		size = min(self.INITIAL_CAPACITY, capacity)
+		self.times = np.empty(size, dtype=np.float64)
+		self.values = np.empty((size, 2), dtype=np.float32)
+		self.start = 0
+		self.size = 0
+
+	def __len__(self):
+		return self.size
+
+	def grow(self):
+		times, values = self.arrays()
+		new_size = min(2 * self.times.shape[0], self.capacity)
+
+		self.times = np.empty(new_size, dtype=np.float64)
+		self.values = np.empty((new_size, 2), dtype=np.float32)
+		self.times[:self.size] = times
+		self.values[:self.size] = values
+		self.start = 0
+
+	def append(self, time, memory, compute):
+		allocated = self.times.shape[0]
+
+		if self.size == allocated:
+			if allocated < self.capacity:
+				self.grow()
+				allocated = self.times.shape[0]
+			else:
+				# overwrite the oldest
+				self.start = (self.start + 1) % allocated
+				self.size -= 1
+
+		idx = (self.start + self.size) % allocated
+		self.times[idx] = time
+		self.values[idx] = (memory, compute)
+		self.size += 1
+
+	def arrays(self):
+		""" (times, values[:, memory/compute]) in chronological order """
+		order = (self.start + np.arange(self.size)) % self.times.shape[0]
+		return self.times[order], self.values[order]
+
+
+class DownsampledSeries:
+	"""
+	Averages of the measurements in buckets of `bucket_length` seconds, or every measurement if it is 0.
+	"""
+
+	def __init__(self, bucket_length, retention, capacity):
+		self.bucket_length = bucket_length
+		self.retention = retention
+		self.buffer = RingBuffer(capacity)
+
+		# bucket being filled: [bucket index, memory sum, memory count, compute sum, compute count]
+		self.pending = None
+
+	def add(self, time, memory, compute):
+		if self.bucket_length == 0:
+			self.buffer.append(time, memory, compute)
+			return
+
+		bucket = int(time // self.bucket_length)
+		if self.pending is not None and self.pending[0] != bucket:
+			self.flush()
+
+		if self.pending is None:
+			self.pending = [bucket, 0., 0, 0., 0]
+
+		if not math.isnan(memory):
+			self.pending[1] += memory
+			self.pending[2] += 1
+		if not math.isnan(compute):
+			self.pending[3] += compute
+			self.pending[4] += 1
+
+	def pending_sample(self):
+		bucket, memory_sum, memory_count, compute_sum, compute_count = self.pending
+		return (
+			bucket * self.bucket_length,
+			memory_sum / memory_count if memory_count else math.nan,
+			compute_sum / compute_count if compute_count else math.nan,
+		)
+
+	def flush(self):
+		self.buffer.append(*self.pending_sample())
+		self.pending = None
+
+	def to_dict(self, now):
+		times, values = self.buffer.arrays()
+
+		if self.pending is not None:
+			time, memory, compute = self.pending_sample()
+			times = np.append(times, time)
+			values = np.append(values, [[memory, compute]], axis=0)
+
+		recent = times >= now - self.retention
+		times = times[recent]
+		values = values[recent].astype(np.float64).round(3)
+
+		return dict(
+			time = times.tolist(),
+			memory = [None if math.isnan(v) else v for v in values[:, 0].tolist()],
+			compute = [None if math.isnan(v) else v for v in values[:, 1].tolist()],
+		)
+
+
+class PodUtilizationHistory:
+	"""
+	Utilization time series of each GPU of a pod, at the resolutions of `HISTORY_TIERS`.
+	"""
+	series_by_gpu : Mapping[int, Mapping[str, DownsampledSeries]]
+
+	def __init__(self):
+		self.series_by_gpu = {}
+
+	def add_report(self, date, gpus):
+		"""
+		gpus - `{gpu index: {memory, compute}}` from `NvidiaSmiCsvParser.summary`
+		"""
+		time = date.timestamp()
+
+		for gpu_index, gpu_report in gpus.items():
+			series = self.series_by_gpu.get(gpu_index)
+			if series is None:
+				series = self.series_by_gpu[gpu_index] = {
+					name: DownsampledSeries(bucket_length, retention, capacity)
+					for (name, bucket_length, retention, capacity) in HISTORY_TIERS
+				}
+
+			memory = gpu_report.get('memory')
+			compute = gpu_report.get('compute')
+			memory = math.nan if memory is None else memory
+			compute = math.nan if compute is None else compute
+
+			for s in series.values():
+				s.add(time, memory, compute)
+
+	def to_dict(self, now, resolutions=None):
+		"""
+		`{gpu index: {resolution: {time, memory, compute}}}`, times in seconds since epoch
+		"""
+		return {
+			gpu_index: {
+				name: s.to_dict(now)
+				for name, s in series.items()
+				if resolutions is None or name in resolutions
+			}
+			for gpu_index, series in sorted(self.series_by_gpu.items())
+		}
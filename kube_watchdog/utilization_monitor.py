@@ -1,10 +1,11 @@
 import logging
-import asyncio, functools
+import asyncio
+import aiohttp
 import kubernetes_asyncio as kube
-import numpy as np
-import random
+import heapq, itertools, time
 from datetime import datetime
-from io import StringIO
+from .exec_pool import ExecClientPool
+from .metrics import Histogram
 
 log = logging.getLogger(__name__)
 
@@ -29,46 +30,135 @@ GPU_QUERY_CMD = [
 	f'--query-gpu={",".join(GPU_QUERY_FIELDS)}',
 ]
 
-def process_row_percent(val):
-	return float(val.split(maxsplit=1)[0]) * 0.01
+CSV_UNAVAILABLE_PREFIXES = ('[', 'N/A') # [N/A], [Not Supported], [Unknown Error]
 
-def process_row_mem(val):
-	return float(val.split(maxsplit=1)[0])
+def csv_header_field(column):
+	""" `utilization.gpu [%]` -> (`utilization.gpu`, is percent) """
+	name, _, unit = column.strip().partition(' [')
+	return name, unit.startswith('%')
 
+def csv_number(value, is_percent=False):
+	""" `42 %` -> 0.42, `1024 MiB` -> 1024., None if unavailable """
+	value = value.strip()
+	if not value or value.startswith(CSV_UNAVAILABLE_PREFIXES):
+		return None
 
-#
-# There is a bizarre error when np.genfromtxt writes into the dict passed as the `covnerters` argument.
-# Every time the function is called, it writes again, and wraps our functions in functools.partial.
-# After enough iterations, the recursion depth is too big and causes an exception.
-# Our defense is twofold:
-# * pass encoding = 'utf8', the wrapper is made to pass `bytes` as argument to our converter
-#	we don't want bytes, why would we want them
-# * use a frozen dict to enforce np.genfromtxt can't write to it
+	number = float(value.split(maxsplit=1)[0])
+	return number * 0.01 if is_percent else number
 
-class FrozenDict(dict):
-	def __setitem__(self, key, value):
-		raise RuntimeError(f'FrozenDict: Trying to set key {key} to {value}')
 
-GPU_QUERY_PROCESSORS = FrozenDict(**{
-	'index': int,
-	'utilization.gpu': process_row_percent,
-	'utilization.memory': process_row_percent,
-	'memory.used': process_row_mem,
-	'memory.total': process_row_mem,
-})
+class NvidiaSmiCsvParser:
+	"""
+	Parses the `nvidia-smi --format=csv --loop` output as it arrives, `feed` accepts arbitrary chunks.
+	Only running sums per GPU are kept, not the rows.
+	Unavailable values (`[N/A]`, `[Not Supported]`) are skipped.
+	"""
+
+	def __init__(self):
+		self.buffer = ''
+		self.columns = None
+		self.compute_is_percent = True
+		# gpu index -> [compute sum, compute samples, memory fraction sum, memory samples]
+		self.sums_by_gpu = {}
+
+	def feed(self, text):
+		lines = (self.buffer + text).split('\n')
+		# the last element is an unfinished line, or '' if the text ends with a newline
+		self.buffer = lines.pop()
+		for line in lines:
+			self.parse_line(line)
+
+	def finish(self):
+		if self.buffer:
+			self.parse_line(self.buffer)
+			self.buffer = ''
+
+	def parse_line(self, line):
+		fields = line.split(',')
+
+		# the first line is the header, it would be repeated if nvidia-smi restarted
+		if self.columns is None or fields[0].strip() == 'index':
+			self.parse_header(fields)
+			return
+
+		try:
+			gpu_index = int(fields[self.columns[0]])
+			compute = csv_number(fields[self.columns[1]], self.compute_is_percent)
+			mem_used = csv_number(fields[self.columns[2]])
+			mem_total = csv_number(fields[self.columns[3]])
+		except (IndexError, ValueError) as e:
+			if line.strip():
+				log.warning(f'nvidia-smi: unexpected line {line!r}: {e!r}')
+			return
+
+		sums = self.sums_by_gpu.get(gpu_index)
+		if sums is None:
+			sums = self.sums_by_gpu[gpu_index] = [0., 0, 0., 0]
+
+		if compute is not None:
+			sums[0] += compute
+			sums[1] += 1
+		if mem_used is not None and mem_total:
+			sums[2] += mem_used / mem_total
+			sums[3] += 1
+
+	def parse_header(self, fields):
+		header = {}
+		for position, column in enumerate(fields):
+			name, is_percent = csv_header_field(column)
+			header[name] = (position, is_percent)
+
+		try:
+			# positions of GPU_QUERY_FIELDS
+			self.columns = tuple(header[name][0] for name in GPU_QUERY_FIELDS)
+			self.compute_is_percent = header['utilization.gpu'][1]
+		except KeyError as e:
+			raise ValueError(f'nvidia-smi: missing column {e} in header {",".join(fields)}')
+
+	def summary(self, gpu_indices=None):
+		"""
+		Average memory fraction and compute over all samples, and per GPU.
+		gpu_indices - only average over these GPUs, for example the ones of a pod when the report covers the whole node
+		"""
+		totals = [0., 0, 0., 0]
+		gpus = {}
+
+		for gpu_index, sums in self.sums_by_gpu.items():
+			if gpu_indices is not None and gpu_index not in gpu_indices:
+				continue
+
+			for i in range(4):
+				totals[i] += sums[i]
+			gpus[gpu_index] = dict(
+				memory = round(sums[2] / sums[3], 2) if sums[3] else None,
+				compute = round(sums[0] / sums[1], 2) if sums[1] else None,
+			)
+
+		if not (totals[1] or totals[3]):
+			raise ValueError('no GPU measurements in the nvidia-smi output')
+
+		return dict(
+			memory = round(totals[2] / totals[3], 2) if totals[3] else None,
+			compute = round(totals[0] / totals[1], 2) if totals[1] else None,
+			gpus = gpus,
+		)
 
-@functools.lru_cache(1)
-def get_api_ws():
-	return kube.client.CoreV1Api(api_client=kube.stream.WsApiClient())
 
+def process_nvidiasmi_report(report_txt, gpu_indices=None):
+	parser = NvidiaSmiCsvParser()
+	parser.feed(report_txt)
+	parser.finish()
+	return parser.summary(gpu_indices)
 
-async def run_nvidiasmi_on_container(pod_name, namespace, api=None):
-	# await kube.config.load_kube_config()
-	api_ws = api or get_api_ws()
 
+async def run_nvidiasmi_on_container(pod_name, namespace, api, parser=None):
+	"""
+	api - CoreV1Api with a websocket client, from `ExecClientPool`
+	Returns the command's output, stdout is passed to `parser` as it arrives.
+	"""
 	cmd = GPU_QUERY_CMD
 	
-	response_future = api_ws.connect_get_namespaced_pod_exec(
+	ws_connection = await api.connect_get_namespaced_pod_exec(
 		name = pod_name, 
 		namespace = namespace,
 		command = cmd,
@@ -76,63 +166,73 @@ async def run_nvidiasmi_on_container(pod_name, namespace, api=None):
 		stdin = False,
 		stdout = True,
 		tty = False,
+		_preload_content = False,
 	)
 
-	response = await asyncio.wait_for(response_future, timeout=GPU_QUERY_MEASUREMENT_TIMEOUT)
+	output = []
 
-	return response
+	async def read_output():
+		async with ws_connection as ws:
+			async for msg in ws:
+				if msg.type == aiohttp.WSMsgType.ERROR:
+					# the connection has failed, counts toward the retirement of the exec client
+					raise aiohttp.ClientConnectionError(msg.data)
+				if msg.type not in (aiohttp.WSMsgType.TEXT, aiohttp.WSMsgType.BINARY):
+					continue
 
+				data = msg.data if isinstance(msg.data, bytes) else msg.data.encode('utf8')
+				if len(data) <= 1:
+					continue
 
-def process_nvidiasmi_report(report_txt):
-	report_table = np.genfromtxt(
-		StringIO(report_txt), 
-		names = GPU_QUERY_FIELDS,
-		converters = GPU_QUERY_PROCESSORS,
-		deletechars = '', # prevent mangling of names
-		delimiter = ',', 
-		skip_header = 1, 
-		autostrip = True,
-		dtype = None, # prevent casting to float
-		encoding = 'utf8', # prevent adding tobytes wrappers
-	)
-	
-	mem_relative = report_table['memory.used'] / report_table['memory.total']
-	gpu_util = report_table['utilization.gpu']
-	
-	mem_relative_avg = np.mean(mem_relative).round(2)
-	gpu_util_avg = np.mean(gpu_util).round(2)
-	
-	return dict(
-		report_table = report_table,
-		memory = mem_relative_avg,
-		compute = gpu_util_avg,
-	)
+				# the first byte is the channel
+				channel, text = data[0], data[1:].decode('utf8')
+				if channel == kube.stream.ws_client.STDOUT_CHANNEL:
+					output.append(text)
+					if parser is not None:
+						parser.feed(text)
+				elif channel == kube.stream.ws_client.STDERR_CHANNEL:
+					output.append(text)
+
+	await asyncio.wait_for(read_output(), timeout=GPU_QUERY_MEASUREMENT_TIMEOUT)
 
-async def measure_gpu_utilization(pod_name, namespace, api=None):
+	return ''.join(output)
+
+
+async def measure_gpu_utilization(pod_name, namespace, exec_pool):
+	"""
+	The report's `outcome` is one of: success, empty, timeout, error
+	"""
 	result = dict(pod_name=pod_name)
 	
 	try:
-		result['report_txt'] = await run_nvidiasmi_on_container(
-			pod_name = pod_name,
-			namespace = namespace,
-			api = api,
-		)
+		parser = NvidiaSmiCsvParser()
+		async with exec_pool.client() as api:
+			result['report_txt'] = await run_nvidiasmi_on_container(
+				pod_name = pod_name,
+				namespace = namespace,
+				api = api,
+				parser = parser,
+			)
 
 		if result['report_txt']:
-			report_parsed = process_nvidiasmi_report(result['report_txt'])
-			result.update(report_parsed)
+			parser.finish()
+			result.update(parser.summary())
+			result['outcome'] = 'success'
 			log.info(f'nvidia-smi result success, pod {pod_name}')
 		else:
 			# empty report, maybe its a cpu job?
 			result['error'] = f'empty response at {datetime.now().isoformat()}'
+			result['outcome'] = 'empty'
 			log.warning(f'nvidia-smi result empty, pod {pod_name}')
 
 	except asyncio.TimeoutError:
 		result['error'] = f'timeout at {datetime.now().isoformat()}'
+		result['outcome'] = 'timeout'
 		log.warning(f'nvidia-smi timeout, pod {pod_name}')
 
 	except Exception as e:
 		result['error'] = str(e)
+		result['outcome'] = 'error'
 		log.exception(f'nvidia-smi monitor error, pod {pod_name}: {e}')	
 
 	result['date'] = datetime.now()
@@ -140,43 +240,203 @@ async def measure_gpu_utilization(pod_name, namespace, api=None):
 	return result
 
 
-class GpuUtilizationMonitor:
+class MeasurementEntry:
+	""" A pod registered in `GpuUtilizationScheduler` """
+
+	def __init__(self, pod_name, namespace, callback):
+		self.pod_name = pod_name
+		self.namespace = namespace
+		self.callback = callback
+		self.num_measurements = 0
+		self.num_failures = 0 # consecutive
+		self.interval = None
+		# (memory, compute) of the last successful measurement
+		self.last_values = None
+		self.active = True
+		self.task = None
+
+
+class GpuUtilizationScheduler:
 	"""
-	Measures the GPU utilization of a container in a loop untill stopped.
+	Measures the GPU utilization of all registered pods, 
+	each one at an interval after its previous measurement finished which adapts to what the measurements show:
+		- new pods, pods whose utilization changed, and pods which hold GPUs without using them: `min_interval` to `cooldown`
+		- stable utilization: the interval doubles with each measurement, up to `max_interval`
+		- failures (such as CPU-only containers without nvidia-smi): the interval doubles up to `max_failure_interval`
+
+	The pods wait in a heap ordered by the time they are due, pods which were never measured go first.
+	At most `max_concurrent` execs run at once and they start at most `max_rate` per second.
+	Once all pods have been measured, starts are also spaced by `cooldown / number of pods`,
+	so that a burst of due pods (after a restart) spreads evenly over the cooldown period.
+	If the measurements can not keep up, the period between measurements of a pod becomes longer than its interval.
 	"""
 
-	callback = None
-	loop_task = None
+	MAX_CONCURRENT = 16
+	MAX_RATE = 2.0 # exec starts per second
+
+	# intervals between measurements of a pod [s]
+	MIN_INTERVAL = GPU_QUERY_MEASUREMENT_COOLDOWN / 2
+	MAX_INTERVAL = GPU_QUERY_MEASUREMENT_COOLDOWN * 8
+	MAX_FAILURE_INTERVAL = 3600
+	# number of first measurements taken at `min_interval`
+	NUM_INITIAL_MEASUREMENTS = 3
+	# a change of memory or compute fraction bigger than this counts as changed
+	STABILITY_THRESHOLD = 0.1
+	# compute fraction below this with GPUs allocated is idle
+	IDLE_THRESHOLD = 0.05
+
+	def __init__(self, max_concurrent=MAX_CONCURRENT, max_rate=MAX_RATE, cooldown=GPU_QUERY_MEASUREMENT_COOLDOWN, 
+			min_interval=MIN_INTERVAL, max_interval=MAX_INTERVAL, max_failure_interval=MAX_FAILURE_INTERVAL, exec_pool=None, exec_heartbeat=ExecClientPool.HEARTBEAT):
+		self.max_concurrent = max_concurrent
+		self.max_rate = max_rate
+		self.cooldown = cooldown
+		self.min_interval = min_interval
+		self.max_interval = max_interval
+		self.max_failure_interval = max_failure_interval
+		self.exec_pool = exec_pool or ExecClientPool(max_connections=max_concurrent, heartbeat=exec_heartbeat)
+
+		self.measurement_duration = Histogram(
+			'watchdog_nvidiasmi_duration_seconds', 'Duration of nvidia-smi measurements by outcome', 
+			label_names = ['outcome'],
+		)
 
-	def __init__(self, pod_name, namespace):
-		self.pod_name = pod_name
-		self.namespace = namespace
+		self.entries = {}
+		# (never measured ? 0 : 1, due time, sequence number, entry)
+		self.heap = []
+		self.sequence = itertools.count()
+		self.last_start_time = -float('inf')
+
+		self.semaphore = None
+		self.heap_changed = None
+		self.num_running = 0
+
+	def register(self, key, pod_name, namespace, callback, last_measured=None):
+		""" 
+		Start measuring the pod, `callback(report)` is called after every measurement.
+		last_measured - date of a previous measurement (before a restart), the next one is due a cooldown after it
+		"""
+		self.unregister(key)
+		log.info(f'GPU utilization measurements scheduled for {key}')
+
+		entry = MeasurementEntry(pod_name=pod_name, namespace=namespace, callback=callback)
+		self.entries[key] = entry
+
+		due_time = time.monotonic()
+		if last_measured is not None:
+			entry.num_measurements = self.NUM_INITIAL_MEASUREMENTS
+			entry.interval = self.cooldown
+			due_time += max(0, self.cooldown - (datetime.now() - last_measured).total_seconds())
+
+		self.schedule(entry, due_time)
+
+	def unregister(self, key):
+		entry = self.entries.pop(key, None)
+		if entry is not None:
+			# the heap item is discarded when it reaches the top
+			entry.active = False
+			if entry.task is not None:
+				entry.task.cancel()
+			log.info(f'GPU utilization measurements stopped for {key}')
+
+	def schedule(self, entry, due_time):
+		priority = 0 if entry.num_measurements == 0 else 1
+		heapq.heappush(self.heap, (priority, due_time, next(self.sequence), entry))
+		
+		if self.heap_changed is not None:
+			self.heap_changed.set()
+
+	async def next_due(self) -> MeasurementEntry:
+		while True:
+			while self.heap and not self.heap[0][3].active:
+				heapq.heappop(self.heap)
+			
+			delay = None
+			if self.heap:
+				delay = self.heap[0][1] - time.monotonic()
+				if delay <= 0:
+					return heapq.heappop(self.heap)[3]
+
+			self.heap_changed.clear()
+			try:
+				await asyncio.wait_for(self.heap_changed.wait(), timeout=delay)
+			except asyncio.TimeoutError:
+				pass
 
-	async def measurement_loop(self):
-		log.info(f'GPU utilization monitor starting for {self.pod_name}')
+	def start_interval(self, entry):
+		interval = 1. / self.max_rate
+		if entry.num_measurements > 0 and self.entries:
+			interval = max(interval, self.cooldown / len(self.entries))
+		return interval
 
-		# initial offset, so that all measurements don't start at the same time, overloading the server
-		await asyncio.sleep(random.uniform(0, 1) * GPU_QUERY_MEASUREMENT_COOLDOWN)
+	async def run(self):
+		self.semaphore = asyncio.Semaphore(self.max_concurrent)
+		self.heap_changed = asyncio.Event()
 
 		while True:
-			report = await measure_gpu_utilization(pod_name = self.pod_name, namespace = self.namespace)
+			await self.semaphore.acquire()
 			try:
-				if self.callback:
-					self.callback(report)
-			except Exception as e:
-				log.exception(f'gpu utilization exception in callback, pod {self.pod_name}')
-			log.info(f'nvidia-smi waiting, pod {self.pod_name}')
-			await asyncio.sleep(GPU_QUERY_MEASUREMENT_COOLDOWN)
+				entry = await self.next_due()
+
+				wait = self.last_start_time + self.start_interval(entry) - time.monotonic()
+				if wait > 0:
+					# put it back, a pod never measured may get registered in the meantime
+					self.schedule(entry, time.monotonic() + wait)
+					self.semaphore.release()
+					continue
+			except:
+				self.semaphore.release()
+				raise
+
+			self.last_start_time = time.monotonic()
+			self.num_running += 1
+			entry.task = asyncio.get_event_loop().create_task(self.measure(entry))
+
+	def next_interval(self, entry, report) -> float:
+		if 'error' in report or report.get('compute') is None:
+			entry.num_failures += 1
+			return min(self.cooldown * 2**(entry.num_failures - 1), self.max_failure_interval)
+		entry.num_failures = 0
+
+		values = (report.get('memory') or 0., report['compute'])
+		previous_values = entry.last_values
+		entry.last_values = values
+
+		if entry.num_measurements <= self.NUM_INITIAL_MEASUREMENTS or previous_values is None:
+			return self.min_interval
+
+		changed = any(abs(v - pv) > self.STABILITY_THRESHOLD for (v, pv) in zip(values, previous_values))
+		if changed:
+			return self.min_interval
+
+		interval = min((entry.interval or self.cooldown) * 2, self.max_interval)
+
+		# idle GPUs are what the dashboard is for, keep them up to date
+		if values[1] < self.IDLE_THRESHOLD:
+			interval = min(interval, self.cooldown)
+
+		return interval
+
+	async def measure(self, entry):
+		try:
+			t_start = time.monotonic()
+			report = await measure_gpu_utilization(pod_name = entry.pod_name, namespace = entry.namespace, exec_pool = self.exec_pool)
+			self.measurement_duration.observe(time.monotonic() - t_start, (report['outcome'],))
+			entry.num_measurements += 1
+			entry.interval = self.next_interval(entry, report)
 
-	def start(self, callback):
-		self.stop()
-		self.callback = callback
-		self.loop_task = asyncio.get_event_loop().create_task(self.measurement_loop())
-
-	def stop(self):
-		if self.loop_task is not None:
-			self.loop_task.cancel()
-			self.loop_task = None
-			log.info(f'utilization monitor stopped, pod {self.pod_name}')
-		self.callback = None
-		
\ No newline at end of file
+			try:
+				entry.callback(report)
+			except Exception as e:
+				log.exception(f'gpu utilization exception in callback, pod {entry.pod_name}')
+		finally:
+			self.semaphore.release()
+			self.num_running -= 1
+			entry.task = None
+
+		if entry.active:
+			self.schedule(entry, time.monotonic() + entry.interval)
+
+	async def close(self):
+		for key in list(self.entries.keys()):
+			self.unregister(key)
+		await self.exec_pool.close()
@@ -3,27 +3,69 @@ import asyncio
 import json, yaml
 import dataclasses
 import logging
+import time
+import gzip
+import hmac
+import os
+import shutil
+import signal
+import multiprocessing
 import click
-from datetime import datetime, date
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
 from pathlib import Path
 from aiohttp import web
 import jinja2
-from .monitor import KubernetesPodListSupervisor
-from .fairness import pods_calculate_order
+from .monitor import KubernetesPodListSupervisor, namespaces_from_options
+from .kube_listener import KubernetesPodListMonitor
+from .fairness import FairnessQueuesByNamespace
+from .state_revisions import StateRevisionLog, json_serialize_unknown, json_list, revision_token, parse_revision_token
+from .state_query import StateIndex, StateQuery
+from .shared_state import SharedStateWriter, make_state_dir
+from .exec_pool import ExecClientPool
+from .utilization_history import parse_resolutions
+from .metrics import MetricsRegistry, Histogram, CallbackMetric, EventLoopLagMonitor, CONTENT_TYPE as METRICS_CONTENT_TYPE
 
-log = logging.getLogger(__name__)
+try:
+	import brotli
+except ImportError:
+	# optional, gzip is used without it
+	brotli = None
 
-def json_serialize_unknown(obj):
-	if isinstance(obj, (datetime, date)):
-		return obj.isoformat()
-	
-	raise TypeError(f'Object not serializable class={type(obj)} obj={obj}')
+# the C emitter is several times faster, when PyYAML is built with libyaml
+YamlDumper = getattr(yaml, 'CSafeDumper', yaml.SafeDumper)
+
+log = logging.getLogger(__name__)
 
 def build_json_response(pod_list):
 	state_obj = [dataclasses.asdict(p) for p in pod_list]
 	state_json = json.dumps(state_obj, default=json_serialize_unknown)
 	return state_json
 
+RESPONSE_SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+# smaller responses are not worth compressing
+COMPRESSION_MIN_SIZE = 1024
+
+CONTENT_ENCODERS = {
+	'gzip': lambda data: gzip.compress(data, compresslevel=6),
+}
+if brotli is not None:
+	CONTENT_ENCODERS['br'] = lambda data: brotli.compress(data, quality=5)
+
+def preferred_encoding(accept_encoding):
+	""" br if available and accepted, otherwise gzip or identity (q-values are ignored) """
+	accepted = {enc.split(';')[0].strip() for enc in accept_encoding.split(',')}
+	for encoding in ('br', 'gzip'):
+		if encoding in accepted and encoding in CONTENT_ENCODERS:
+			return encoding
+	return 'identity'
+
+def sse_message(data_text):
+	""" Encode a Server-Sent Events message, data must not contain newlines """
+	return f'data: {data_text}\n\n'.encode('utf8')
+
 def expunge_nulls(d):
 	if isinstance(d, dict):
 		return {
@@ -37,51 +79,641 @@ def expunge_nulls(d):
 		return d
 
 
+class EncodedSnapshot:
+	"""
+	The snapshot of a `StateRevisionLog` in each content encoding, 
+	compressed on the first request for each revision and then served from memory.
+	"""
+
+	def __init__(self):
+		self.revision = None
+		self.bodies = {}
+
+	def get(self, state_log, encoding) -> bytes:
+		if self.revision != state_log.revision:
+			self.revision = state_log.revision
+			self.bodies = {'identity': state_log.snapshot_json.encode('utf8')}
+
+		body = self.bodies.get(encoding)
+		if body is None:
+			body = self.bodies[encoding] = CONTENT_ENCODERS[encoding](self.bodies['identity'])
+		return body
+
+
+def render_pod_yaml(description_raw : bytes) -> str:
+	""" Blocking, meant to run in an executor """
+	return yaml.dump(expunge_nulls(json.loads(description_raw)), Dumper=YamlDumper)
+
+
+class RenderedDescriptionCache:
+	"""
+	LRU cache of the YAML descriptions of pods, keyed by pod and valid for one `resourceVersion`.
+	Descriptions missing from the cache are rendered in the default executor;
+	concurrent requests for the same pod wait for the same rendering.
+	"""
+
+	MAX_SIZE = 256
+
+	def __init__(self, max_size=MAX_SIZE):
+		self.max_size = max_size
+		# pod key -> (resource version, future of the YAML text)
+		self.entries = OrderedDict()
+		self.num_hits = 0
+		self.num_misses = 0
+
+	async def get(self, pod_data) -> str:
+		key = pod_data.data_pub.key
+		version = pod_data.resource_version
+		entry = self.entries.get(key)
+
+		if entry is not None and entry[0] == version:
+			self.num_hits += 1
+			self.entries.move_to_end(key)
+			result = entry[1]
+		else:
+			self.num_misses += 1
+			result = asyncio.get_event_loop().run_in_executor(None, render_pod_yaml, pod_data.description_raw)
+			self.entries[key] = (version, result)
+			self.entries.move_to_end(key)
+			while len(self.entries) > self.max_size:
+				self.entries.popitem(last=False)
+
+		try:
+			# a disconnecting client must not cancel the rendering shared with the others
+			return await asyncio.shield(result)
+		except Exception:
+			if self.entries.get(key, (None, None))[1] is result:
+				del self.entries[key]
+			raise
+
+
+def revision_headers(request, boot_id, revision, representation):
+	"""
+	Headers of a response for this state revision, with its ETag.
+	representation - the content encoding of a snapshot, 'patch' or 'query'
+	Raises 304 if the client has this revision, whichever form of it it has asked for
+	(ETags are per URL, so the revision also identifies the result of a query).
+	The 304 carries the ETag which the full response would have had.
+	"""
+	etag_prefix = f'"{boot_id}-{revision}-'
+	headers = {
+		'ETag': f'{etag_prefix}{representation}"',
+		'X-State-Revision': str(revision),
+		# for `?since=`, revisions are only comparable within one start of the server
+		'X-State-Token': revision_token(boot_id, revision),
+		'Cache-Control': 'no-cache',
+		'Vary': 'Accept-Encoding',
+	}
+
+	if any(tag.strip().startswith(etag_prefix) for tag in request.headers.get('If-None-Match', '').split(',')):
+		raise web.HTTPNotModified(headers=headers)
+
+	return headers
+
+def json_text_response(json_text, headers):
+	response = web.Response(text=json_text, content_type="application/json", headers=headers)
+	if len(json_text) > COMPRESSION_MIN_SIZE:
+		response.enable_compression()
+	return response
+
+def state_response(request, state, boot_id, snapshot_body):
+	"""
+	Response of `api/state`, shared by the server and its web workers.
+	state - `StateRevisionLog` or `SharedState`
+	snapshot_body(encoding) - the snapshot of `state` compressed with that encoding
+	"""
+	since = request.query.get('since', None)
+
+	if since is None:
+		encoding = preferred_encoding(request.headers.get('Accept-Encoding', ''))
+		headers = revision_headers(request, boot_id, state.revision, encoding)
+		body = snapshot_body(encoding)
+		if encoding != 'identity':
+			headers['Content-Encoding'] = encoding
+		return web.Response(body=body, content_type="application/json", headers=headers)
+
+	headers = revision_headers(request, boot_id, state.revision, 'patch')
+
+	try:
+		state_json = state.changes_since_json(parse_revision_token(since, boot_id))
+	except ValueError:
+		raise web.HTTPBadRequest(reason=f'Expected the X-State-Token of a previous response, got {since}')
+
+	return json_text_response(state_json, headers)
+
+
 class WatchdogWebServer:
 
 	WEB_STATIC_DIR = Path(__file__).parent / 'web_assets'
 	WEB_STATIC_INDEX = WEB_STATIC_DIR / 'index.html'
 
-	def __init__(self, namespace, port=8000, config_file=None):
+	# comment line sent to idle stream clients so that proxies do not drop the connection
+	STREAM_KEEPALIVE_INTERVAL = 30
+
+	UTILIZATION_SOURCES = ['exec', 'agent', 'off']
+	RECOMPUTE_MODES = ['thread', 'inline']
+	# wait after a failed recompute [s]
+	RECOMPUTE_RETRY_DELAY = 5
+
+	def __init__(self, namespaces=None, label_selector=None, port=8000, config_file=None, coalesce_window=KubernetesPodListSupervisor.COALESCE_WINDOW, utilization_source='exec', snapshot_path=None, watch_decoding='raw', recompute_mode='thread', num_workers=0, agent_token=None, exec_heartbeat=ExecClientPool.HEARTBEAT):
+		"""
+		namespaces - list of namespaces to watch, None for the whole cluster
+		utilization_source - 
+			exec: run nvidia-smi in each pod
+			agent: receive reports from `node_agent` on each node at `api/utilization`
+			off: do not measure
+		agent_token - the shared secret which the node agents send, required for `utilization_source = 'agent'`
+		exec_heartbeat - interval [s] of the pings on the nvidia-smi exec websockets, None to disable
+		watch_decoding - one of `KubernetesPodListMonitor.WATCH_DECODINGS`
+		recompute_mode - where the ordering and serialization run after a state change
+			thread: in a worker thread, the event loop keeps serving requests meanwhile
+			inline: on the event loop
+		num_workers - if not 0, this process only collects the state and this many worker processes serve it, see `web_worker`
+		"""
+		if utilization_source == 'agent' and not agent_token:
+			raise ValueError('Utilization reports from the node agents require an agent_token')
+
 		self.port = port
-		self.namespace = namespace
+		self.utilization_source = utilization_source
+		self.agent_token = agent_token
+		self.exec_heartbeat = exec_heartbeat
+		self.snapshot_path = snapshot_path
+		self.watch_decoding = watch_decoding
+		self.recompute_mode = recompute_mode
+		self.num_workers = num_workers
+		self.namespaces = namespaces
+		self.label_selector = label_selector
 		self.config_file = config_file
-		self.pod_hierarchy_json = '[]'
+		self.coalesce_window = coalesce_window
+		self.fairness_queue = FairnessQueuesByNamespace()
+		self.pod_hierarchy = []
+		# of `pod_hierarchy`, for the filtered `api/state` queries
+		self.state_index = StateIndex()
+
+		# key None is the state of all namespaces,
+		# the per-namespace logs are created when first requested with `?namespace=`
+		self.state_logs = {None: StateRevisionLog()}
+		# the patch from the previous revision, sent to all stream clients which are up to date
+		self.state_patches_sse = {}
+
+		# resolved and replaced every time the published state changes, stream clients await it
+		self.state_changed = None
+		self.num_stream_clients = 0
+
+		# created in `run` for the thread mode
+		self.recompute_executor = None
+		# the newest pod list not yet processed, while a recompute is running
+		self.pending_pods = None
+		self.recompute_task = None
+		# set when `run` exits, nothing is submitted to the executor afterwards
+		self.closing = False
+
+		# namespace -> compressed snapshot bodies of the current revision
+		self.encoded_snapshots = {}
+		# revisions start from 0 when the server restarts, the ETags must not repeat
+		self.boot_id = format(int(time.time()), 'x')
+		# the state of all namespaces for the web workers, created in `run` if there are workers
+		self.shared_state = None
+
+		self.order_duration = Histogram('watchdog_order_duration_seconds', 'Duration of the fairness ordering per state change')
+		self.serialize_duration = Histogram('watchdog_serialize_duration_seconds', 'Duration of the state serialization per state change')
+		self.loop_lag = EventLoopLagMonitor('watchdog_event_loop_lag_seconds', 'Delay of the event loop in running a task which is due')
+		self.response_size = Histogram(
+			'watchdog_response_size_bytes', 'Size of HTTP responses and stream messages by route', 
+			buckets = RESPONSE_SIZE_BUCKETS, label_names = ['route'],
+		)
 
 		self.html_template_describe_pod = jinja2.Template(
 			(self.WEB_STATIC_DIR / 'describe_pod.html').read_text()
 		)
+		self.description_cache = RenderedDescriptionCache()
+
+	def on_kube_state_change(self, pod_list):
+		if self.closing:
+			return
+
+		if self.recompute_executor is None:
+			self.apply_recompute(self.recompute(pod_list))
+			return
+
+		# one recompute at a time, the changes which arrive meanwhile are processed together afterwards
+		self.pending_pods = pod_list
+		if self.recompute_task is None:
+			self.recompute_task = asyncio.get_event_loop().create_task(self.recompute_in_executor())
+
+	async def recompute_in_executor(self):
+		loop = asyncio.get_event_loop()
+		try:
+			while self.pending_pods is not None:
+				pod_list, self.pending_pods = self.pending_pods, None
+				try:
+					result = await loop.run_in_executor(self.recompute_executor, self.recompute, pod_list)
+				except Exception as e:
+					log.exception(f'Error in state recompute, retrying in {self.RECOMPUTE_RETRY_DELAY}s')
+					# keep the list unless a newer one has arrived, otherwise the published state would stay stale
+					if self.pending_pods is None:
+						self.pending_pods = pod_list
+					await asyncio.sleep(self.RECOMPUTE_RETRY_DELAY)
+					continue
+
+				if not self.apply_recompute(result) and self.pending_pods is None:
+					# a namespace log was created meanwhile, prepare its updates again
+					self.pending_pods = pod_list
+		finally:
+			self.recompute_task = None
+
+	async def stop_recompute(self):
+		""" Stops the recompute task, and then the executor once no more work can be submitted to it """
+		self.closing = True
+
+		task = self.recompute_task
+		if task is not None:
+			task.cancel()
+			try:
+				await task
+			except asyncio.CancelledError:
+				pass
+
+		if self.recompute_executor is not None:
+			# waits for the recompute or shared state write in progress, so that it does not outlive the state file
+			self.recompute_executor.shutdown(wait=True)
+
+	def recompute(self, pod_list):
+		"""
+		Ordering and serialization of a new pod list, the CPU-heavy part of a state change.
+		In the thread mode this runs in `recompute_executor`: the pod list is the one published by the supervisor, 
+		and the state logs are only read, `apply_recompute` switches them to the new revisions on the event loop.
+		The ordering writes `user_ordinal` and `global_ordinal` into the pod objects, 
+		so the event loop must not read those fields from the objects, only from the state logs.
+		"""
+		t0 = time.perf_counter()
+		pod_hierarchy = self.fairness_queue.update(pod_list)
+		state_index = StateIndex(pod_hierarchy, [p for p in pod_list if p.status != 'Running'], previous=self.state_index)
+		t1 = time.perf_counter()
+
+		updates = {
+			namespace: state_log.prepare_update(self.namespace_pods(namespace, pod_hierarchy))
+			for namespace, state_log in list(self.state_logs.items())
+		}
+
+		return pod_hierarchy, state_index, updates, t1 - t0, time.perf_counter() - t1
+
+	def apply_recompute(self, result) -> bool:
+		"""
+		Returns False if some update was prepared from an outdated log and has been dropped,
+		or a log was created after the recompute started and has no update.
+		"""
+		pod_hierarchy, state_index, updates, order_duration, serialize_duration = result
+		self.pod_hierarchy = pod_hierarchy
+		self.state_index = state_index
+
+		any_changed = False
+		all_applied = updates.keys() >= self.state_logs.keys()
+		for namespace, update in updates.items():
+			if update is None:
+				continue
+			if update.revision != self.state_logs[namespace].revision + 1:
+				all_applied = False
+				continue
+
+			self.apply_state_update(namespace, update)
+			any_changed = True
+
+			if namespace is None and self.shared_state is not None:
+				self.publish_shared_state(update)
+
+		self.order_duration.observe(order_duration)
+		self.serialize_duration.observe(serialize_duration)
+
+		if any_changed:
+			self.notify_state_changed()
+			# log.info('New state: ' + self.state_logs[None].snapshot_json)
 
-	def on_kube_state_change(self, event):
-		self.pod_hierarchy = pods_calculate_order(self.monitor.get_pods())
-		self.pod_hierarchy_json = build_json_response(self.pod_hierarchy)
-		# log.info('New state: ' + self.pod_hierarchy_json)
+		return all_applied
+
+	def publish_shared_state(self, update):
+		""" Compresses the snapshot once for all workers, in the recompute thread if there is one """
+		if self.closing:
+			return
+
+		if self.recompute_executor is not None:
+			self.recompute_executor.submit(self.write_shared_state, update)
+		else:
+			self.write_shared_state(update)
+
+	def write_shared_state(self, update):
+		try:
+			snapshot = update.snapshot_json.encode('utf8')
+			bodies = {encoding: encode(snapshot) for encoding, encode in CONTENT_ENCODERS.items()}
+			bodies['identity'] = snapshot
+			self.shared_state.publish(update.revision, bodies, update.patch_json.encode('utf8'))
+		except Exception as e:
+			log.exception('Error while publishing the shared state')
+
+	def namespace_pods(self, namespace, pod_hierarchy):
+		if namespace is None:
+			return pod_hierarchy
+		return [p for p in pod_hierarchy if p.namespace == namespace]
+
+	def apply_state_update(self, namespace, update):
+		self.state_logs[namespace].apply_update(update)
+		self.state_patches_sse[namespace] = sse_message(update.patch_json)
+
+	def update_state_log(self, namespace) -> bool:
+		""" Brings a namespace log to the current revision of the log of all namespaces """
+		source = self.state_logs[None]
+		prefix = f'{namespace}/'
+		keys = [key for key in source.order if key.startswith(prefix)]
+
+		update = self.state_logs[namespace].prepare_subset_update(source, keys)
+		if update is not None:
+			self.apply_state_update(namespace, update)
+			return True
+		return False
+
+	def get_state_log(self, request):
+		"""
+		The state log for the `?namespace=` query parameter, all namespaces if it is absent.
+		"""
+		namespace = request.query.get('namespace', None) or None
+
+		state_log = self.state_logs.get(namespace, None)
+		if state_log is not None:
+			return namespace, state_log
+
+		# only create logs for namespaces we watch, not for any string a client sends
+		if self.namespaces is not None:
+			is_watched = namespace in self.namespaces
+		else:
+			is_watched = namespace in self.fairness_queue.queues
+
+		if not is_watched:
+			raise web.HTTPNotFound(reason=f'Namespace {namespace} is not watched')
+
+		state_log = self.state_logs[namespace] = StateRevisionLog()
+		self.update_state_log(namespace)
+		return namespace, state_log
+
+	def notify_state_changed(self):
+		if self.state_changed is not None:
+			self.state_changed.set_result(None)
+		self.state_changed = asyncio.get_event_loop().create_future()
 
 	async def web_index(self, request):
 		return web.FileResponse(self.WEB_STATIC_INDEX)
 
 	async def web_state(self, request):
-		return web.Response(
-			text = self.pod_hierarchy_json,
-			content_type = "application/json",
-		)
+		"""
+		Without arguments: list of pods.
+		With `?since=<X-State-Token>`: changes since that revision, or a full snapshot if it is too old or from before a restart.
+		With `?namespace=ns`: only the pods of that namespace (revisions are counted separately).
+		With any of the `state_query` parameters: see `web_state_query`.
+		"""
+		if StateQuery.is_requested(request.query):
+			return self.web_state_query(request)
 
-	async def web_describe_pod(self, request):
+		namespace, state_log = self.get_state_log(request)
+		encoded_snapshot = self.encoded_snapshots.setdefault(namespace, EncodedSnapshot())
+
+		return state_response(request, state_log, self.boot_id, lambda encoding: encoded_snapshot.get(state_log, encoding))
+
+	def web_state_query(self, request):
+		"""
+		A filtered, sorted page of all pods, not only the running ones, `{"revision", "total", "offset", "pods"}`:
+			user, status, node, namespace - can be repeated, a pod matches one of the values of each given parameter
+			min_gpus, max_gpus - number of GPUs
+			idle - only pods with GPUs which are not computing
+			sort - queue (default, the pods which are not running follow the queue), name, user, gpus, started, compute, memory; descending with a - prefix
+			limit, offset - the page, `total` is the number of all matching pods
+		"""
+		try:
+			query = StateQuery.from_query(request.query)
+		except ValueError as e:
+			raise web.HTTPBadRequest(reason=str(e))
+
+		# the index and the log of all namespaces are switched to a new revision together
+		state_log = self.state_logs[None]
+		headers = revision_headers(request, self.boot_id, state_log.revision, 'query')
+
+		total, pods = self.state_index.query(query)
+		pods_json = json_list(self.state_index.pod_json(p, state_log.pod_json_by_key) for p in pods)
+		state_json = f'{{"revision": {state_log.revision}, "total": {total}, "offset": {query.offset}, "pods": {pods_json}}}'
+
+		return json_text_response(state_json, headers)
+
+	async def web_state_stream(self, request):
+		"""
+		Server-Sent Events stream: the full state is sent on connection,
+		then a patch only when the state changes (same format as `api/state?since=`).
+		Accepts `?namespace=ns` like `api/state`.
+		"""
+		namespace, state_log = self.get_state_log(request)
+
+		response = web.StreamResponse(headers = {
+			'Content-Type': 'text/event-stream',
+			'Cache-Control': 'no-cache',
+			'X-Accel-Buffering': 'no', # disable buffering in nginx
+		})
+		await response.prepare(request)
+		self.num_stream_clients += 1
+
+		try:
+			client_revision = state_log.revision
+			msg = sse_message(state_log.full_json())
+			self.response_size.observe(len(msg), ('/api/state/stream',))
+			await response.write(msg)
+
+			while True:
+				if client_revision == state_log.revision:
+					try:
+						await asyncio.wait_for(
+							asyncio.shield(self.state_changed), 
+							timeout = self.STREAM_KEEPALIVE_INTERVAL,
+						)
+					except asyncio.TimeoutError:
+						await response.write(b': keepalive\n\n')
+					continue
+
+				if client_revision == state_log.revision - 1:
+					msg = self.state_patches_sse[namespace]
+				else:
+					msg = sse_message(state_log.changes_since_json(client_revision))
+
+				client_revision = state_log.revision
+				self.response_size.observe(len(msg), ('/api/state/stream',))
+				await response.write(msg)
+
+		except ConnectionResetError:
+			# client has closed the page
+			pass
+		finally:
+			self.num_stream_clients -= 1
+
+		return response
+
+	async def web_ingest_utilization(self, request):
+		"""
+		Reports from a node agent: `{"node": name, "pods": [{"uid", "memory", "compute", "report_txt"}, ...]}`
+		The agent authenticates with `Authorization: Bearer <agent_token>`.
+		"""
+		authorization = request.headers.get('Authorization', '')
+		if not hmac.compare_digest(authorization.encode('utf8'), f'Bearer {self.agent_token}'.encode('utf8')):
+			log.warning(f'Utilization report with a wrong token from {request.remote}')
+			raise web.HTTPUnauthorized(headers={'WWW-Authenticate': 'Bearer'})
+
+		try:
+			body = await request.json()
+			node = body.get('node')
+			pod_reports = list(body['pods'])
+		except (ValueError, KeyError, TypeError, AttributeError):
+			raise web.HTTPBadRequest(reason='Expected JSON object {"node": name, "pods": [...]}')
+
+		num_matched = self.monitor.on_utilization_reports(pod_reports, node=node)
+		log.debug(f'Utilization report from node {node}: {len(pod_reports)} pods, {num_matched} matched')
+
+		return web.json_response(dict(pods_matched = num_matched))
+
+	def get_pod_data(self, request):
 		pod_name = request.match_info['pod_name']
+		namespace = request.match_info.get('namespace', None)
 
-		pod_data = self.monitor.pod_data_by_name.get(pod_name, None)
+		if namespace is not None:
+			pod_data = self.monitor.get_pod_data(namespace, pod_name)
+		else:
+			# old links without namespace, fine as long as the name is unique
+			pod_data = next((pd for pd in self.monitor.pod_data_by_key.values() if pd.name == pod_name), None)
 
 		if pod_data is None:
 			raise web.HTTPNotFound(reason=f"No pod {pod_name}")
 
-		pod_description = pod_data.description_from_api
+		return pod_data
+
+	async def web_utilization_history(self, request):
+		"""
+		GPU utilization of a pod over time, `{"pod", "gpus": {index: {resolution: {time, memory, compute}}}}`
+		`?resolution=raw|1m|10m` (can be repeated), all by default.
+		"""
+		try:
+			resolutions = parse_resolutions(request.query.getall('resolution', None))
+		except ValueError as e:
+			raise web.HTTPBadRequest(reason=str(e))
+
+		pod_data = self.get_pod_data(request)
+
+		history = pod_data.utilization_history
+		gpus = history.to_dict(now=datetime.now().timestamp(), resolutions=resolutions) if history is not None else {}
+
+		return web.json_response(dict(
+			pod = pod_data.data_pub.key,
+			gpus = gpus,
+		))
+
+	async def web_metrics(self, request):
+		return web.Response(
+			body = self.metrics.render().encode('utf8'),
+			headers = {'Content-Type': METRICS_CONTENT_TYPE},
+		)
+
+	@web.middleware
+	async def response_size_middleware(self, request, handler):
+		response = await handler(request)
+
+		# streamed and file responses do not have a body here
+		body = getattr(response, 'body', None)
+		if isinstance(body, bytes):
+			resource = request.match_info.route.resource
+			route = resource.canonical if resource is not None else 'unknown'
+			self.response_size.observe(len(body), (route,))
+
+		return response
+
+	def setup_metrics(self):
+		monitor = self.monitor
+		scheduler = monitor.utilization_scheduler
+
+		self.metrics = MetricsRegistry()
+		m = self.metrics
+
+		m.register(CallbackMetric(
+			'watchdog_watch_events_total', 'Kubernetes watch events by type, suppressed: modifications without published changes',
+			lambda: (((ev_type,), count) for ev_type, count in monitor.event_counts.items()),
+			metric_type = 'counter', label_names = ['type'],
+		))
+		m.register(CallbackMetric(
+			'watchdog_state_changes_total', 'Changes of the pod state, before coalescing',
+			lambda: [((), monitor.num_state_changes)], metric_type = 'counter',
+		))
+		m.register(CallbackMetric(
+			'watchdog_state_publishes_total', 'Deliveries of the pod state to listeners, after coalescing',
+			lambda: [((), monitor.num_publishes)], metric_type = 'counter',
+		))
+		m.register(self.order_duration)
+		m.register(self.serialize_duration)
+		m.register(self.loop_lag.histogram)
+		m.register(self.loop_lag.max_lag_metric('watchdog_event_loop_lag_max_seconds', 'Largest event loop lag since the previous scrape'))
+		m.gauge('watchdog_pods', 'Pods stored', lambda: [((), len(monitor.pod_data_by_key))])
+		m.gauge('watchdog_state_revision', 'Revision of the published state', lambda: [((), self.state_logs[None].revision)])
+		m.gauge('watchdog_stream_clients', 'Connected state stream clients', lambda: [((), self.num_stream_clients)])
+		m.register(self.response_size)
+		m.register(CallbackMetric(
+			'watchdog_describe_cache_requests_total', 'Pod description requests by cache result',
+			lambda: [(('hit',), self.description_cache.num_hits), (('miss',), self.description_cache.num_misses)],
+			metric_type = 'counter', label_names = ['result'],
+		))
+
+		if scheduler is not None:
+			pool = scheduler.exec_pool
+			m.register(scheduler.measurement_duration)
+			m.gauge('watchdog_measurements_registered', 'Pods registered for utilization measurement', lambda: [((), len(scheduler.entries))])
+			m.gauge('watchdog_measurements_running', 'nvidia-smi measurements in progress', lambda: [((), scheduler.num_running)])
+			m.gauge('watchdog_exec_clients', 'Websocket clients in the exec pool', lambda: [((), len(pool.clients))])
+			m.gauge('watchdog_exec_in_use', 'Execs in progress through the pool', lambda: [((), pool.num_in_use)])
+			m.gauge('watchdog_exec_in_use_max', 'Most execs in progress at once since the start', lambda: [((), pool.max_in_use)])
+			m.gauge('watchdog_exec_capacity', 'Concurrent execs allowed by the pool', lambda: [((), pool.max_connections)])
+			m.register(pool.exec_duration)
+			m.register(CallbackMetric(
+				'watchdog_exec_total', 'Execs through the pool',
+				lambda: [((), pool.num_execs)], metric_type = 'counter',
+			))
+			m.register(CallbackMetric(
+				'watchdog_exec_errors_total', 'Execs through the pool which failed',
+				lambda: [((), pool.num_errors)], metric_type = 'counter',
+			))
+			m.register(CallbackMetric(
+				'watchdog_exec_clients_replaced_total', 'Exec clients retired after connection errors',
+				lambda: [((), pool.num_clients_replaced)], metric_type = 'counter',
+			))
+
+		def pod_utilization(field):
+			for pd in monitor.pod_data_by_key.values():
+				value = pd.utilization_report.get(field)
+				if value is not None:
+					yield (pd.namespace, pd.name, pd.data_pub.user or ''), value
+
+		pod_labels = ['namespace', 'pod', 'user']
+		m.gauge(
+			'watchdog_pod_gpus', 'GPUs allocated to running pods', 
+			lambda: (((p.namespace, p.name, p.user or ''), p.num_gpu) for p in monitor.get_pods() if p.status == 'Running'),
+			label_names = pod_labels,
+		)
+		m.gauge('watchdog_pod_gpu_compute_ratio', 'GPU compute utilization of the pod, 0-1', lambda: pod_utilization('compute'), label_names = pod_labels)
+		m.gauge('watchdog_pod_gpu_memory_ratio', 'GPU memory allocated by the pod, 0-1', lambda: pod_utilization('memory'), label_names = pod_labels)
+
+	async def web_describe_pod(self, request):
+		pod_data = self.get_pod_data(request)
+		pod_name = pod_data.name
+
 		pod_utilization_report = pod_data.utilization_report
+		pod_data_yaml = await self.description_cache.get(pod_data)
 
+		# the page itself only inserts the cached texts, it is rendered each time for the access date
 		html = self.html_template_describe_pod.render(
 			pod_name = pod_name,
+			# relative, so that the page also works behind a proxy under a path prefix
+			root_path = '../' * (request.path.count('/') - 1),
 			nvidiasmi_date = pod_utilization_report.get('date', None),
 			nvidiasmi_report = pod_utilization_report.get('report_txt', None) or pod_utilization_report.get('error', ''),
-			pod_data_yaml = yaml.dump(expunge_nulls(pod_description.to_dict())),
+			pod_data_yaml = pod_data_yaml,
 			date_accessed = datetime.now(),
 		)
 
@@ -91,47 +723,146 @@ class WatchdogWebServer:
 	async def run(self):
 		log.info('Server being constructed')
 
+		self.notify_state_changed()
+
 		# setup kubernetes
 		self.monitor = KubernetesPodListSupervisor(
-			namespace = self.namespace, 
+			namespaces = self.namespaces, 
+			label_selector = self.label_selector,
 			config_file = self.config_file,
+			coalesce_window = self.coalesce_window,
+			measure_utilization = self.utilization_source == 'exec',
+			snapshot_path = self.snapshot_path,
+			watch_decoding = self.watch_decoding,
+			exec_heartbeat = self.exec_heartbeat,
 		)
 		self.monitor.add_listener(self.on_kube_state_change)
+		self.setup_metrics()
 
 		# setup webserver
-		self.application = web.Application()
+		self.application = web.Application(middlewares=[self.response_size_middleware])
 
 		self.application.add_routes([
 			web.get('/', self.web_index),
 			web.get('/api/state', self.web_state),
+			web.get('/api/state/stream', self.web_state_stream),
+			web.get('/describe/{namespace}/{pod_name}', self.web_describe_pod),
 			web.get('/describe/{pod_name}', self.web_describe_pod),
+			web.get('/api/history/{namespace}/{pod_name}', self.web_utilization_history),
+			web.get('/api/history/{pod_name}', self.web_utilization_history),
+			web.get('/metrics', self.web_metrics),
 			web.static('/static', self.WEB_STATIC_DIR / 'static', follow_symlinks=True),
 		])
 
+		if self.utilization_source == 'agent':
+			self.application.add_routes([
+				web.post('/api/utilization', self.web_ingest_utilization),
+			])
+
+		if self.recompute_mode == 'thread':
+			self.recompute_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='recompute')
+
 		runner = web.AppRunner(self.application)
 		await runner.setup()
-		site = web.TCPSite(runner, '0.0.0.0', self.port)
+
+		workers = []
+		if self.num_workers:
+			# the workers take the public port, requests they can not answer come through the socket
+			state_dir = make_state_dir()
+			self.shared_state = SharedStateWriter(state_dir / 'state', self.boot_id)
+			collector_socket = state_dir / 'collector.sock'
+			site = web.UnixSite(runner, str(collector_socket))
+		else:
+			site = web.TCPSite(runner, '0.0.0.0', self.port)
 		
 		log.info('Server starting')
 
 		# wait for both
-		await asyncio.gather(
-			self.monitor.run(),
-			site.start(),
-		)
+		try:
+			await site.start()
+			monitor_task = asyncio.ensure_future(self.monitor.run())
+
+			if self.num_workers:
+				workers = self.start_workers(self.shared_state.path, collector_socket)
+				# stops the monitor, which closes its API clients, then the workers and the shared state file are cleaned up
+				asyncio.get_event_loop().add_signal_handler(signal.SIGTERM, monitor_task.cancel)
+
+			await asyncio.gather(
+				monitor_task,
+				self.loop_lag.run(),
+			)
+		finally:
+			await self.stop_recompute()
+
+			for process in workers:
+				process.terminate()
+			for process in workers:
+				process.join(timeout=5)
+
+			if self.shared_state is not None:
+				self.shared_state.close()
+				shutil.rmtree(state_dir, ignore_errors=True)
+
+	def start_workers(self, state_path, collector_socket):
+		from .web_worker import run_worker
+
+		# spawn, a fork would inherit the running event loop
+		context = multiprocessing.get_context('spawn')
+		workers = [
+			context.Process(
+				target = run_worker, 
+				args = (self.port, str(state_path), str(collector_socket), os.getpid(), i),
+				name = f'web-worker-{i}',
+				daemon = True,
+			)
+			for i in range(self.num_workers)
+		]
+		for process in workers:
+			process.start()
+
+		log.info(f'Started {self.num_workers} web workers on port {self.port}')
+		return workers
 
 @click.command('server')
-@click.option('--namespace', type=str, help="Kubernetes namespace to monitor")
+@click.option('--namespace', type=str, multiple=True, help="Kubernetes namespace to monitor, can be repeated")
+@click.option('--all-namespaces', is_flag=True, help="Monitor all namespaces in the cluster")
+@click.option('--label-selector', type=str, default=None, help="Only monitor pods matching this selector, for example lab=cvlab")
 @click.option('--config', type=click.Path(exists=True, file_okay=True, dir_okay=False), help="Config file path", default=None)
 @click.option('--port', type=int, default=8000)
-def main(namespace, config, port):
+@click.option('--coalesce-window', type=float, default=KubernetesPodListSupervisor.COALESCE_WINDOW, help="Changes within this many seconds are processed together, 0 to disable")
+@click.option('--utilization', type=click.Choice(WatchdogWebServer.UTILIZATION_SOURCES), default='exec', help="How GPU utilization is measured: exec nvidia-smi in each pod, or receive reports from node agents")
+@click.option('--snapshot', type=click.Path(dir_okay=False), default=None, help="Save the state to this file and restore it at startup")
+@click.option('--watch-decoding', type=click.Choice(KubernetesPodListMonitor.WATCH_DECODINGS), default='raw', help="Parse the watch stream as JSON directly, or through the client's model objects")
+@click.option('--recompute', type=click.Choice(WatchdogWebServer.RECOMPUTE_MODES), default='thread', help="Run the ordering and serialization in a worker thread, or on the event loop")
+@click.option('--workers', type=int, default=0, help="Serve the web interface from this many processes sharing the port, 0 to serve from the collecting process")
+@click.option('--agent-token-file', type=click.Path(exists=True, dir_okay=False), default=None, help="File with the secret token of the node agents, required with --utilization agent")
+@click.option('--exec-heartbeat', type=float, default=ExecClientPool.HEARTBEAT, help="Seconds between pings on the nvidia-smi exec websockets, which keep them open through proxies, 0 to disable")
+def main(namespace, all_namespaces, label_selector, config, port, coalesce_window, utilization, snapshot, watch_decoding, recompute, workers, agent_token_file, exec_heartbeat):
 	"""
 	Host the web interface.
 	"""
+	agent_token = Path(agent_token_file).read_text().strip() if agent_token_file else None
+	if utilization == 'agent' and not agent_token:
+		raise click.UsageError('--utilization agent requires a non-empty --agent-token-file, the reports are not accepted without it')
 
 	server = WatchdogWebServer(
-		namespace = namespace, 
+		namespaces = namespaces_from_options(namespace, all_namespaces), 
+		label_selector = label_selector,
 		port = port,
 		config_file = config,
+		coalesce_window = coalesce_window,
+		utilization_source = utilization,
+		snapshot_path = snapshot,
+		watch_decoding = watch_decoding,
+		recompute_mode = recompute,
+		num_workers = workers,
+		agent_token = agent_token,
+		exec_heartbeat = exec_heartbeat or None,
 	)
-	asyncio.get_event_loop().run_until_complete(server.run())
+
+	# asyncio.run cancels the tasks on Ctrl+C, so that the API clients get closed
+	try:
+		asyncio.run(server.run())
+	except asyncio.CancelledError:
+		# SIGTERM with workers
+		log.info('Server stopped')
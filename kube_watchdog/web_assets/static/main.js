@@ -6,6 +6,14 @@ import { useState, useEffect } from './lib/preact-10.0.5/hooks.module.js';
 
 const UPDATE_INTERVAL = 1.5;
 
+// `?namespace=ns` in the page address shows only that namespace
+const NAMESPACE_FILTER = new URLSearchParams(window.location.search).get('namespace');
+const NAMESPACE_QUERY = NAMESPACE_FILTER ? `namespace=${encodeURIComponent(NAMESPACE_FILTER)}` : '';
+
+function pod_key(pod_info) {
+	return `${pod_info.namespace}/${pod_info.name}`;
+}
+
 const ORDINAL_ENDING = ['th', 'st', 'nd', 'rd', 'th', 'th', 'th', 'th', 'th', 'th'];
 function ordinal_text(num) {
 	if (num === 0) {
@@ -106,7 +114,7 @@ function JobListRow(attrs) {
 		[
 			// name
 			h('td', {'class': 'name'}, 
-				h('a', {'href': `describe/${pod_info.name}`, 'target': '_blank'}, pod_info.name),
+				h('a', {'href': `describe/${pod_key(pod_info)}`, 'target': '_blank'}, pod_info.name),
 			),
 			// owner
 			(known_user ? 
@@ -153,22 +161,98 @@ function JobRowSeparator(attrs) {
 	);
 }
 
+function NamespaceHeader(attrs) {
+	return h('tr', {}, 
+		h('th', {'class': 'namespace', 'colspan': job_list_columns.length}, 
+			h('a', {'href': `?namespace=${encodeURIComponent(attrs.namespace)}`}, attrs.namespace),
+		),
+	);
+}
+
 function ClusterStatsBar(attrs) {
 	const {cluster_stats} = attrs;
 
 	return h('span', {'class': 'cluster-stats-bar'}, `Number of GPUs allocated: ${cluster_stats.total_num_gpu_allocated}`);
 }
 
+/*
+Client copy of the server state, updated with patches
+	{revision, full: true, pods}
+	{revision, full: false, changed, removed, order}
+*/
+class PodState {
+	constructor() {
+		this.revision = 0;
+		this.pods_by_key = new Map();
+		this.order = [];
+	}
+
+	apply_patch(patch) {
+		if (patch.full) {
+			this.pods_by_key = new Map(patch.pods.map((p) => [pod_key(p), p]));
+			this.order = patch.pods.map(pod_key);
+		} else {
+			for (const key of patch.removed) {
+				this.pods_by_key.delete(key);
+			}
+			for (const pod_info of patch.changed) {
+				this.pods_by_key.set(pod_key(pod_info), pod_info);
+			}
+			if (patch.order !== null) {
+				this.order = patch.order;
+			}
+		}
+		this.revision = patch.revision;
+	}
+
+	pod_list() {
+		return this.order.map((key) => this.pods_by_key.get(key));
+	}
+}
+
 function JobList() {
 	const [pod_list, set_pod_list] = useState([]);
 
 	useEffect(() => {
+		const pod_state = new PodState();
+
+		// the server pushes a new state only when it changes
+		if (window.EventSource) {
+			const event_source = new EventSource(`api/state/stream?${NAMESPACE_QUERY}`);
+
+			event_source.onmessage = (event) => {
+				pod_state.apply_patch(JSON.parse(event.data));
+				set_pod_list(pod_state.pod_list());
+			};
+
+			console.log('Subscribed to state stream');
+
+			// return cleanup function
+			return () => {
+				event_source.close();
+				console.log('Closed state stream');
+			}
+		}
+
+		// fallback for browsers without EventSource: polling
+		// the server answers 304 without a body if our revision is still current
+		let etag = null;
+		// revision of the last response and the server's start, a restarted server sends a full snapshot,
+		// as it does for a bare revision number
+		let state_token = '0';
 
 		const check_for_update = async () => {
-			const response_raw = await fetch('api/state');
+			const headers = etag ? {'If-None-Match': etag} : {};
+			const response_raw = await fetch(`api/state?since=${encodeURIComponent(state_token)}&${NAMESPACE_QUERY}`, {headers});
+			if (response_raw.status === 304) {
+				return;
+			}
+			etag = response_raw.headers.get('ETag');
+			state_token = response_raw.headers.get('X-State-Token') || state_token;
 			const response = await response_raw.json();
 
-			set_pod_list(response);
+			pod_state.apply_patch(response);
+			set_pod_list(pod_state.pod_list());
 		};
 
 		check_for_update();
@@ -188,6 +272,10 @@ function JobList() {
 
 	const rows = [];
 	let prev_ord = null;
+	let prev_namespace = null;
+
+	// the pods are grouped by namespace, each namespace has its own queue
+	const multiple_namespaces = pod_list.some((p) => p.namespace !== pod_list[0].namespace);
 	
 	const cluster_stats = {
 		total_num_gpu_allocated: 0,
@@ -198,14 +286,22 @@ function JobList() {
 		const known_user = pod_info.user !== null;
 		const this_ord = known_user ? pod_info.user_ordinal : null;
 
-		if (prev_ord !== null && prev_ord !== this_ord) {
+		if (prev_ord !== null && (prev_ord !== this_ord || prev_namespace !== pod_info.namespace)) {
 			rows.push(h(JobRowSeparator, 
-				{'ordinal': prev_ord, 'key': `sep_ord_${prev_ord}`},
+				{'ordinal': prev_ord, 'key': `sep_ord_${prev_namespace}_${prev_ord}`},
+			));
+		}
+
+		if (multiple_namespaces && prev_namespace !== pod_info.namespace) {
+			rows.push(h(NamespaceHeader, 
+				{'namespace': pod_info.namespace, 'key': `ns_${pod_info.namespace}`},
 			));
+			prev_ord = null;
 		}
+		prev_namespace = pod_info.namespace;
 
 		rows.push(h(JobListRow, 
-			{'pod_info': pod_info, 'key': pod_info.name},
+			{'pod_info': pod_info, 'key': pod_key(pod_info)},
 		));
 
 		cluster_stats.total_num_gpu_allocated += pod_info.num_gpu;
@@ -216,7 +312,7 @@ function JobList() {
 	// if the last job is not anonymous, add the last separator as summary to how many gpus were used
 	if (prev_ord !== null) {
 		rows.push(h(JobRowSeparator, 
-			{'ordinal': prev_ord, 'key': `sep_ord_${prev_ord}`},
+			{'ordinal': prev_ord, 'key': `sep_ord_${prev_namespace}_${prev_ord}`},
 		));
 	}
 
@@ -0,0 +1,192 @@
+
+"""
+Web workers for `server --workers N`.
+The collector process runs the watch, the utilization measurements and the ordering,
+and publishes each revision of the state to a `SharedStateWriter`.
+The workers share the public port (SO_REUSEPORT) and serve the state, its stream and the static files;
+other requests are forwarded to the collector through its unix socket.
+"""
+
+import asyncio
+import logging
+import os
+import aiohttp
+from aiohttp import web
+from . import init_log
+from .shared_state import SharedStateReader
+from .state_query import StateQuery
+from .web import WatchdogWebServer, CONTENT_ENCODERS, state_response, sse_message
+
+log = logging.getLogger(__name__)
+
+# not passed on by the forwarding, the connection to the collector is separate
+HOP_BY_HOP_HEADERS = {'connection', 'keep-alive', 'transfer-encoding', 'upgrade', 'te', 'trailer', 'proxy-authorization', 'proxy-authenticate'}
+
+
+class WatchdogWebWorker:
+
+	# how often the shared state is checked for a new revision [s]
+	POLL_INTERVAL = 0.1
+
+	def __init__(self, port, state_path, collector_socket, parent_pid):
+		self.port = port
+		self.state_path = state_path
+		self.collector_socket = collector_socket
+		self.parent_pid = parent_pid
+
+		self.state_changed = None
+
+	def snapshot_body(self, shared, encoding):
+		body = shared.bodies.get(encoding)
+		if body is None:
+			# an encoding the collector does not have, compressed once per revision in this worker
+			body = shared.bodies[encoding] = CONTENT_ENCODERS[encoding](shared.bodies['identity'])
+		return body
+
+	def notify_state_changed(self):
+		if self.state_changed is not None:
+			self.state_changed.set_result(None)
+		self.state_changed = asyncio.get_event_loop().create_future()
+
+	async def watch_shared_state(self):
+		""" Wakes up the stream clients on each new revision, returns when the collector has exited """
+		sequence = self.reader.read().sequence
+
+		while os.getppid() == self.parent_pid:
+			await asyncio.sleep(self.POLL_INTERVAL)
+
+			shared = self.reader.read()
+			if shared.sequence != sequence:
+				sequence = shared.sequence
+				self.notify_state_changed()
+
+		log.info(f'Web worker {os.getpid()}: the collector process has exited')
+
+	async def web_index(self, request):
+		return web.FileResponse(WatchdogWebServer.WEB_STATIC_INDEX)
+
+	async def web_state(self, request):
+		""" `WatchdogWebServer.web_state` for all namespaces, namespaces and filtered queries are answered by the collector """
+		if request.query.get('namespace', None) or StateQuery.is_requested(request.query):
+			return await self.forward(request)
+
+		shared = self.reader.read()
+		return state_response(request, shared, shared.boot_id, lambda encoding: self.snapshot_body(shared, encoding))
+
+	async def web_state_stream(self, request):
+		""" `WatchdogWebServer.web_state_stream` for all namespaces """
+		if request.query.get('namespace', None):
+			return await self.forward(request)
+
+		response = web.StreamResponse(headers = {
+			'Content-Type': 'text/event-stream',
+			'Cache-Control': 'no-cache',
+			'X-Accel-Buffering': 'no', # disable buffering in nginx
+		})
+		await response.prepare(request)
+
+		try:
+			shared = self.reader.read()
+			client_revision = shared.revision
+			await response.write(sse_message(shared.full_json()))
+
+			while True:
+				shared = self.reader.read()
+				if client_revision == shared.revision:
+					try:
+						await asyncio.wait_for(
+							asyncio.shield(self.state_changed),
+							timeout = WatchdogWebServer.STREAM_KEEPALIVE_INTERVAL,
+						)
+					except asyncio.TimeoutError:
+						await response.write(b': keepalive\n\n')
+					continue
+
+				msg = sse_message(shared.changes_since_json(client_revision))
+				client_revision = shared.revision
+				await response.write(msg)
+
+		except ConnectionResetError:
+			# client has closed the page
+			pass
+
+		return response
+
+	async def forward(self, request):
+		""" Passes the request to the collector and streams back its response """
+		headers = {k: v for k, v in request.headers.items() if k.lower() not in HOP_BY_HOP_HEADERS}
+		body = await request.read() if request.can_read_body else None
+
+		try:
+			upstream = await self.collector_session.request(
+				request.method, f'http://collector{request.path_qs}',
+				headers = headers, data = body, allow_redirects = False,
+			)
+		except aiohttp.ClientConnectionError as e:
+			log.error(f'Web worker could not reach the collector: {e}')
+			raise web.HTTPBadGateway(reason='Collector process unavailable')
+
+		try:
+			response = web.StreamResponse(
+				status = upstream.status,
+				reason = upstream.reason,
+				headers = {k: v for k, v in upstream.headers.items() if k.lower() not in HOP_BY_HOP_HEADERS},
+			)
+			await response.prepare(request)
+
+			async for chunk in upstream.content.iter_any():
+				await response.write(chunk)
+
+			await response.write_eof()
+			return response
+
+		except ConnectionResetError:
+			# client has left, also closes a forwarded stream
+			return response
+		finally:
+			upstream.release()
+
+	async def run(self):
+		self.reader = SharedStateReader(self.state_path)
+		self.notify_state_changed()
+
+		# bodies are passed through as they are, still compressed, in the encoding the client has accepted
+		self.collector_session = aiohttp.ClientSession(
+			connector = aiohttp.UnixConnector(path=self.collector_socket),
+			auto_decompress = False,
+			skip_auto_headers = ['Accept-Encoding', 'User-Agent'],
+			timeout = aiohttp.ClientTimeout(total=None),
+		)
+
+		self.application = web.Application()
+		self.application.add_routes([
+			web.get('/', self.web_index),
+			web.get('/api/state', self.web_state),
+			web.get('/api/state/stream', self.web_state_stream),
+			web.static('/static', WatchdogWebServer.WEB_STATIC_DIR / 'static', follow_symlinks=True),
+			web.route('*', '/{path:.*}', self.forward),
+		])
+
+		runner = web.AppRunner(self.application)
+		await runner.setup()
+		site = web.TCPSite(runner, '0.0.0.0', self.port, reuse_port=True)
+		await site.start()
+		log.info(f'Web worker {os.getpid()} serving on port {self.port}')
+
+		try:
+			await self.watch_shared_state()
+		finally:
+			await runner.cleanup()
+			await self.collector_session.close()
+			self.reader.close()
+
+
+def run_worker(port, state_path, collector_socket, parent_pid, worker_index):
+	""" Entry point of a worker process """
+	init_log(f'watchdog-worker{worker_index}.log')
+
+	try:
+		asyncio.run(WatchdogWebWorker(port, state_path, collector_socket, parent_pid).run())
+	except KeyboardInterrupt:
+		# the collector in the same terminal stops the workers itself
+		pass